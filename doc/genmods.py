@@ -34,7 +34,11 @@ MODULES = [
     #('interface', 'Interface'),
     ('abeles', 'Pure python reflectivity calculator'),
     ('anstodata', 'Reader for ANSTO data format'),
+    ('backend', 'Selectable kernel implementations'),
+    ('bulkload', 'Concurrent loading of many data files'),
     ('cheby', 'Freeform - Chebyshev model'),
+    ('cost', 'Evaluation cost estimates'),
+    ('datacache', 'Binary cache for parsed data files'),
     #('composition', 'Composition space model'),
     #('corrtest', 'Test for residual structure'),
     ('dist', 'Non-uniform samples'),
@@ -10,10 +10,13 @@ application uses reflmodule to compute reflectivity.
 """
 from __future__ import print_function, division
 
+import numpy as np
 from numpy import asarray, isscalar, empty, ones, ones_like
 from numpy import sqrt, exp, pi
 
-def refl(kz, depth, rho, irho=0, sigma=0, rho_index=None):
+from .interface import Tanh, TANH_INTERFACE, LINEAR_INTERFACE
+
+def refl(kz, depth, rho, irho=0, sigma=0, rho_index=None, shape=None):
     r"""
     Reflectometry as a function of kz for a set of slabs.
 
@@ -34,6 +37,10 @@ def refl(kz, depth, rho, irho=0, sigma=0, rho_index=None):
         entries, though it may have m with the last entry ignored.
     *rho_index* : int[m]
         index into rho vector for each kz
+    *shape* : int[m-1]
+        interface shape code for each interface, or None for gaussian
+        roughness throughout.  See
+        :func:`refl1d.reflectivity.reflectivity_amplitude`.
 
     Slabs are ordered with the surface SLD at index 0 and substrate at
     index -1, or reversed if kz < 0.
@@ -48,6 +55,7 @@ def refl(kz, depth, rho, irho=0, sigma=0, rho_index=None):
     rho = asarray(rho, 'd')
     irho = irho*ones_like(rho) if isscalar(irho) else asarray(irho, 'd')
     sigma = sigma*ones(m-1, 'd') if isscalar(sigma) else asarray(sigma, 'd')
+    shape = 0*sigma if shape is None else asarray(shape, 'i')
 
     # Repeat rho, irho columns as needed
     if rho_index is not None:
@@ -66,15 +74,35 @@ def refl(kz, depth, rho, irho=0, sigma=0, rho_index=None):
     ## This allows the caller to provide an array of length n
     ## corresponding to rho, mu or of length n-1.
     r = empty(len(kz), 'D')
-    r[kz >= 1e-10] = _calc(kz[kz >= 1e-10], depth, rho, irho, sigma)
-    r[kz <= 1e-10] = _calc(-kz[kz <= 1e-10], depth[::-1], rho[:, ::-1],
-                           irho[:, ::-1], sigma[m-2::-1])
+    for index, sign in ((kz >= 1e-10, 1), (kz <= 1e-10, -1)):
+        # Select the rows for the points when each kz has its own profile.
+        rows, irows = ((rho[index], irho[index]) if rho_index is not None
+                       else (rho, irho))
+        if sign > 0:
+            r[index] = _calc(kz[index], depth, rows, irows, sigma, shape)
+        else:
+            r[index] = _calc(-kz[index], depth[::-1], rows[:, ::-1],
+                             irows[:, ::-1], sigma[m-2::-1], shape[m-2::-1])
     r[abs(kz) < 1e-10] = -1
     return r
 
 
-def _calc(kz, depth, rho, irho, sigma):
-    # type: (np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray) -> np.ndarray
+def _roughness(shape, k, k_next, sigma):
+    """
+    Roughness factor for the Fresnel coefficient between k and k_next.
+    """
+    if shape == TANH_INTERFACE and sigma > 0:
+        s = pi*sigma/(2*Tanh.C)
+        a, b = s*(k - k_next), s*(k + k_next)
+        return np.sinh(a)/np.sinh(b)*(b/a)
+    elif shape == LINEAR_INTERFACE and sigma > 0:
+        x = sqrt(k*k_next)*sigma
+        return np.sin(x)/x
+    else:
+        return exp(-2*k*k_next*sigma**2)
+
+def _calc(kz, depth, rho, irho, sigma, shape):
+    # type: (np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray) -> np.ndarray
     if len(kz) == 0:
         return kz
 
@@ -94,7 +122,7 @@ def _calc(kz, depth, rho, irho, sigma):
     for i in range(0, len(depth)-1):
         k_next = sqrt(kz_sq - 4e-6*pi*(rho[:, i+1] + 1j*irho[:, i+1]))
         F = (k - k_next) / (k + k_next)
-        F *= exp(-2*k*k_next*sigma[i]**2)
+        F *= _roughness(shape[i], k, k_next, sigma[i])
         #print("==== layer", i)
         #print("kz:", kz.real)
         #print("k:", k.real)
@@ -15,6 +15,7 @@ import os.path
 import numpy as np
 
 from bumps.data import maybe_open
+from . import datacache
 from .probe import QProbe
 from .resolution import FWHM2sigma
 
@@ -38,6 +39,16 @@ def _load_dat(f):
     (filename, name, data) - str, str, tuple of np.ndarray
     """
 
+    header, data = datacache.parse(_parse_dat, f)
+
+    # the cached name may be relative to another working directory
+    filename = f if not hasattr(f, 'read') else header['filename']
+    name = os.path.splitext(os.path.basename(filename))[0]
+
+    return filename, name, data
+
+
+def _parse_dat(f):
     # it would be nice to use refl1d.probe.load4 directly. However,
     # there are lots of files in the wild that don't use # to denote comments
     # in the header. In addition, it is known that ANSTO datasets emit dQ as
@@ -58,10 +69,7 @@ def _load_dat(f):
 
     data = np.loadtxt(f, unpack=True, skiprows=header_lines)
 
-    filename = fname
-    name = os.path.splitext(os.path.basename(fname))[0]
-
-    return filename, name, data
+    return {'filename': fname}, data
 
 
 def load(filename, instrument=None, **kw):
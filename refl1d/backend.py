@@ -0,0 +1,575 @@
+# This program is public domain
+r"""
+Selectable implementations of the reflectivity kernels.
+
+The reflectivity amplitude, the magnetic reflectivity amplitude and the
+gaussian resolution convolution can be computed by more than one backend:
+
+    =======  ==========================================================
+    backend  implementation
+    =======  ==========================================================
+    c        reflmodule extension, threaded with OpenMP
+    numba    loops compiled with numba, run in parallel over the points
+    numpy    :func:`refl1d.abeles.refl` over batches of points
+    =======  ==========================================================
+
+The C kernels are used by default.  They are the only ones supporting
+the incremental calculation and single precision, so with another backend
+the amplitude is always computed in full and in double precision.  The
+magnetic amplitude only has a C implementation, since there is no pure
+python version of the magnetic calculation to build the others on.
+
+Which backend is fastest depends on the shape of the model, the processor
+and the number of threads, with a few layers on a long Q grid behaving
+differently from thousands of microslabs on a short one.  Use::
+
+    from refl1d import backend
+    backend.use_backend('auto')
+    experiment.tune_backends()
+
+to time the available backends on the shapes used by the model before
+the fit, keeping the fastest.  Shapes are grouped by the nearest power of
+two in the number of layers and points.  Shapes which were not tuned use
+the C kernels, so no timing is done in the middle of a fit.  Models using
+the incremental calculation or single precision also keep the C kernel
+for the amplitude.  The choices are saved in a per-host cache file so
+the timing is only done once for each group.  The cache directory is
+taken from the environment variable REFL1D_BACKEND_CACHE, or
+~/.refl1d if it is not set.  Setting the environment variable
+REFL1D_BACKEND to the backend name selects it in the worker processes of
+a parallel fit as well.
+
+Other implementations, such as a GPU kernel, can be added with
+:func:`register`.
+"""
+from __future__ import division, print_function
+
+__all__ = ['KERNELS', 'register', 'available', 'use_backend', 'get_backend',
+           'autotune', 'tune', 'use_backend_cache', 'select', 'evaluate']
+
+import os
+import math
+import json
+import socket
+from timeit import default_timer as timer
+
+import numpy as np
+
+from . import __version__
+from .util import lazy_njit, numba_available, asbytes, atomic_write
+from .interface import Tanh
+from . import abeles
+
+_BACKEND_KEY = 'REFL1D_BACKEND'
+_BACKEND_CACHE_KEY = 'REFL1D_BACKEND_CACHE'
+
+#: Kernels with selectable implementations.  The implementations are
+#: called as follows, with dense arrays for all vector arguments:
+#:
+#:   amplitude(kz, depth, rho, irho, sigma, rho_index, shape) -> r
+#:   magnetic(kz, depth, rho, irho, sigma, sld_b, u1, u3, Aguide,
+#:            rho_index) -> (r++, r+-, r-+, r--)
+#:   convolve(xi, yi, x, dx) -> y
+#:
+#: See :func:`refl1d.reflectivity.reflectivity_amplitude`,
+#: :func:`refl1d.reflectivity.magnetic_amplitude` and
+#: :func:`refl1d.reflectivity.convolve` for the meaning of the arguments.
+KERNELS = ('amplitude', 'magnetic', 'convolve')
+
+# {kernel: [(name, function, available)]} in order of registration
+_registry = dict((kernel, []) for kernel in KERNELS)
+# {kernel: name} for the current process, with name 'auto' for autotuning
+_setting = {}
+# [path, {'kernel:layers x points': name}] for the host cache
+_cache_setting = []
+# True while tune() is running
+_tuning = [False]
+
+# Relative difference allowed between a backend and the reference backend
+# when autotuning.
+_AGREEMENT = 1e-8
+# Minimum time for each autotune measurement, in seconds.
+_MIN_TIME = 1e-3
+
+
+def register(kernel, name, fn, available=None):
+    """
+    Add an implementation *fn* of *kernel* under the backend *name*.
+
+    *available* is a function returning False if the implementation
+    cannot be used on this host, such as when a required package is not
+    installed.  It is called when the backend is selected or tuned.
+    Registering an existing name replaces it.
+    """
+    if kernel not in _registry:
+        raise ValueError("unknown kernel %r" % kernel)
+    entries = _registry[kernel]
+    entries[:] = [entry for entry in entries if entry[0] != name]
+    entries.append((name, fn, available))
+
+
+def available(kernel):
+    """
+    Return the names of the backends for *kernel* which can be used on
+    this host, with the reference implementation first.
+    """
+    return [name for name, _, _ in _registry[kernel]
+            if _is_available(kernel, name)]
+
+
+def _is_available(kernel, name):
+    for entry_name, _, check in _registry[kernel]:
+        if entry_name == name:
+            return check is None or check()
+    return False
+
+
+def use_backend(name=None, kernel=None):
+    """
+    Select the backend for *kernel*, or for all kernels if *kernel* is None.
+
+    *name* is one of the registered backends, or 'auto' to use the
+    fastest for each model shape found by :func:`tune`.  If *name* is None
+    the environment variable REFL1D_BACKEND is used, or 'c' if it is not
+    set.  When selecting for all kernels, those without an implementation
+    called *name* use the C kernel.
+
+    The setting applies to the current process.  Raises ValueError if
+    the backend is not available.
+    """
+    if name is None:
+        name = os.environ.get(_BACKEND_KEY, '') or 'c'
+    kernels = KERNELS if kernel is None else [kernel]
+    usable = [k for k in kernels if name == 'auto' or _is_available(k, name)]
+    if not usable or (kernel is not None and kernel not in usable):
+        raise ValueError("backend %r is not available" % name)
+    for k in kernels:
+        _setting[k] = name if k in usable else 'c'
+    return name
+
+
+def get_backend(kernel):
+    """
+    Return the backend selected for *kernel*.
+    """
+    if not _setting:
+        use_backend()
+    return _setting[kernel]
+
+
+def use_backend_cache(path=None):
+    """
+    Set the directory for the per-host cache of autotuned backends.
+
+    If *path* is None, the directory given by the environment variable
+    REFL1D_BACKEND_CACHE is used, or ~/.refl1d if it is not set.  Use
+    *path=False* to keep the choices in memory only.
+
+    Returns the cache directory, or None if the choices are not saved.
+    """
+    if path is None:
+        path = (os.environ.get(_BACKEND_CACHE_KEY, '')
+                or os.path.join(os.path.expanduser('~'), '.refl1d'))
+    path = path if path else None
+    _cache_setting[:] = [path, _load_choices(path)]
+    return path
+
+
+def _choices():
+    if not _cache_setting:
+        use_backend_cache()
+    return _cache_setting[1]
+
+
+def _cache_file(path):
+    return os.path.join(path, 'backend-%s.json' % socket.gethostname())
+
+
+def _load_choices(path):
+    if path is None:
+        return {}
+    try:
+        with open(_cache_file(path)) as fid:
+            content = json.load(fid)
+    except (IOError, OSError, ValueError):
+        return {}
+    # Retune after upgrading since the kernels may have changed.
+    if not isinstance(content, dict) or content.get('refl1d') != __version__:
+        return {}
+    return content.get('choices', {})
+
+
+def _save_choices(path, choices):
+    try:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        # Keep the choices made by other processes since the cache was read.
+        merged = _load_choices(path)
+        merged.update(choices)
+        text = json.dumps({'refl1d': __version__, 'choices': merged},
+                          indent=2, sort_keys=True)
+        atomic_write(_cache_file(path), lambda fid: fid.write(asbytes(text)))
+    except (IOError, OSError):
+        # Read-only home directory; tune again in the next process.
+        pass
+
+
+def _shape_key(kernel, args):
+    if kernel == 'convolve':
+        n, m = len(args[0]), len(args[2])
+    else:
+        n, m = len(args[1]), len(args[0])
+    return "%s:%dx%d" % (kernel, _bucket(n), _bucket(m))
+
+
+def _bucket(n):
+    return 1 << int(round(np.log2(max(n, 1))))
+
+
+def select(kernel, args, native=False):
+    """
+    Return the name of the backend to use for *kernel* with arguments
+    *args*.
+
+    If the backend is 'auto', this is the choice recorded for the shape
+    of *args*, or the C kernel if the shape has not been tuned.  Shapes
+    are only tuned within :func:`tune`.  Use *native=True* if the caller
+    has an incremental or single precision calculation which only the C
+    kernel supports, so that 'auto' keeps the C kernel.
+    """
+    name = get_backend(kernel)
+    if name == 'auto':
+        reference = _registry[kernel][0][0]
+        if native:
+            return reference
+        name = _choices().get(_shape_key(kernel, args))
+        if name is None or not _is_available(kernel, name):
+            name = autotune(kernel, args) if _tuning[0] else reference
+    return name
+
+
+def tune(fn, *args, **kw):
+    """
+    Return *fn(\*args, \*\*kw)*, calling :func:`autotune` for each kernel
+    shape which it uses with the backend 'auto' and which has not been
+    tuned before.
+
+    This is the start up step for the backend 'auto'; call it with a
+    typical evaluation of each model before the fit.
+    """
+    previous, _tuning[0] = _tuning[0], True
+    try:
+        return fn(*args, **kw)
+    finally:
+        _tuning[0] = previous
+
+
+def evaluate(kernel, *args):
+    """
+    Evaluate *kernel* for *args* with the selected backend.
+    """
+    name = select(kernel, args)
+    for entry_name, fn, _ in _registry[kernel]:
+        if entry_name == name:
+            return fn(*args)
+    raise ValueError("backend %r is not registered for %s" % (name, kernel))
+
+
+def autotune(kernel, args, repeats=3):
+    """
+    Time each available backend for *kernel* with arguments *args*, and
+    keep the fastest for models of the same shape.
+
+    The result of each backend is checked against the first backend,
+    which is the C kernel, and backends which fail or disagree are
+    skipped.  Each backend is called once before timing so that compile
+    time for the numba kernels is not counted.  The timing is the best of
+    *repeats* measurements.
+
+    Returns the name of the fastest backend.
+    """
+    reference, times = None, {}
+    for name, fn, check in _registry[kernel]:
+        if check is not None and not check():
+            continue
+        try:
+            result = fn(*args)
+        except Exception:
+            # A backend which cannot handle these arguments is not a
+            # candidate; the reference backend is always tried first.
+            if reference is None:
+                raise
+            continue
+        if reference is None:
+            reference = result
+        elif not _agrees(result, reference):
+            continue
+        start = timer()
+        fn(*args)
+        number = max(1, int(_MIN_TIME/max(timer() - start, 1e-9)))
+        best = np.inf
+        for _ in range(repeats):
+            start = timer()
+            for _ in range(number):
+                fn(*args)
+            best = min(best, (timer() - start)/number)
+        times[name] = best
+    name = min(times, key=times.get)
+    _choices()[_shape_key(kernel, args)] = name
+    path = _cache_setting[0]
+    if path is not None:
+        _save_choices(path, {_shape_key(kernel, args): name})
+    return name
+
+
+def _agrees(result, reference):
+    result, reference = np.asarray(result), np.asarray(reference)
+    scale = np.max(abs(reference)) if reference.size else 0.
+    return (result.shape == reference.shape
+            and np.allclose(result, reference, rtol=_AGREEMENT,
+                            atol=_AGREEMENT*scale, equal_nan=True))
+
+
+# ---- C kernels ----
+
+def _c_amplitude(kz, depth, rho, irho, sigma, rho_index, shape):
+    from .reflectivity import _kernels
+
+    r = np.empty(kz.shape, 'D')
+    _kernels()._reflectivity_amplitude(depth, sigma, rho, irho, kz,
+                                       rho_index, r, shape)
+    return r
+
+
+def _c_magnetic(kz, depth, rho, irho, sigma, sld_b, u1, u3, Aguide,
+                rho_index):
+    from .reflectivity import _kernels
+
+    R1, R2, R3, R4 = [np.empty(kz.shape, 'D') for pol in (1, 2, 3, 4)]
+    _kernels()._magnetic_amplitude(depth, sigma, rho, irho,
+                                   sld_b, u1, u3, Aguide, kz, rho_index,
+                                   R1, R2, R3, R4)
+    return R1, R2, R3, R4
+
+
+def _c_convolve(xi, yi, x, dx):
+    from .reflectivity import _kernels
+
+    y = np.empty_like(x)
+    _kernels().convolve(xi, yi, x, dx, y)
+    return y
+
+
+# ---- numba kernels ----
+
+# Replaced by numba.prange when the kernels are compiled; see lazy_njit.
+prange = range
+
+_PI4 = 12.566370614359172e-6  # 1e-6 * 4 pi
+_KZ_CUTOFF = 1e-10
+# Gaussian resolution is truncated where G(x)/G(0) = 0.001
+_LOG_RESLIMIT = -6.90775527898213703123
+_SQRT2 = 1.41421356237309504880
+_SQRT2PI = 2.50662827463100050241
+
+
+def _numba_threads():
+    # Use the same number of threads as the OpenMP kernels.
+    import numba
+    from .reflectivity import _num_threads
+
+    # The default TBB layer hangs in process pools forked after it has
+    # started, which is how parallel fits run.
+    if 'NUMBA_THREADING_LAYER' not in os.environ:
+        numba.config.THREADING_LAYER = 'workqueue'
+    n = _num_threads()
+    numba.set_num_threads(n if n > 0 else numba.config.NUMBA_NUM_THREADS)
+
+
+def _numba_amplitude(kz, depth, rho, irho, sigma, rho_index, shape):
+    _numba_threads()
+    if shape is None:
+        shape = np.zeros(len(depth), 'i')
+    r = np.empty(kz.shape, 'D')
+    _numba_amplitude_kernel(kz, depth, rho.ravel(), irho.ravel(), sigma,
+                            rho_index, shape, Tanh.C, r)
+    return r
+
+
+@lazy_njit(parallel=True)
+def _numba_amplitude_kernel(kz, depth, rho, irho, sigma, rho_index, shape,
+                            tanh_c, r):
+    # Same calculation as refl_range in reflectivity.cc.
+    layers = len(depth)
+    for j in prange(len(kz)):
+        if abs(kz[j]) < _KZ_CUTOFF:
+            r[j] = -1.
+            continue
+        offset = layers*rho_index[j]
+        if kz[j] > 0.:
+            step, incident = 1, 0
+        else:
+            step, incident = -1, layers-1
+        kz_sq = kz[j]*kz[j] + _PI4*rho[offset+incident]
+        k = complex(abs(kz[j]), 0.)
+        B11, B12, B21, B22 = 1.+0j, 0j, 0j, 1.+0j
+        current = incident
+        for _ in range(layers-1):
+            following = current + step
+            interface = min(current, following)
+            k_next = np.sqrt(complex(kz_sq - _PI4*rho[offset+following],
+                                     -_PI4*irho[offset+following]))
+            s = sigma[interface]
+            if s == 0.:
+                factor = 1.+0j
+            elif shape[interface] == 1:  # TANH_INTERFACE
+                scale = np.pi*s/(2.*tanh_c)
+                a, b = scale*(k - k_next), scale*(k + k_next)
+                if abs(b) < 1e-8:
+                    factor = 1.+0j
+                else:
+                    denom = 1. - np.exp(-2.*b)
+                    if abs(a) < 1e-8:
+                        factor = 2.*b*np.exp(-b)/denom
+                    else:
+                        factor = (np.exp(a-b) - np.exp(-a-b))/denom*(b/a)
+            elif shape[interface] == 2:  # LINEAR_INTERFACE
+                x = np.sqrt(k*k_next)*s
+                factor = 1.+0j if abs(x) < 1e-8 else np.sin(x)/x
+            else:
+                factor = np.exp(-2.*k*k_next*s*s)
+            F = (k - k_next)/(k + k_next)*factor
+            if current != incident:
+                M11 = np.exp(1j*k*depth[current])
+                M22 = np.exp(-1j*k*depth[current])
+            else:
+                M11 = M22 = 1.+0j
+            M21, M12 = F*M11, F*M22
+            B11, B21 = B11*M11 + B21*M12, B11*M21 + B21*M22
+            B12, B22 = B12*M11 + B22*M12, B12*M21 + B22*M22
+            current = following
+            k = k_next
+        r[j] = B12/B11
+
+
+def _numba_convolve(xi, yi, x, dx):
+    _numba_threads()
+    y = np.empty_like(x)
+    _numba_convolve_kernel(xi, yi, x, dx, y)
+    return y
+
+
+@lazy_njit(parallel=True)
+def _numba_convolve_kernel(xin, yin, x, dx, y):
+    # Same calculation as convolve in convolve.c.
+    n = len(xin)
+    for out in prange(len(x)):
+        sigma, xo = dx[out], x[out]
+        limit = np.sqrt(-2.*sigma*sigma*_LOG_RESLIMIT)
+        # Start at the last point at or before the window, if any.
+        k = np.searchsorted(xin, xo - limit)
+        if k > n-1:
+            k = n-1
+        elif k > 0 and xin[k] > xo - limit:
+            k -= 1
+        if sigma > 0.:
+            two_sigma_sq = 2.*sigma*sigma
+            z = xo - xin[k]
+            Glo = np.exp(-z*z/two_sigma_sq)
+            erfmin = erflo = math.erf(-z/(_SQRT2*sigma))
+            total = 0.
+            k += 1
+            while k < n:
+                if xin[k] != xin[k-1]:
+                    zhi = xo - xin[k]
+                    Ghi = np.exp(-zhi*zhi/two_sigma_sq)
+                    erfhi = math.erf(-zhi/(_SQRT2*sigma))
+                    m = (yin[k]-yin[k-1])/(xin[k]-xin[k-1])
+                    b = yin[k] - m*xin[k]
+                    total += (0.5*(m*xo+b)*(erfhi-erflo)
+                              - sigma/_SQRT2PI*m*(Ghi-Glo))
+                    Glo, erflo = Ghi, erfhi
+                if xin[k] >= xo + limit:
+                    break
+                k += 1
+            y[out] = 2.*total/(erflo - erfmin)
+        else:
+            lo = k if k < n-1 else k-1
+            m = (yin[lo+1]-yin[lo])/(xin[lo+1]-xin[lo])
+            y[out] = yin[k] + m*(xo - xin[k])
+
+
+# ---- numpy kernels ----
+
+# Number of values in the per-layer arrays of each numpy batch.
+_NUMPY_BATCH = 1 << 16
+
+
+def _numpy_amplitude(kz, depth, rho, irho, sigma, rho_index, shape):
+    # abeles.refl builds arrays of one value per point for each layer, so
+    # the points are computed in batches.
+    layers = len(depth)
+    rho, irho = rho.reshape(-1, layers), irho.reshape(-1, layers)
+    # A single profile broadcasts against kz, so it isn't repeated.
+    single = len(rho) == 1
+    batch = _NUMPY_BATCH if single else max(_NUMPY_BATCH//layers, 64)
+    r = np.empty(kz.shape, 'D')
+    with np.errstate(all='ignore'):
+        for start in range(0, len(kz), batch):
+            part = slice(start, start+batch)
+            r[part] = abeles.refl(kz[part], depth, rho, irho,
+                                  sigma[:layers-1],
+                                  None if single else rho_index[part],
+                                  shape)
+    return r
+
+
+def _numpy_convolve(xi, yi, x, dx):
+    from scipy.special import erf
+
+    n = len(xi)
+    limit = np.sqrt(-2.*dx**2*_LOG_RESLIMIT)
+    # Window [lo, hi] for each point, as in the C kernel.
+    lo = np.minimum(np.searchsorted(xi, x - limit), n-1)
+    lo -= (lo > 0) & (xi[lo] > x - limit)
+    hi = np.maximum(np.searchsorted(xi, x + limit), lo + 1)
+    hi = np.minimum(hi, n-1)
+    width = hi - lo
+    steps = np.arange(width.max() + 1)
+    batch = max(_NUMPY_BATCH//len(steps), 1)
+    y = np.empty_like(x)
+    for start in range(0, len(x), batch):
+        part = slice(start, start+batch)
+        index = np.minimum(lo[part, None] + steps, n-1)
+        xk, yk = xi[index], yi[index]
+        xo, sigma = x[part, None], dx[part, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z = xo - xk
+            G = np.exp(-z*z/(2.*sigma*sigma))
+            E = erf(-z/(_SQRT2*sigma))
+            run = np.diff(xk, axis=1)
+            valid = (steps[1:] <= width[part, None]) & (run != 0.)
+            m = np.where(valid, np.diff(yk, axis=1)/run, 0.)
+            b = yk[:, 1:] - m*xk[:, 1:]
+            area = (0.5*(m*xo + b)*np.diff(E, axis=1)
+                    - sigma/_SQRT2PI*m*np.diff(G, axis=1))
+            total = np.where(valid, area, 0.).sum(axis=1)
+            norm = E[np.arange(len(xk)), width[part]] - E[:, 0]
+            y[part] = 2.*total/norm
+    # Linear interpolation for points without resolution.
+    zero = ~(dx > 0.)
+    if zero.any():
+        k = lo[zero]
+        seg = np.where(k < n-1, k, k-1)
+        m = (yi[seg+1] - yi[seg])/(xi[seg+1] - xi[seg])
+        y[zero] = yi[k] + m*(x[zero] - xi[k])
+    return y
+
+
+register('amplitude', 'c', _c_amplitude)
+register('amplitude', 'numba', _numba_amplitude, numba_available)
+register('amplitude', 'numpy', _numpy_amplitude)
+register('magnetic', 'c', _c_magnetic)
+register('convolve', 'c', _c_convolve)
+register('convolve', 'numba', _numba_convolve, numba_available)
+register('convolve', 'numpy', _numpy_convolve)
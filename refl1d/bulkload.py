@@ -0,0 +1,211 @@
+# This program is public domain
+"""
+Concurrent loading of many reduced data files.
+
+Kinetics and other series measurements produce hundreds of short runs.
+:func:`load_many` loads them with a pool of worker processes and returns
+the probes in a fixed order, independent of the order in which the loads
+complete::
+
+    from refl1d.bulkload import load_many
+    probes = load_many('kinetics/run*.refl', format='ncnr',
+                       Tlo=0.5, slits_at_Tlo=0.2)
+
+The file format is determined from the first block of each file, as
+outlined in :mod:`refl1d.instrument`:
+
+    =============  ==========================================  ==================
+    format         signature                                   loader
+    =============  ==========================================  ==================
+    ncnr           first line starts with #RRF                 NCNR.load
+    ncnr_magnetic  #RRF with extension .reflA, .reflB, ...     NCNR.load_magnetic
+    sns            first line starts with #F                   SNS.load
+    ansto          column names without #, or PLP data file    ANSTO.load
+    load4          '# key: value' header, or bare columns      load4
+    =============  ==========================================  ==================
+
+The cross sections of NCNR polarized data (.reflA to .reflD) are grouped
+and loaded as one :class:`PolarizedNeutronProbe <refl1d.probe.PolarizedNeutronProbe>`,
+which takes the place of the first cross section in the returned list.
+"""
+from __future__ import division, print_function
+
+__all__ = ["load_many", "sniff", "FORMATS"]
+
+import os
+import re
+import glob
+from functools import partial
+
+from . import ncnrdata, snsdata, anstodata
+from .probe import load4
+
+# Number of bytes read when checking the file signature.
+_BLOCK = 4096
+
+_MAGNETIC_EXT = re.compile(r'\.refl[a-d]$', re.IGNORECASE)
+
+
+def _load_ncnr(filename, instrument=None, **kw):
+    if instrument is not None:
+        return instrument.load(filename, **kw)
+    return ncnrdata.load(filename, **kw)
+
+def _load_ncnr_magnetic(filename, instrument=None, **kw):
+    if instrument is not None:
+        return instrument.load_magnetic(filename, **kw)
+    return ncnrdata.load_magnetic(filename, **kw)
+
+def _load_sns(filename, instrument=None, **kw):
+    if instrument is None:
+        # guess the instrument from the original file name, as is done
+        # by parse_sns_file
+        with open(filename) as fid:
+            original_file = fid.readline()
+        if 'REF_L' in original_file:
+            instrument = snsdata.Liquids()
+        elif 'REF_M' in original_file:
+            instrument = snsdata.Magnetic()
+    return snsdata.load(filename, instrument=instrument, **kw)
+
+def _load_ansto(filename, instrument=None, **kw):
+    return anstodata.load(filename, instrument=instrument, **kw)
+
+def _load_load4(filename, instrument=None, **kw):
+    return load4(filename, **kw)
+
+#: Loaders for each of the formats recognized by :func:`sniff`.
+FORMATS = {
+    'ncnr': _load_ncnr,
+    'ncnr_magnetic': _load_ncnr_magnetic,
+    'sns': _load_sns,
+    'ansto': _load_ansto,
+    'load4': _load_load4,
+}
+
+
+def sniff(filename):
+    """
+    Return the name of the format of *filename* from :data:`FORMATS`.
+
+    Raises IOError if the file cannot be read or the format is unknown.
+    """
+    with open(filename, 'rb') as fid:
+        block = fid.read(_BLOCK).decode('latin1')
+    lines = [line.strip() for line in block.splitlines() if line.strip()]
+    if not lines:
+        raise IOError("Empty data file %r" % filename)
+    first = lines[0]
+    if first.startswith('#RRF'):
+        if _MAGNETIC_EXT.search(filename):
+            return 'ncnr_magnetic'
+        return 'ncnr'
+    if first.startswith('#F '):
+        return 'sns'
+    if not first.startswith('#'):
+        if not _is_numeric(first) or re.search(r'PLP\d+', filename):
+            return 'ansto'
+        return 'load4'
+    header = [line for line in lines if line.startswith('#')]
+    if all(':' in line or _is_numeric(line[1:]) for line in header):
+        return 'load4'
+    raise IOError("Unknown data format in %r" % filename)
+
+def _is_numeric(line):
+    try:
+        [float(v) for v in re.split(r'[\s,]+', line.strip())]
+    except ValueError:
+        return False
+    return True
+
+
+def load_many(files, format=None, instrument=None, workers=None,
+              processes=True, options=None, **kw):
+    """
+    Load many data files concurrently.
+
+    *files* is a glob pattern, or a list of file names and glob patterns.
+    Patterns are expanded in sorted order.  Entries can also be
+    *(filename, options)* pairs, with *options* a dictionary of keyword
+    arguments for that file which override the format options.
+
+    *format* is one of the names in :data:`FORMATS`, or None to check each
+    file with :func:`sniff`.  If an *instrument* such as *NCNR.NG1(...)* is
+    given, its *load* or *load_magnetic* method is used.
+
+    *options* maps format names to dictionaries of keyword arguments for
+    the loader of that format, such as *{'ncnr': {'Tlo': 0.5}}*, since the
+    loaders accept different arguments.  Other keyword arguments are
+    passed to the loader when a single *format* is given, and raise
+    TypeError otherwise.
+
+    *workers* is the number of concurrent loads, which defaults to the
+    number of CPUs.  With *processes=False* a thread pool is used instead
+    of a process pool.  Threads avoid the cost of sending the probes back
+    to the parent, but the text parsers hold the python interpreter lock.
+
+    Returns the list of probes in the order of *files*.  Polarized cross
+    sections are loaded together as a single probe.
+    """
+    options = dict((fmt, dict(v)) for fmt, v in (options or {}).items())
+    unknown = set(options) - set(FORMATS)
+    if unknown:
+        raise ValueError("unknown formats %s in options" % sorted(unknown))
+    if kw:
+        if format is None:
+            raise TypeError("use options={format: {...}} for loader arguments"
+                            " when the format is detected from each file")
+        options.setdefault(format, {}).update(kw)
+    jobs = _jobs(files, format)
+    if workers is None:
+        workers = _cpu_count()
+    workers = min(workers, len(jobs))
+    task = partial(_run, instrument=instrument, options=options)
+    if workers <= 1:
+        return [task(job) for job in jobs]
+    if processes:
+        from multiprocessing import Pool
+    else:
+        from multiprocessing.pool import ThreadPool as Pool
+    pool = Pool(workers)
+    try:
+        # map returns results in the order of jobs
+        return pool.map(task, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def _jobs(files, format):
+    if not isinstance(files, (list, tuple)):
+        files = [files]
+    entries = []
+    for entry in files:
+        filename, options = (entry if isinstance(entry, (list, tuple))
+                             else (entry, {}))
+        matches = (sorted(glob.glob(filename)) if glob.has_magic(filename)
+                   else [filename])
+        entries.extend((name, options) for name in matches)
+    jobs, seen = [], set()
+    for filename, options in entries:
+        fmt = format if format is not None else sniff(filename)
+        if fmt == 'ncnr_magnetic' and _MAGNETIC_EXT.search(filename):
+            # load the cross sections together, in place of the first one
+            filename = filename[:-1]
+            if filename in seen:
+                continue
+            seen.add(filename)
+        jobs.append((fmt, filename, options))
+    return jobs
+
+def _run(job, instrument, options):
+    fmt, filename, file_options = job
+    kw = dict(options.get(fmt, {}))
+    kw.update(file_options)
+    return FORMATS[fmt](filename, instrument=instrument, **kw)
+
+def _cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        import multiprocessing
+        return multiprocessing.cpu_count()
@@ -76,6 +76,8 @@ the bounds.  Bounds on the oscillation are easier to control using
 # - Newton methods: Hessian should point back to domain
 # - Direct methods: random walk should be biased toward the domain
 # - moderately complicated
+from collections import OrderedDict
+
 import numpy as np
 from numpy import inf, real, imag
 from bumps.parameter import  Parameter as Par, to_dict
@@ -133,10 +135,16 @@ class FreeformCheby(Layer):
     def render(self, probe, slabs):
         """Render slabs for use with the given probe"""
         thickness = self.thickness.value
-        Pw, Pz = slabs.microslabs(thickness)
-        t = Pz/thickness
-        Prho = _profile([p.value for p in self.rho], t, self.method)
-        Pirho = _profile([p.value for p in self.irho], t, self.method)
+        rho = [p.value for p in self.rho]
+        irho = [p.value for p in self.irho]
+        def profile(z):
+            t = z/thickness
+            if len(rho) == len(irho):
+                # evaluate rho and irho with a single matrix product
+                return _profile(np.array([rho, irho]).T, t, self.method).T
+            return (_profile(rho, t, self.method),
+                    _profile(irho, t, self.method))
+        Pw, _, (Prho, Pirho) = slabs.adaptive_microslabs(thickness, profile)
         slabs.extend(rho=[Prho], irho=[Pirho], w=Pw)
 
 class ChebyVF(Layer):
@@ -220,10 +228,9 @@ class ChebyVF(Layer):
             pass
 
         thickness = self.thickness.value
-        Pw, Pz = slabs.microslabs(thickness)
-        t = Pz/thickness
-        vf = _profile([p.value for p in self.vf], t, self.method)
-        vf = np.clip(vf, 0, 1)
+        c = [p.value for p in self.vf]
+        profile = lambda z: np.clip(_profile(c, z/thickness, self.method), 0, 1)
+        Pw, _, vf = slabs.adaptive_microslabs(thickness, profile)
         Pw, vf = util.merge_ends(Pw, vf, tol=1e-3)
         P = M*vf + S*(1-vf)
         Pr, Pi = real(P), imag(P)
@@ -239,7 +246,46 @@ def _profile(c, t, method):
     If method is 'interp' then $c_i$ are the values of the interpolated
     function $f$ evaluated at the chebyshev points returned by
     :func:`cheby_points`.
+
+    If c is a matrix, then each column is a separate profile, and the
+    result has one column for each profile.
+    """
+    c = np.asarray(c, 'd')
+    return np.dot(_cheby_matrix(len(c), t, method), c)
+
+_CHEBY_MATRIX_CACHE = OrderedDict()
+
+def _cheby_matrix(n, t, method, cache=_CHEBY_MATRIX_CACHE):
     """
-    if method == 'interp':
-        c = cheby_coeff(c)
-    return cheby_val(c, t)
+    Return the matrix mapping the n chebyshev coefficients or control point
+    values to the profile at points t.
+
+    The matrix only depends on the grid and the polynomial order, so it is
+    cached for reuse in the next render with the same layer thickness.
+    """
+    t = np.asarray(t, 'd')
+    key = n, method, t.tobytes()
+    if key in cache:
+        cache[key] = matrix = cache.pop(key)
+        return matrix
+
+    # Columns are T_k(2t-1), with c_0 weighted by 1/2 as in cheby_val
+    x = 2*t - 1
+    matrix = np.empty((len(t), n))
+    if n > 0:
+        matrix[:, 0] = 1.
+    if n > 1:
+        matrix[:, 1] = x
+    for k in range(2, n):
+        matrix[:, k] = 2*x*matrix[:, k-1] - matrix[:, k-2]
+    if n > 0:
+        matrix[:, 0] = 0.5
+    if method == 'interp' and n > 0:
+        # cheby_coeff is linear in the control point values
+        coeff = np.array([cheby_coeff(point) for point in np.eye(n)]).T
+        matrix = np.dot(matrix, coeff)
+
+    cache[key] = matrix
+    while len(cache) > 32:
+        cache.popitem(last=False)
+    return matrix
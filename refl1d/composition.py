@@ -3,7 +3,7 @@
 """
 Composition space modeling
 
-INCOMPLETE UNUSED UNTESTED CODE
+INCOMPLETE CODE
 
 
 """
@@ -32,6 +32,8 @@ class CompositionSpace(Layer):
         self.name = name
         self.thickness = Par.default(thickness, limits=(0, inf),
                                      name=name+" thickness")
+        self._grid = None
+        self._fractions = None
 
     def parameters(self):
         return {
@@ -60,52 +62,97 @@ class CompositionSpace(Layer):
     def __setitem__(self, n, part):
         self.parts[n] = part
 
+    # Indexing gives parts, not layers, so Stack must not iterate over them
+    __iter__ = None
+
     def plot_volume_fraction(self, slabs, ax):
         """
         Composition space items have a plotting routine for showing the
         volume profile.
         """
-        # Uniform stepping
-        z = np.arange(slabs.dz/2, self.thickness.value, slabs.dz)
-
-        # Storage for the sub-totals
-        volume_total = np.zeros_like(z)
+        _, z = self._microslabs(slabs)
+        f = self._volume_fractions(z)
 
         # Accumulate the parts
-        for p in self.parts:
-            f = p.profile(z)
-            ax.plot(z, f, label=p.name)
-            volume_total += f
+        for p, fp in zip(self.parts, f):
+            ax.plot(z, fp, label=p.material.name)
 
         # Remainder is solvent
-        ax.plot(z, 1-volume_total, label=self.solvent.name)
+        ax.plot(z, 1-np.clip(np.sum(f, axis=0), 0, 1), label=self.solvent.name)
 
     # Render a profile
     def render(self, probe, slabs):
-        # Uniform stepping
-        z = np.arange(slabs.dz/2, self.thickness.value, slabs.dz)
+        w, z = self._microslabs(slabs)
+        if len(w) == 0:
+            return
 
-        # Storage for the sub-totals
-        n, k = len(z), slabs.nprobe
-        rho_total = np.zeros((n, k))
-        mu_total = np.zeros((n, k))
-        volume_total = np.zeros_like(z)
+        # Volume fraction profile for each part, one part per row
+        f = self._volume_fractions(z)
 
-        # Accumulate the parts
-        for p in self.parts:
-            f, rho, mu = p.f_sld(probe, z)
-            rho_total += rho
-            mu_total += mu
-            volume_total += f
+        # Scattering contribution for the parts
+        sld = [_scalar_sld(p.material, probe) for p in self.parts]
+        M = np.array(sld, dtype='D').reshape(-1)
+        P = np.dot(M, f) if len(M) else np.zeros(len(z), dtype='D')
 
         # Remainder is solvent
-        rho, mu = probe.sld(self.solvent)
-        rho_total += rho*(1-volume_total)
-        mu_total += mu*(1-volume_total)
+        volume_total = np.sum(f, axis=0)
+        np.clip(volume_total, 0, 1, out=volume_total)
+        np.subtract(1, volume_total, out=volume_total)
+        P += _scalar_sld(self.solvent, probe)*volume_total
 
         # Add to model
-        w = slabs.dz * np.ones(z.shape)
-        slabs.extend(w=w, rho=rho_total, mu=mu_total)
+        slabs.extend(w=w, rho=[P.real], irho=[P.imag])
+
+    def _microslabs(self, slabs):
+        """
+        Return the cached microslab widths and centers for the layer.
+        """
+        key = self.thickness.value, slabs.dz
+        if self._grid is None or self._grid[0] != key:
+            self._grid = key, slabs.microslabs(self.thickness.value)
+        return self._grid[1]
+
+    def _volume_fractions(self, z):
+        """
+        Return the volume fraction profile of each part on the grid z.
+
+        Profiles are cached, and only the parts whose parameters have
+        changed since the last call are recomputed.  Changed parts with
+        a :class:`Gaussian` profile are evaluated together.
+        """
+        parts = list(self.parts)
+        keys = [(p, p.key()) for p in parts]
+        if (self._fractions is None or self._fractions[0] is not z
+                or len(keys) != len(self._fractions[1])):
+            f = np.empty((len(keys), len(z)))
+            changed = list(range(len(keys)))
+        else:
+            _, cached_keys, f = self._fractions
+            changed = [k for k, (p, key) in enumerate(keys)
+                       if p is not cached_keys[k][0] or key != cached_keys[k][1]]
+        gauss = [k for k in changed if isinstance(parts[k].profile, Gaussian)]
+        if gauss:
+            pars = np.array([(parts[k].fraction.value,
+                              parts[k].profile.center.value,
+                              parts[k].profile.width.value,
+                              parts[k].profile.stretch.value)
+                             for k in gauss]).T[:, :, None]
+            f[gauss] = pars[0]*stretched_gaussian(z, *pars[1:])
+        for k in changed:
+            if k not in gauss:
+                f[k] = parts[k].f(z)
+        self._fractions = z, keys, f
+        return f
+
+
+def _scalar_sld(material, probe):
+    rho, irho = material.sld(probe)
+    try:
+        rho, irho = rho[0], irho[0]  # Temporary hack
+    except Exception:
+        pass
+    return rho + 1j*irho
+
 
 class Part(object):
     def __init__(self, material, profile, fraction=1):
@@ -129,13 +176,35 @@ class Part(object):
             'fraction': self.fraction,
         })
 
+    def f(self, z):
+        """
+        Volume fraction profile of the part.
+        """
+        return self.fraction.value*self.profile(z)
+
+    def key(self):
+        """
+        Parameter values which determine the volume fraction profile.
+        """
+        return (self.fraction.value,) + tuple(
+            p.value for p in _parameter_list(self.profile.parameters()))
+
     def f_sld(self, probe, z):
         # Note: combining f and sld because there my be some
         # composites such as oriented proteins for which the
         # sld and volume change at the same time.
-        rho, mu = probe.sld(self.material)
-        f = self.fraction.value*self.profile(z)
-        return f, rho*f, mu*f
+        rho, irho = self.material.sld(probe)
+        f = self.f(z)
+        return f, rho*f, irho*f
+
+
+def _parameter_list(pars):
+    if isinstance(pars, dict):
+        return [p for k in sorted(pars) for p in _parameter_list(pars[k])]
+    elif isinstance(pars, (list, tuple)):
+        return [p for v in pars for p in _parameter_list(v)]
+    else:
+        return [pars]
 
 
 class Gaussian(object):
@@ -175,11 +244,20 @@ class Gaussian(object):
         return ret
 
     def __call__(self, z):
-        mu, sigma, w = self.center.value, self.stretch.value, self.width.value/2
-        if w <= 0:
-            result = exp(-0.5*((z-mu)/sigma)**2)
-        else:
-            result = np.ones_like(z)
-            idx = abs(z-mu) < w
-            result[idx] = exp(-0.5*((abs(z[idx]-mu)-w)/sigma)**2)
-        return result
+        return stretched_gaussian(z, self.center.value, self.width.value,
+                                  self.stretch.value)
+
+
+def stretched_gaussian(z, center, width, sigma):
+    """
+    Evaluate the :class:`Gaussian` profile at z.
+
+    The parameters can be arrays which broadcast against z, for example
+    column vectors to evaluate a set of profiles at once.
+    """
+    distance = abs(z - center) - width/2
+    np.maximum(distance, 0, out=distance)
+    distance /= sigma
+    distance **= 2
+    distance *= -0.5
+    return exp(distance, out=distance)
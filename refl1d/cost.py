@@ -0,0 +1,419 @@
+# This program is in the public domain
+# Author: Paul Kienzle
+"""
+Evaluation cost estimates.
+
+Before starting a long fit it is worth checking how much work each
+theory evaluation does and whether the model is being computed more
+accurately than the data can support.  The cost of an evaluation is
+dominated by the kernel, which runs once per slab per calculation point,
+so thin microslabs (small *dz*), loose contraction (small *dA*), step
+interfaces and heavy oversampling all multiply the run time.
+
+Use :func:`evaluation_cost` to time the individual stages of a single
+evaluation, :func:`fit_time` to extrapolate that to a complete fit, and
+:func:`recommend` to try cheaper settings, keeping only those which leave
+the theory within *tolerance* of the current theory.  The :func:`report`
+function combines all three.
+
+Example
+-------
+
+    >>> from refl1d.names import *
+    >>> from refl1d.cost import evaluation_cost, fit_time
+    >>> probe = NeutronProbe(T=np.linspace(0.1, 5, 200), L=4.75)
+    >>> sample = silicon(0, 5) | gold(100, 5) | air
+    >>> M = Experiment(sample=sample, probe=probe)
+    >>> cost = evaluation_cost(M)
+    >>> print(cost.slabs, cost.calc_points)
+    3 200
+    >>> fit_time(cost, fitter='de', nfree=4, steps=100) > 0
+    True
+"""
+from __future__ import division, print_function
+
+__all__ = ['EvaluationCost', 'Recommendation', 'evaluation_cost', 'fit_time',
+           'recommend', 'report', 'theory_deviation']
+
+from timeit import default_timer as timer
+
+import numpy as np
+from bumps import parameter
+
+# Attributes holding the calculation points for a probe.  These are saved
+# and restored around oversampling trials.
+_CALC_ATTRS = ('calc_T', 'calc_L', 'calc_Qo', 'unique_L', '_L_idx')
+
+# Number of function evaluations for the bumps fitters, given the number
+# of fitted parameters *n* and the fitter options.  These are the upper
+# bounds implied by the stopping conditions; local optimizers will often
+# converge sooner.
+_FITTERS = {
+    'amoeba': (lambda n, steps=1000, starts=1, **kw:
+               2*steps*max(starts, 1)),
+    'de': (lambda n, steps=1000, pop=10, **kw:
+           steps*pop*n),
+    'dream': (lambda n, samples=10000, burn=100, pop=10, **kw:
+              burn*pop*n + samples),
+    'lm': (lambda n, steps=200, **kw:
+           steps*(n+1)),
+    'newton': (lambda n, steps=3000, starts=1, **kw:
+               steps*(n+1)*max(starts, 1)),
+    'pt': (lambda n, steps=400, burn=100, nT=24, **kw:
+           (steps+burn)*nT),
+}
+
+
+class EvaluationCost(object):
+    r"""
+    Cost of a single theory evaluation.
+
+    *slabs* is the number of slabs passed to the kernel after contraction.
+
+    *calc_points* is the number of $Q$ points at which the theory is
+    computed, including oversampling.
+
+    *data_points* is the number of measured points.
+
+    *render*, *kernel* and *beam* are the times in seconds for building
+    the slab profile, computing the reflectivity amplitude and applying
+    resolution, intensity and background.  *total* is the time for the
+    complete nllf calculation, which for simple models fuses the kernel
+    and the beam so it may be less than the sum of the stages.
+    """
+    def __init__(self, slabs=0, calc_points=0, data_points=0,
+                 render=0., kernel=0., beam=0., total=0.):
+        self.slabs = slabs
+        self.calc_points = calc_points
+        self.data_points = data_points
+        self.render = render
+        self.kernel = kernel
+        self.beam = beam
+        self.total = total
+
+    @property
+    def work(self):
+        """Kernel work units (slabs x calculation points)."""
+        return self.slabs*self.calc_points
+
+    def __str__(self):
+        return ("%d slabs x %d points (%d measured): "
+                "render %s, kernel %s, beam %s, total %s"
+                % (self.slabs, self.calc_points, self.data_points,
+                   _format_time(self.render), _format_time(self.kernel),
+                   _format_time(self.beam), _format_time(self.total)))
+
+
+class Recommendation(object):
+    """
+    Cheaper setting for an experiment.
+
+    *name* is the setting, such as 'dA', 'dz', 'step_interfaces',
+    'oversample' or 'subsample', and *value* is the suggested value.
+
+    *speedup* is the ratio of the current evaluation time to the time
+    with the suggested setting.
+
+    *deviation* is the largest change in the theory, in units of the
+    data uncertainty if data is available or relative to the theory
+    otherwise.
+
+    *action* is a python statement which applies the setting.
+    """
+    def __init__(self, name, value, speedup, deviation, action):
+        self.name = name
+        self.value = value
+        self.speedup = speedup
+        self.deviation = deviation
+        self.action = action
+
+    def __str__(self):
+        return ("%s  # %.1fx faster, max deviation %.3g"
+                % (self.action, self.speedup, self.deviation))
+
+
+def evaluation_cost(experiment, repeats=3):
+    """
+    Measure the cost of a theory evaluation for *experiment*.
+
+    Each of the *repeats* evaluations starts from a model reset, with the
+    saved kernel products and cached theory discarded so that every
+    repeat does the full work of an evaluation after a parameter change.
+    The stages are timed separately through the staged calculation, and
+    the total is the time for *nllf()* alone, which may combine the
+    stages.  The fastest time for each is kept.  Returns an
+    :class:`EvaluationCost`.
+    """
+    render = kernel = beam = total = np.inf
+    for _ in range(max(repeats, 1)):
+        _reset(experiment)
+        t0 = timer()
+        if hasattr(experiment, '_render_slabs'):
+            experiment._render_slabs()
+        t1 = timer()
+        experiment._reflamp()
+        t2 = timer()
+        experiment.reflectivity()
+        t3 = timer()
+        _reset(experiment)
+        t4 = timer()
+        experiment.nllf()
+        t5 = timer()
+        render = min(render, t1-t0)
+        kernel = min(kernel, t2-t1)
+        beam = min(beam, t3-t2)
+        total = min(total, t5-t4)
+    slabs = (len(experiment._slabs) if hasattr(experiment, '_slabs')
+             else sum(len(p._slabs) for p in getattr(experiment, 'parts', [])))
+    return EvaluationCost(
+        slabs=slabs,
+        calc_points=len(experiment.probe.calc_Q),
+        data_points=experiment.numpoints(),
+        render=render, kernel=kernel, beam=beam, total=total)
+
+
+def _reset(experiment):
+    """
+    Reset *experiment* so that the next evaluation starts from scratch,
+    without the kernel products saved from the previous evaluation or
+    theory restored from the theory cache.
+    """
+    experiment.update()
+    for M in [experiment] + list(getattr(experiment, 'parts', [])):
+        M._cache = {}
+        for saved in ('_incremental', '_aligned'):
+            if getattr(M, saved, None) is not None:
+                getattr(M, saved).reset()
+
+
+def fit_time(cost, fitter='dream', nfree=None, parallel=1, **options):
+    """
+    Predict the wall time in seconds for a fit.
+
+    *cost* is an :class:`EvaluationCost` or the time for one evaluation.
+
+    *fitter* is one of the bumps fitter ids 'amoeba', 'de', 'dream', 'lm',
+    'newton' or 'pt', with *options* such as *steps*, *samples*, *burn*
+    and *pop* given as for the bumps command line.  Defaults match the
+    bumps defaults.
+
+    *nfree* is the number of fitted parameters.
+
+    *parallel* is the number of worker processes evaluating the
+    population.  Only population based fitters (de, dream, pt) benefit.
+
+    The estimate is an upper bound based on the stopping conditions, and
+    excludes uncertainty analysis after the fit.
+    """
+    if fitter not in _FITTERS:
+        raise ValueError("unknown fitter %r; use one of %s"
+                         % (fitter, ", ".join(sorted(_FITTERS))))
+    if nfree is None:
+        raise TypeError("need the number of fitted parameters nfree")
+    per_eval = cost.total if isinstance(cost, EvaluationCost) else cost
+    evaluations = _FITTERS[fitter](nfree, **options)
+    if fitter in ('de', 'dream', 'pt'):
+        evaluations /= max(parallel, 1)
+    return evaluations*per_eval
+
+
+def theory_deviation(probe, reference, theory, relative=False):
+    r"""
+    Return the largest difference between two theory curves.
+
+    *reference* and *theory* are the result of *experiment.reflectivity()*
+    for *probe*.  The difference is measured in units of the data
+    uncertainty $\Delta R$ where data is available, or relative to the
+    reference reflectivity otherwise.  Use *relative=True* to always
+    measure relative to the reference reflectivity.
+    """
+    if probe.polarized:
+        parts = [(xs, ref, th)
+                 for xs, ref, th in zip(probe.xs, reference, theory)
+                 if xs is not None]
+    else:
+        parts = [(probe, reference, theory)]
+    worst = 0.
+    for data, (_, Rref), (_, Rth) in parts:
+        delta = abs(np.asarray(Rth) - np.asarray(Rref))
+        if data.dR is not None and not relative:
+            scale = np.asarray(data.dR)
+        else:
+            scale = abs(np.asarray(Rref))
+        scale = np.where(scale > 0, scale, np.finfo('d').tiny)
+        worst = max(worst, np.max(delta/scale))
+    return worst
+
+
+def recommend(experiment, tolerance=0.1, repeats=3):
+    r"""
+    Suggest cheaper settings for *experiment*.
+
+    Settings tried include larger contraction *dA*, larger microslab *dz*,
+    Nevot-Croce interfaces instead of step interfaces, single precision,
+    less oversampling and subsampling densely measured data.  Each is compared to the
+    current theory using :func:`theory_deviation`, and kept if the
+    deviation is below *tolerance* (default 0.1 $\Delta R$).  For the
+    numeric settings the cheapest acceptable value is reported.
+
+    The experiment is restored to its original settings on return.
+
+    Returns a list of :class:`Recommendation`, fastest first.
+    """
+    experiment.update()
+    reference = experiment.reflectivity()
+    base = evaluation_cost(experiment, repeats=repeats).total
+    found = []
+
+    def trial(name, value, action, apply, restore):
+        apply()
+        try:
+            experiment.update()
+            deviation = theory_deviation(experiment.probe, reference,
+                                         experiment.reflectivity())
+            if deviation > tolerance:
+                return False
+            cost = evaluation_cost(experiment, repeats=repeats).total
+            found.append(Recommendation(name, value, base/cost,
+                                        deviation, action))
+            return True
+        finally:
+            restore()
+            experiment.update()
+
+    # Contraction tolerance; pick the largest acceptable dA.
+    if getattr(experiment, 'dA', 'auto') != 'auto':
+        dA = experiment.dA
+        def set_dA(v):
+            experiment.dA = v
+        for v in reversed([v for v in (0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10)
+                           if dA is None or v > dA]):
+            if trial('dA', v, "Experiment(..., dA=%g)"%v,
+                     lambda: set_dA(v), lambda: set_dA(dA)):
+                break
+
+    # Microslab size; pick the largest acceptable dz.
+    if hasattr(experiment, 'dz'):
+        dz = experiment.dz
+        def set_dz(v):
+            experiment.dz = experiment._slabs.dz = v
+        for scale in (10, 5, 2):
+            v = dz*scale
+            if trial('dz', v, "Experiment(..., dz=%g)"%v,
+                     lambda: set_dz(v), lambda: set_dz(dz)):
+                break
+
+    # Nevot-Croce interfaces rather than step interfaces.
+    if getattr(experiment, 'step_interfaces', False):
+        def set_step(v):
+            experiment.step_interfaces = v
+        trial('step_interfaces', False,
+              "Experiment(..., step_interfaces=False)",
+              lambda: set_step(False), lambda: set_step(True))
+
+    # Single precision away from the critical edge.
+    if getattr(experiment, 'precision', None) == 'double':
+        def set_precision(v):
+            experiment.precision = v
+        trial('precision', 'single', "Experiment(..., precision='single')",
+              lambda: set_precision('single'),
+              lambda: set_precision('double'))
+
+    # Oversampling; pick the smallest acceptable number of points.
+    probe = experiment.probe
+    n_data = experiment.numpoints()
+    if n_data > 0 and hasattr(probe, 'oversample'):
+        current = len(probe.calc_Q)/n_data
+        saved = _save_calc(probe)
+        for n in (5, 10, 20, 50):
+            if n >= current:
+                break
+            if trial('oversample', n, "probe.oversample(n=%d)"%n,
+                     lambda: probe.oversample(n=n),
+                     lambda: _restore_calc(probe, saved)):
+                break
+
+    # Subsampling densely measured data.
+    if not probe.polarized and not hasattr(probe, 'probes'):
+        rec = _subsample(experiment, reference, base, tolerance)
+        if rec is not None:
+            found.append(rec)
+
+    found.sort(key=lambda rec: -rec.speedup)
+    return found
+
+
+def report(experiment, fitter='dream', tolerance=0.1, parallel=1,
+           **options):
+    """
+    Print the evaluation cost, the predicted fit time and any cheaper
+    settings for *experiment*.  See :func:`fit_time` for *fitter*,
+    *parallel* and *options*, and :func:`recommend` for *tolerance*.
+    """
+    cost = evaluation_cost(experiment)
+    pars = parameter.unique(experiment.parameters())
+    nfree = len(parameter.varying(pars))
+    print("evaluation:", cost)
+    if nfree > 0:
+        seconds = fit_time(cost, fitter=fitter, nfree=nfree,
+                           parallel=parallel, **options)
+        print("predicted %s fit with %d parameters: %s"
+              % (fitter, nfree, _format_time(seconds)))
+    for rec in recommend(experiment, tolerance=tolerance):
+        print("suggest", rec)
+
+
+def _subsample(experiment, reference, base, tolerance):
+    """
+    Check if the data can be thinned to one point every half resolution
+    width without changing the shape of the theory curve.
+    """
+    probe = experiment.probe
+    if getattr(probe, 'R', None) is None or len(probe.Q) < 10:
+        return None
+    dQ = 0.5*np.median(probe.dQ)
+    if not dQ > 0 or np.median(np.diff(probe.Qo)) >= dQ:
+        return None
+    Q = np.arange(probe.Qo[0], probe.Qo[-1], dQ)
+    idx = np.unique(np.searchsorted(probe.Qo, Q))
+    idx = idx[idx < len(probe.Qo)]
+    Qref, Rref = reference
+    Rth = np.interp(Qref, Qref[idx], Rref[idx])
+    deviation = theory_deviation(probe, reference, (Qref, Rth))
+    if deviation > tolerance:
+        return None
+    # Kernel cost scales with the number of calculation points, which
+    # are proportional to the number of measured points.
+    speedup = len(probe.Qo)/len(idx)
+    return Recommendation('subsample', dQ, speedup, deviation,
+                          "probe.subsample(dQ=%.3g)"%dQ)
+
+
+def _probe_parts(probe):
+    return probe.probes if hasattr(probe, 'probes') else [probe]
+
+
+def _save_calc(probe):
+    return [dict((k, getattr(p, k)) for k in _CALC_ATTRS if hasattr(p, k))
+            for p in _probe_parts(probe)]
+
+
+def _restore_calc(probe, saved):
+    for p, state in zip(_probe_parts(probe), saved):
+        for k, v in state.items():
+            setattr(p, k, v)
+
+
+def _format_time(seconds):
+    if seconds < 1e-3:
+        return "%.1f us"%(seconds*1e6)
+    elif seconds < 1:
+        return "%.1f ms"%(seconds*1e3)
+    elif seconds < 120:
+        return "%.1f s"%seconds
+    elif seconds < 7200:
+        return "%.1f min"%(seconds/60)
+    elif seconds < 2*86400:
+        return "%.1f h"%(seconds/3600)
+    else:
+        return "%.1f days"%(seconds/86400)
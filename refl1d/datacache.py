@@ -0,0 +1,155 @@
+# This program is public domain
+"""
+Binary cache for parsed data files.
+
+Reduced data files are text, and parsing them dominates the time to load
+a model when it is loaded many times, such as when each fit worker runs
+the model script, or when a batch pipeline refits the same files.  The
+parsed headers and data arrays can be saved in a cache directory and
+memory mapped on later loads::
+
+    from refl1d import datacache
+    datacache.use_data_cache('/tmp/refl1d-data')
+
+or by setting the environment variable REFL1D_DATA_CACHE before starting
+the fit, which also enables the cache in the worker processes.
+
+Entries are keyed by the absolute path, size and modification time of
+the file along with the parser and its arguments, so the cache does not
+need to be cleared when files are changed.  Stale entries are left in
+the cache directory and can be removed at any time.
+"""
+from __future__ import division, print_function
+
+__all__ = ["use_data_cache", "parse"]
+
+import os
+import json
+import hashlib
+
+import numpy as np
+
+from .util import asbytes, atomic_write
+
+_DATA_CACHE_KEY = 'REFL1D_DATA_CACHE'
+_data_cache_setting = []
+
+# Change this when the layout of the cache entries changes.
+_VERSION = 1
+
+
+def use_data_cache(path=None):
+    """
+    Set the directory for caching parsed data files.
+
+    If *path* is None, the directory given by the environment variable
+    REFL1D_DATA_CACHE is used, or the cache is disabled if it is not set.
+    Use *path=False* to disable the cache.
+
+    Returns the cache directory, or None if the cache is disabled.
+    """
+    if path is None:
+        path = os.environ.get(_DATA_CACHE_KEY, None)
+    if path:
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+    else:
+        path = None
+    _data_cache_setting[:] = [path]
+    return path
+
+
+def _default_data_cache():
+    if not _data_cache_setting:
+        use_data_cache()
+    return _data_cache_setting[0]
+
+
+def parse(parser, filename, **kw):
+    """
+    Return *parser(filename, **kw)*, using the data cache if enabled.
+
+    *parser* returns a *(header, data)* pair such as
+    :func:`bumps.data.parse_file`, or a list of pairs such as
+    :func:`bumps.data.parse_multi`.  Header values must be strings, numbers
+    or arrays.  Arrays are returned as copy-on-write memory maps of the
+    cache entry.
+
+    If *filename* is an open file rather than a path, or the cache is
+    disabled, then the file is parsed directly.
+    """
+    path = _default_data_cache()
+    if path is None or hasattr(filename, 'read'):
+        return parser(filename, **kw)
+    key = _key(parser, filename, kw)
+    result = _load(path, key)
+    if result is None:
+        result = parser(filename, **kw)
+        _save(path, key, result)
+    return result
+
+
+def _key(parser, filename, kw):
+    filename = os.path.abspath(filename)
+    info = os.stat(filename)
+    fields = (_VERSION, filename, info.st_size, info.st_mtime,
+              parser.__module__, parser.__name__, sorted(kw.items()))
+    return hashlib.sha1(asbytes(repr(fields))).hexdigest()
+
+
+def _load(path, key):
+    try:
+        with open(os.path.join(path, key + '.json')) as fid:
+            meta = json.load(fid)
+        parts = []
+        for header, arrays in meta['parts']:
+            for k, name in arrays.items():
+                header[k] = _map(path, name)
+            parts.append(header)
+    except (IOError, OSError, ValueError, KeyError):
+        # missing, partly removed or from an older version
+        return None
+    parts = [(header, header.pop('')) for header in parts]
+    return parts if meta['multi'] else parts[0]
+
+
+def _map(path, name):
+    if name is None:
+        return None
+    return np.load(os.path.join(path, name), mmap_mode='c')
+
+
+def _save(path, key, result):
+    multi = isinstance(result, list)
+    meta = {'multi': multi, 'parts': []}
+    written = []
+    try:
+        for index, (header, data) in enumerate(result if multi else [result]):
+            strings, arrays = {}, {}
+            for k, v in list(header.items()) + [('', data)]:
+                if isinstance(v, np.ndarray):
+                    name = '%s-%d-%d.npy'%(key, index, len(arrays))
+                    atomic_write(os.path.join(path, name),
+                           lambda fid: np.save(fid, v, allow_pickle=False))
+                    written.append(name)
+                    arrays[k] = name
+                elif k == '' and v is None:
+                    arrays[k] = None
+                else:
+                    strings[k] = v
+            meta['parts'].append((strings, arrays))
+        # The metadata is written last so partial entries are never read.
+        text = json.dumps(meta)
+        atomic_write(os.path.join(path, key + '.json'),
+               lambda fid: fid.write(asbytes(text)))
+    except (IOError, OSError, TypeError, ValueError):
+        # Unsupported header values or a full disk; parse the file each time.
+        for name in written:
+            try:
+                os.unlink(os.path.join(path, name))
+            except OSError:
+                pass
+
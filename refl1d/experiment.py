@@ -14,6 +14,8 @@ import os
 from math import pi, log10, floor
 import traceback
 import json
+import hashlib
+from collections import OrderedDict
 from warnings import warn
 
 import numpy as np
@@ -23,6 +25,9 @@ from bumps.parameter import Parameter, to_dict
 from . import material, profile
 from . import __version__
 from .reflectivity import reflectivity_amplitude as reflamp
+from .reflectivity import IncrementalAmplitude, DenseAmplitude
+from .reflectivity import reflectivity_chisq
+from .probe import Probe, ProbeSet
 from .reflectivity import magnetic_amplitude as reflmag
 from .reflectivity import BASE_GUIDE_ANGLE as DEFAULT_THETA_M
 #print("Using pure python reflectivity calculator")
@@ -42,6 +47,98 @@ def plot_sample(sample, instrument=None, roughness_limit=0):
                             roughness_limit=roughness_limit)
     experiment.plot()
 
+class TheoryCache(object):
+    """
+    Least recently used cache of the calculated theory for an experiment.
+
+    Each entry is the contents of the experiment cache (reflectivity,
+    residuals, profiles, ...) for one parameter vector, keyed by a hash of
+    the parameter values and the probe data.  The least recently used
+    entries are dropped when the total size of the arrays exceeds
+    *max_bytes*.
+
+    *hits*, *misses* and *evictions* count lookups and dropped entries.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.clear()
+
+    def clear(self):
+        """
+        Drop all entries and reset the counters.
+        """
+        self._entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def __getstate__(self):
+        # Entries are rebuilt as needed after unpickling.
+        return {'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Return a copy of the entry for *key*, or {} if it is not cached.
+        """
+        if key in self._entries:
+            self.hits += 1
+            entry = self._entries[key] = self._entries.pop(key)
+            return dict(entry[0])
+        self.misses += 1
+        return {}
+
+    def put(self, key, values):
+        """
+        Save *values* as the entry for *key*, evicting old entries.
+        """
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key)[1]
+        size = _nbytes(values)
+        if not values or size > self.max_bytes:
+            return
+        self._entries[key] = dict(values), size
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, (_, dropped) = self._entries.popitem(last=False)
+            self.nbytes -= dropped
+            self.evictions += 1
+
+    def stats(self):
+        """
+        Return a dict with the hit rate, counters and size of the cache.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits/lookups if lookups else 0.,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'nbytes': self.nbytes,
+            'max_bytes': self.max_bytes,
+            }
+
+def _nbytes(value):
+    """
+    Approximate size in bytes of the arrays in a nested container.
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_nbytes(v) for v in value)
+    return 8
+
+# Candidate contraction tolerances for dA='auto', from fine to coarse.
+_AUTO_DA = 10.**np.arange(-3, 2.01, 0.25)
+
 class ExperimentBase(object):
     probe = None # type: probe.Probe
     interpolation = 0
@@ -79,6 +176,13 @@ class ExperimentBase(object):
         p = self.parameters()
         print(parameter.format(p))
 
+    def __getstate__(self):
+        # Cached profiles and reflectivity are rebuilt on the next update,
+        # so there is no need to send them to the workers.
+        state = self.__dict__.copy()
+        state['_cache'] = {}
+        return state
+
     def update_composition(self):
         """
         When the model composition has changed, we need to lookup the
@@ -101,10 +205,9 @@ class ExperimentBase(object):
 
         This signals that the entire model needs to be recalculated.
         """
-        # if we wanted to be particularly clever we could predefine
-        # the optical matrices and only adjust those that have changed
-        # as the result of a parameter changing.   More trouble than it
-        # is worth, methinks.
+        # The optical matrices for the unchanged layers on the substrate
+        # side are kept by self._incremental, which compares the new slabs
+        # to the previous ones.
         #print("reseting calculation")
         self._cache = {}
 
@@ -353,16 +456,61 @@ class Experiment(ExperimentBase):
     then each profile step forms its own slab.  The *dA* condition will
     also apply to the slab approximation to the interfaces.
 
+    If *dA* is 'auto', then the largest contraction tolerance is chosen
+    such that the reflectivity differs from the uncontracted reflectivity
+    by no more than *dA_error*.  The error is in units of the data
+    uncertainty *dR*, or relative to *R* if *dA_relative* is True or
+    there is no data.  The tolerance is chosen by :meth:`tune_dA` at the
+    first evaluation and revalidated every *dA_recheck* evaluations
+    thereafter as the fit moves through parameter space.  Use
+    *dA_recheck=None* to tune only once.
+
+    If *precision* is 'single', the reflectivity of non-magnetic models is
+    computed in single precision away from the critical edge, which is
+    faster but only accurate to a few parts in $10^4$ for thin samples and
+    a few parts in $10^3$ for thick ones.  This is good enough for the
+    global search at the start of a fit, but the final fit and the
+    uncertainty analysis should use the default 'double'.  Use
+    :meth:`precision_error` to check the difference for the current model.
+
+    If *alignment_cache* is True, the reflectivity amplitude of a
+    non-magnetic sample is kept on a dense kz grid, and evaluations in
+    which only the probe parameters such as *theta_offset* and
+    *sample_broadening* have changed interpolate the grid instead of
+    rendering the sample and calling the kernel.  Points for which the
+    interpolation error could exceed *alignment_error* relative to $|r|$
+    are computed directly.  The grid costs a few evaluations to build, so
+    this only helps when the alignment is often varied on its own, such as
+    when scanning *theta_offset* for a fixed sample.  See
+    :class:`refl1d.reflectivity.DenseAmplitude`.
+
+    If *theory_cache* is given, the reflectivity, residuals and profiles
+    computed for the last few parameter vectors are kept in a least
+    recently used cache of at most *theory_cache* bytes, so that returning
+    to an earlier point, such as the best point at the end of a fit or a
+    repeated proposal, does not recompute the model.  Use
+    :meth:`theory_cache_stats` to see the hit rate.
+
     *interpolation* indicates the number of points to plot in between
     existing points.
 
     *smoothness* **DEPRECATED** This parameter is not used.
     """
     profile_shift = 0
+    _auto_dA = None
+    _dA_countdown = 0
+    precision = 'double'
+    alignment_cache = False
+    alignment_error = 1e-5
+    _theory = None
+    _theory_key = None
     def __init__(self, sample=None, probe=None, name=None,
                  roughness_limit=0, dz=None, dA=None,
                  step_interfaces=None, smoothness=None,
-                 interpolation=0):
+                 interpolation=0, dA_error=0.1, dA_relative=False,
+                 dA_recheck=1000, precision='double',
+                 alignment_cache=False, alignment_error=1e-5,
+                 theory_cache=None):
         # Note: smoothness ignored
         self.sample = sample
         self._substrate = self.sample[0].material
@@ -374,17 +522,30 @@ class Experiment(ExperimentBase):
             dz = min(dz, 5.0)
         self.dz = dz
         self.dA = dA
+        self.dA_error = dA_error
+        self.dA_relative = dA_relative
+        self.dA_recheck = dA_recheck
         self.step_interfaces = step_interfaces
         self.interpolation = interpolation
+        self.precision = precision
+        self.alignment_cache = alignment_cache
+        self.alignment_error = alignment_error
         num_slabs = len(probe.unique_L) if probe.unique_L is not None else 1
         self._slabs = profile.Microslabs(num_slabs, dz=dz)
         self._probe_cache = material.ProbeCache(probe)
         self._cache = {}  # Cache calculated profiles/reflectivities
+        self._incremental = IncrementalAmplitude()
+        self._aligned = DenseAmplitude(alignment_error)
+        self._theory = TheoryCache(theory_cache) if theory_cache else None
         self._name = name
 
     @property
     def ismagnetic(self):
         """True if experiment contains magnetic materials"""
+        # Set by _reflamp when the amplitude comes from the alignment cache
+        # without rendering the sample.
+        if 'ismagnetic' in self._cache:
+            return self._cache['ismagnetic']
         slabs = self._render_slabs()
         return slabs.ismagnetic
 
@@ -404,28 +565,184 @@ class Experiment(ExperimentBase):
             'roughness_limit': self.roughness_limit,
             'dz': self.dz,
             'dA': self.dA,
+            'dA_error': self.dA_error,
+            'dA_relative': self.dA_relative,
+            'dA_recheck': self.dA_recheck,
             'step_interfaces': self.step_interfaces,
             'interpolation': self.interpolation,
+            'precision': self.precision,
+            'alignment_cache': self.alignment_cache,
+            'alignment_error': self.alignment_error,
+            'theory_cache': self.theory_cache,
         })
 
+    @property
+    def theory_cache(self):
+        """Size limit of the theory cache in bytes, or None if disabled"""
+        return self._theory.max_bytes if self._theory is not None else None
+
+    def theory_cache_stats(self):
+        """
+        Return the hit rate and size of the theory cache as a dict, or None
+        if the experiment has no theory cache.  See :class:`TheoryCache`.
+        """
+        return self._theory.stats() if self._theory is not None else None
+
+    def update(self):
+        if self._theory is None:
+            ExperimentBase.update(self)
+            return
+        # Save the theory for the previous parameters, dropping the flag for
+        # the shared slabs since they are overwritten by the next render.
+        if self._theory_key is not None:
+            saved = dict((k, v) for k, v in self._cache.items()
+                         if k != 'rendered')
+            self._theory.put(self._theory_key, saved)
+        self._theory_key = self._theory_hash()
+        self._cache = self._theory.get(self._theory_key)
+    update.__doc__ = ExperimentBase.update.__doc__
+
+    def _theory_hash(self):
+        """
+        Hash of the parameter values and the probe data for the theory cache.
+        """
+        pars = parameter.unique(self.parameters())
+        settings = (self.dA, self._auto_dA, self.dz, self.step_interfaces,
+                    self.precision, self.interpolation)
+        digest = hashlib.sha1(asbytes(repr(
+            settings + tuple(p.value for p in pars))))
+        probe = self.probe
+        probes = probe.xs if probe.polarized else [probe]
+        for p in probes:
+            if p is None:
+                continue
+            for v in (p.calc_Q, p.Q, p.dQ, p.R, p.dR):
+                if v is not None:
+                    digest.update(np.ascontiguousarray(v, 'd').tobytes())
+        return digest.hexdigest()
+
     def _render_slabs(self):
         """
         Build a slab description of the model from the individual layers.
         """
         key = 'rendered'
         if key not in self._cache:
+            dA = self._contraction()
             self._slabs.clear()
+            self._slabs.dA = dA
             self.sample.render(self._probe_cache, self._slabs)
             self._slabs.finalize(step_interfaces=self.step_interfaces,
-                                 dA=self.dA)
+                                 dA=dA)
                                  #roughness_limit=self.roughness_limit)
             self._cache[key] = True
         return self._slabs
 
+    def _contraction(self):
+        """
+        Contraction tolerance for the next render, retuning if *dA='auto'*
+        and the tuned value is due for revalidation.
+        """
+        if self.dA != 'auto':
+            return self.dA
+        if self._dA_countdown <= 0:
+            self.tune_dA()
+        self._dA_countdown -= 1
+        return self._auto_dA
+
+    def tune_dA(self):
+        """
+        Find the largest contraction tolerance within the error budget.
+
+        The reflectivity at the current parameter values is computed
+        without contraction, then a bisection over the candidate tolerances
+        in *_AUTO_DA* finds the largest for which the reflectivity is within
+        *dA_error* of the uncontracted reflectivity.  Returns the selected
+        tolerance, or None if even the smallest candidate is out of budget.
+
+        This is called automatically when *dA='auto'*.
+        """
+        from .cost import theory_deviation
+
+        # Suppress revalidation while tuning.
+        self._dA_countdown = np.inf
+        self._auto_dA = None
+        self._cache = {}
+        reference = self.reflectivity()
+        # Invariant: _AUTO_DA[lo] is within budget and _AUTO_DA[hi] is not,
+        # with lo=-1 standing for no contraction.
+        lo, hi = -1, len(_AUTO_DA)
+        while hi - lo > 1:
+            mid = (lo + hi)//2
+            self._auto_dA = _AUTO_DA[mid]
+            self._cache = {}
+            error = theory_deviation(self.probe, reference, self.reflectivity(),
+                                     relative=self.dA_relative)
+            if error <= self.dA_error:
+                lo = mid
+            else:
+                hi = mid
+        self._auto_dA = _AUTO_DA[lo] if lo >= 0 else None
+        self._cache = {}
+        recheck = self.dA_recheck
+        self._dA_countdown = recheck if recheck else np.inf
+        return self._auto_dA
+
+    def precision_error(self, relative=True):
+        """
+        Return the largest difference between the reflectivity computed
+        with the current *precision* and the reflectivity computed in
+        double precision.
+
+        The difference is relative to *R*, or in units of the data
+        uncertainty *dR* if *relative* is False.  See
+        :func:`refl1d.cost.theory_deviation`.  The error is zero when
+        *precision* is 'double'.
+        """
+        from .cost import theory_deviation
+
+        if self.precision == 'double':
+            return 0.
+        precision = self.precision
+        try:
+            self.precision = 'double'
+            self._cache = {}
+            reference = self.reflectivity()
+            self.precision = precision
+            self._cache = {}
+            return theory_deviation(self.probe, reference, self.reflectivity(),
+                                    relative=relative)
+        finally:
+            self.precision = precision
+            self._cache = {}
+
+    def tune_backends(self):
+        """
+        Time the kernel backends on the shapes used by this model, keeping
+        the fastest for backend 'auto'.
+
+        Call this for each model before the fit.  See :mod:`refl1d.backend`.
+        """
+        from . import backend
+
+        self.update()
+        try:
+            backend.tune(self.nllf)
+        finally:
+            self.update()
+
     def _reflamp(self):
         #calc_q = self.probe.calc_Q
         #return calc_q, calc_q
         key = 'calc_r'
+        if key not in self._cache and self.alignment_cache:
+            calc_q = self.probe.calc_Q
+            self._aligned.tolerance = self.alignment_error
+            calc_r = (self._aligned(-calc_q/2, self._sample_key(),
+                                    self._aligned_sample)
+                      if not self.probe.polarized else None)
+            if calc_r is not None:
+                self._cache['ismagnetic'] = False
+                self._cache[key] = calc_q, calc_r
         if key not in self._cache:
             slabs = self._render_slabs()
             w = slabs.w
@@ -442,8 +759,10 @@ class Experiment(ExperimentBase):
                                  rhoM=rhoM, thetaM=thetaM, Aguide=Aguide, H=H,
                                  sigma=sigma)
             else:
-                calc_r = reflamp(-calc_q/2, depth=w, rho=rho, irho=irho,
-                                 sigma=sigma)
+                calc_r = self._incremental(-calc_q/2, depth=w, rho=rho,
+                                           irho=irho, sigma=sigma,
+                                           shape=slabs.interface_shape,
+                                           precision=self.precision)
             if False and np.isnan(calc_r).any():
                 print("w", w)
                 print("rho", rho)
@@ -464,6 +783,28 @@ class Experiment(ExperimentBase):
             #if np.isnan(calc_r).any(): print("calc_r contains NaN")
         return self._cache[key]
 
+    def _sample_key(self):
+        """
+        Values which determine the rendered sample, for the alignment cache.
+        """
+        pars = parameter.unique(self.sample.parameters())
+        return ((self.dA, self._auto_dA, self.dz, self.step_interfaces)
+                + tuple(p.value for p in pars))
+
+    def _aligned_sample(self):
+        """
+        Slabs for the alignment cache, or None if the sample is magnetic or
+        has a separate profile for each wavelength.
+        """
+        slabs = self._render_slabs()
+        if slabs.ismagnetic or slabs.rho.shape[0] != 1:
+            return None
+        shape = slabs.interface_shape
+        # Copies, since the slabs are overwritten by the next render.
+        return (np.array(slabs.w), np.array(slabs.rho[0]),
+                np.array(slabs.irho[0]), np.array(slabs.sigma),
+                np.array(shape) if shape is not None else None)
+
     def amplitude(self, resolution=False, interpolation=0):
         """
         Calculate reflectivity amplitude at the probe points.
@@ -493,6 +834,73 @@ class Experiment(ExperimentBase):
             self._cache[key] = res
         return self._cache[key]
 
+    def residuals(self):
+        if 'residuals' not in self._cache:
+            probes = self._fused_probes()
+            if probes:
+                self._fused_chisq(probes, keep=True)
+        return ExperimentBase.residuals(self)
+
+    def nllf(self):
+        if 'residuals' in self._cache:
+            return ExperimentBase.nllf(self)
+        if 'chisq' not in self._cache:
+            probes = self._fused_probes()
+            if not probes:
+                return ExperimentBase.nllf(self)
+            self._cache['chisq'] = self._fused_chisq(probes)
+        return 0.5*self._cache['chisq']
+
+    def _fused_probes(self):
+        """
+        Return the probes for :meth:`_fused_chisq`, or None if the model
+        needs the step by step calculation.
+        """
+        probe = self.probe
+        if (self.alignment_cache or probe.polarized or self.ismagnetic
+                or type(self).reflectivity is not Experiment.reflectivity
+                or type(self)._reflamp is not Experiment._reflamp):
+            return None
+        probes = probe.probes if isinstance(probe, ProbeSet) else [probe]
+        for p in probes:
+            if (isinstance(p, ProbeSet)
+                    or type(p).apply_beam is not Probe.apply_beam
+                    or type(p)._apply_resolution is not Probe._apply_resolution
+                    or p.resolution != 'normal'
+                    or p.R is None or p.dR is None):
+                return None
+        return probes
+
+    def _fused_chisq(self, probes, keep=False):
+        """
+        Compute the chi-squared for the non-magnetic reflectivity with
+        gaussian resolution with one call to the kernel for each probe,
+        going directly from the slabs to the sum of the squared residuals.
+        This avoids the intermediate arrays of :meth:`_reflamp` and
+        :meth:`Probe.apply_beam`.
+
+        *probes* is the list from :meth:`_fused_probes`.  If *keep* is
+        True, the residuals and the theory are saved in the
+        cache for :meth:`residuals` and :meth:`reflectivity`.
+        """
+        slabs = self._render_slabs()
+        npts = sum(len(p.Q) for p in probes)
+        theory = np.empty(npts) if keep else None
+        resid = np.empty(npts) if keep else None
+        beams = [(p.Q, p.dQ, p.R, p.dR, p.intensity.value, p.background.value,
+                  p.back_absorption.value, p.back_reflectivity)
+                 for p in probes]
+        chisq = reflectivity_chisq(
+            self.probe.calc_Q, slabs.w, slabs.rho, slabs.irho, slabs.sigma,
+            shape=slabs.interface_shape, beams=beams,
+            precision=self.precision, incremental=self._incremental,
+            theory=theory, resid=resid)
+
+        if keep:
+            self._cache['residuals'] = resid
+            self._cache[('reflectivity', True, 0)] = self.probe.Q, theory
+        return chisq
+
     def smooth_profile(self, dz=0.1):
         """
         Return the scattering potential for the sample.
@@ -10,8 +10,8 @@ __all__ = ["data_view", "model_view", "new_model", "calc_errors", "show_errors"]
 
 import numpy as np
 
-from . import names as refl
-from .errors import calc_errors, show_errors
+# The model and error modules are imported on first use so that the
+# command line and worker processes start quickly.
 
 # These are names used by the driver
 def data_view():
@@ -31,8 +31,9 @@ def load_model(filename):
         problem = garefl.load(filename)
         return problem
     elif filename.endswith('.staj') or filename.endswith('.sta'):
+        from bumps.fitproblem import FitProblem
         from .stajconvert import load_mlayer
-        return refl.FitProblem(load_mlayer(filename))
+        return FitProblem(load_mlayer(filename))
         #fit_all(problem.fitness, pmp=20)
     elif filename.endswith('.zip'):
         from bumps.fitproblem import load_problem
@@ -48,7 +49,18 @@ def load_model(filename):
     else:
         return None
 
+def calc_errors(problem, points):
+    from .errors import calc_errors
+    return calc_errors(problem, points)
+calc_errors.__doc__ = "See :func:`refl1d.errors.calc_errors`."
+
+def show_errors(errors, *args, **kw):
+    from .errors import show_errors
+    return show_errors(errors, *args, **kw)
+show_errors.__doc__ = "See :func:`refl1d.errors.show_errors`."
+
 def new_model():
+    from . import names as refl
     stack = refl.silicon(0, 10) | refl.air
     instrument = refl.NCNR.NG1()
     probe = instrument.probe(T=np.linspace(0, 5, 200),
@@ -1,5 +1,6 @@
 import inspect
 
+import numpy as np
 from numpy import real, imag, asarray, broadcast_to
 
 from bumps.parameter import Parameter, BaseParameter, to_dict
@@ -26,6 +27,8 @@ class FunctionalProfile(Layer):
 
         *name* is the layer name
 
+        *jit* is True if the profile function should be compiled with numba
+
     The profile function takes a depth vector *z* returns a density vector
     *rho*. For absorbing profiles, return complex vector *rho + irho*1j*.
 
@@ -36,8 +39,14 @@ class FunctionalProfile(Layer):
 
     Initial values for the function parameters can be given using name=value.
     These values can be scalars or fitting parameters.  The function will
-    be called with the current parameter values as arguments.  The layer
-    thickness can be computed as :func:`layer_thickness`.
+    be called with the current parameter values as arguments.
+
+    The profile is evaluated once for each new set of parameter values on
+    the microslab grid, and once at *z=[0, thickness]* for the values of
+    the *start* and *end* materials.  The function should therefore be
+    pure, with a result that depends only on *z* and the parameter values.  With *jit=True* the
+    function is compiled using *numba.njit* if numba is available; if not,
+    the python function is used as is.
 
     There is no mechanism for querying the larger profile to determine the
     value of the *rho* at the layer boundaries.  If needed, this information
@@ -52,11 +61,11 @@ class FunctionalProfile(Layer):
                                     rhoL=L1.rho, rhoR=L3.rho)
         sample = L1 | profile | L3
     """
-    RESERVED = ('thickness', 'interface', 'profile', 'tol', 'magnetism', 'name')
+    RESERVED = ('thickness', 'interface', 'profile', 'tol', 'magnetism', 'name',
+                'jit')
 
-    # TODO: test that thickness(z) matches the thickness of the layer
     def __init__(self, thickness=0, interface=0, profile=None, tol=1e-3,
-                 magnetism=None, name=None, **kw):
+                 magnetism=None, name=None, jit=False, **kw):
         if not name:
             name = profile.__name__
         if interface != 0:
@@ -69,6 +78,9 @@ class FunctionalProfile(Layer):
         self.profile = profile
         self.tol = tol
         self.magnetism = magnetism
+        self.jit = jit
+        self._cache = _ProfileCache(_compile(profile, jit), self._fpars,
+                                    self._evaluate)
 
         # TODO: maybe make these lazy (and for magnetism below as well)
         rho_start = _LayerLimit(self, isend=False, isrho=True)
@@ -96,19 +108,15 @@ class FunctionalProfile(Layer):
             'parameters': {k: getattr(self, k) for k in self._parameters},
             'tol': self.tol,
             'magnetism': self.magnetism,
+            'jit': self.jit,
         })
 
     def render(self, probe, slabs):
-        Pw, Pz = slabs.microslabs(self.thickness.value)
-        if len(Pw) == 0:
+        thickness = self.thickness.value
+        if len(slabs.microslabs(thickness)[0]) == 0:
             return
-        #print kw
-        # TODO: always return rho, irho from profile function
-        # return value may be a constant for rho or irho
-        phi = asarray(self.profile(Pz, **self._fpars()))
-        if phi.shape != Pz.shape:
-            raise TypeError("profile function '%s' did not return array phi(z)"
-                            %self.profile.__name__)
+        profile = lambda z: self._cache(thickness, z)
+        Pw, _, phi = slabs.adaptive_microslabs(thickness, profile)
         Pw, phi = util.merge_ends(Pw, phi, tol=self.tol)
         #P = M*phi + S*(1-phi)
         slabs.extend(rho=[real(phi)], irho=[imag(phi)], w=Pw)
@@ -118,6 +126,15 @@ class FunctionalProfile(Layer):
         kw = dict((k, getattr(self, k).value) for k in self._parameters)
         return  kw
 
+    def _evaluate(self, profile, z, kw):
+        # TODO: always return rho, irho from profile function
+        # return value may be a constant for rho or irho
+        phi = asarray(profile(z, **kw))
+        if phi.shape != z.shape:
+            raise TypeError("profile function '%s' did not return array phi(z)"
+                            %self.profile.__name__)
+        return phi
+
 
 class FunctionalMagnetism(BaseMagnetism):
     """
@@ -129,6 +146,8 @@ class FunctionalMagnetism(BaseMagnetism):
 
         *tol* is the tolerance for considering values equal
 
+        *jit* is True if the profile function should be compiled with numba
+
         :class:`refl1d.magnetism.BaseMagnetism` parameters
 
     The profile function takes a depth vector *z* and returns a magnetism
@@ -140,9 +159,9 @@ class FunctionalMagnetism(BaseMagnetism):
     function.
     """
     RESERVED = ('profile', 'tol', 'name', 'extent', 'dead_below', 'dead_above',
-                'interface_below', 'interface_above')
+                'interface_below', 'interface_above', 'jit')
     magnetic = True
-    def __init__(self, profile=None, tol=1e-3, name=None, **kw):
+    def __init__(self, profile=None, tol=1e-3, name=None, jit=False, **kw):
         if not name:
             name = profile.__name__
         if profile is None:
@@ -152,6 +171,9 @@ class FunctionalMagnetism(BaseMagnetism):
         BaseMagnetism.__init__(self, name=name, **magkw)
         self.profile = profile
         self.tol = tol
+        self.jit = jit
+        self._cache = _ProfileCache(_compile(profile, jit), self._fpars,
+                                    self._evaluate)
 
         self._parameters = _set_vars(self, name, profile, kw, self.RESERVED)
         rhoM_start = _MagnetismLimit(self, isend=False, isrhoM=True)
@@ -190,22 +212,15 @@ class FunctionalMagnetism(BaseMagnetism):
             'profile': self.profile,
             'parameters': {k: getattr(self, k) for k in self._parameters},
             'tol': self.tol,
+            'jit': self.jit,
         }))
+        return ret
 
     def render(self, probe, slabs, thickness, anchor, sigma):
         Pw, Pz = slabs.microslabs(thickness)
         if len(Pw) == 0:
             return
-        kw = dict((k, getattr(self, k).value) for k in self._parameters)
-        P = self.profile(Pz, **kw)
-
-        rhoM, thetaM = P if isinstance(P, tuple) else (P, DEFAULT_THETA_M)
-        try:
-            # rhoM or thetaM may be constant, lists or arrays (but not tuples!)
-            rhoM, thetaM = [broadcast_to(v, Pz.shape) for v in (rhoM, thetaM)]
-        except ValueError:
-            raise TypeError("profile function '%s' did not return array rhoM(z)"
-                            %self.profile.__name__)
+        rhoM, thetaM = self._cache(thickness, Pz)
         P = rhoM + thetaM*0.001j  # combine rhoM/thetaM so they can be merged
         Pw, P = util.merge_ends(Pw, P, tol=self.tol)
         rhoM, thetaM = P.real, P.imag*1000  # split out rhoM,thetaM again
@@ -216,13 +231,74 @@ class FunctionalMagnetism(BaseMagnetism):
         kw = dict((k, getattr(self, k).value) for k in self._parameters)
         return  kw
 
+    def _evaluate(self, profile, z, kw):
+        P = profile(z, **kw)
+        rhoM, thetaM = P if isinstance(P, tuple) else (P, DEFAULT_THETA_M)
+        try:
+            # rhoM or thetaM may be constant, lists or arrays (but not tuples!)
+            return np.array([broadcast_to(v, z.shape) for v in (rhoM, thetaM)],
+                            dtype='d')
+        except ValueError:
+            raise TypeError("profile function '%s' did not return array rhoM(z)"
+                            %self.profile.__name__)
+
     def __repr__(self):
         return "FunctionalMagnetism(%s)"%self.name
 
 
+class _ProfileCache(object):
+    """
+    Memoized profile evaluation for a functional layer.
+
+    Calling the cache with *thickness* and the microslab centers *z* returns
+    *evaluate(profile, z, pars())*, which is recomputed only when the
+    thickness, the points or the parameter values change.  The values at
+    the layer boundaries are from :meth:`limits`, which is memoized
+    separately so that rendering always evaluates the profile on the
+    uniform microslab grid.
+    """
+    def __init__(self, profile, pars, evaluate):
+        self.profile = profile
+        self.pars = pars
+        self.evaluate = evaluate
+        self.clear()
+
+    def __call__(self, thickness, z):
+        kw = self.pars()
+        key = (thickness, tuple(sorted(kw.items())))
+        if key != self.key or not np.array_equal(z, self.z):
+            self.value = self.evaluate(self.profile, z, kw)
+            self.key, self.z = key, z
+        return self.value
+
+    def limits(self, thickness):
+        """
+        Return the profile evaluated at *z=[0, thickness]*.
+        """
+        kw = self.pars()
+        key = (thickness, tuple(sorted(kw.items())))
+        if key != self.limits_key:
+            z = np.array([0., thickness])
+            self.limits_value = self.evaluate(self.profile, z, kw)
+            self.limits_key = key
+        return self.limits_value
+
+    def clear(self):
+        self.key = self.z = self.value = None
+        self.limits_key = self.limits_value = None
+
+
+def _compile(profile, jit):
+    # User functions may be defined where numba cannot cache them on disk.
+    return util.lazy_njit(profile, cache=False) if jit else profile
+
+
 def _set_vars(self, name, profile, kw, reserved):
     # Query profile function for the list of arguments
-    vars = inspect.getargspec(profile)[0]
+    try:
+        vars = inspect.getfullargspec(profile)[0]
+    except AttributeError:  # CRUFT: python 2.7 does not have getfullargspec
+        vars = inspect.getargspec(profile)[0]
     #print "vars", vars
     if inspect.ismethod(profile):
         vars = vars[1:]  # Chop self
@@ -255,9 +331,8 @@ class _LayerLimit(BaseParameter):
 
     @property
     def value(self):
-        z = asarray([0., self.flayer.thickness.value])
-        P = self.flayer.profile(asarray(z), **self.flayer._fpars())
-        index = 1 if self.isend else 0
+        P = self.flayer._cache.limits(self.flayer.thickness.value)
+        index = -1 if self.isend else 0
         return real(P[index]) if self.isrho else imag(P[index])
 
     def __repr__(self):
@@ -277,11 +352,7 @@ class _MagnetismLimit(BaseParameter):
 
     @property
     def value(self):
-        zmax = self.flayer._calc_thickness()
-        z = asarray([0., zmax])
-        P = self.flayer.profile(z, **self.flayer._fpars())
-        rhoM, thetaM = P if isinstance(P, tuple) else (P, DEFAULT_THETA_M)
-        rhoM, thetaM = [broadcast_to(v, z.shape) for v in (rhoM, thetaM)]
+        rhoM, thetaM = self.flayer._cache.limits(self.flayer._calc_thickness())
         index = -1 if self.isend else 0
         return rhoM[index] if self.isrhoM else thetaM[index]
 
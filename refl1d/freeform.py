@@ -66,10 +66,12 @@ class FreeLayer(Layer):
         thickness = self.thickness.value
         left_rho, left_irho = self.left.sld(probe)
         right_rho, right_irho = self.right.sld(probe)
-        Pw, Pz = slabs.microslabs(thickness)
-        t = Pz/thickness
-        Prho = _profile(left_rho, right_rho, self.rho, self.rhoz, t)
-        Pirho = _profile(left_irho, right_irho, self.irho, self.irhoz, t)
+        def profile(z):
+            t = z/thickness
+            return (_profile(left_rho, right_rho, self.rho, self.rhoz, t),
+                    _profile(left_irho, right_irho, self.irho, self.irhoz, t))
+        Pw, _, (Prho, Pirho) = slabs.adaptive_microslabs(thickness, profile,
+                                                         pointwise=True)
         slabs.extend(rho=[Prho], irho=[Pirho], w=Pw)
 
 class FreeformInterface01(Layer):
@@ -124,9 +126,10 @@ class FreeformInterface01(Layer):
         right_rho, right_irho = self.above.sld(probe)
         z = np.hstack((0, sorted([v.value for v in self.z]), 1))
         vf = np.hstack((0, sorted([v.value for v in self.vf]), 1))
-        Pw, Pz = slabs.microslabs(thickness)
-        t = Pz/thickness
-        offset, profile = pbs(z, vf, t, parametric=False, clamp=True)
+        Pw, _, profile = slabs.adaptive_microslabs(
+            thickness,
+            lambda t: pbs(z, vf, t/thickness, parametric=False, clamp=True)[1],
+            pointwise=True)
         Pw, profile = util.merge_ends(Pw, profile, tol=1e-3)
         Prho = (1-profile)*left_rho + profile*right_rho
         Pirho = (1-profile)*left_irho + profile*right_irho
@@ -192,9 +195,10 @@ class FreeInterface(Layer):
         if p[-1] == 0:
             p[-1] = 1
         p /= p[-1]
-        Pw, Pz = slabs.microslabs(z[-1])
-        _, profile = pbs(z, p, Pz, parametric=False, clamp=True)
-        profile = np.clip(profile, 0, 1)
+        Pw, _, profile = slabs.adaptive_microslabs(
+            z[-1],
+            lambda t: np.clip(pbs(z, p, t, parametric=False, clamp=True)[1], 0, 1),
+            pointwise=True)
         Pw, profile = util.merge_ends(Pw, profile, tol=1e-3)
         Prho = (1-profile)*left_rho + profile*right_rho
         Pirho = (1-profile)*left_irho + profile*right_irho
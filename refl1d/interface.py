@@ -64,6 +64,13 @@ You will need to provide the following methods::
         returns the set of parameters used to define the interface
 
 See the implementation of :class:`Erf` or :class:`Tanh` for a complete example.
+
+Interfaces with an analytic roughness factor also define *shape*, the
+interface shape code used by the reflectivity kernel, and *kernel_width()*,
+the width in the units expected by the kernel.  Slabs with these interfaces
+are computed as a single boundary in the reflectivity calculation rather
+than being expanded into microslabs.  See
+:func:`refl1d.reflectivity.reflectivity_amplitude` for the formulas.
 """
 from __future__ import division, print_function
 
@@ -75,6 +82,13 @@ from numpy import arccosh as acosh
 from numpy import arctanh as atanh
 from scipy.special import erf, erfinv
 
+# Interface shape codes for the reflectivity kernel.  These are defined
+# here rather than in refl1d.reflectivity so that this module does not
+# depend on the kernels.
+ERF_INTERFACE = 0
+TANH_INTERFACE = 1
+LINEAR_INTERFACE = 2
+
 try:
     from bumps.parameter import Parameter
 except ImportError:
@@ -99,12 +113,27 @@ class Interface(object):
     An interface defines the transition from one layer to another in terms
     of the relative proportion of materials on either side of the interface.
     """
+    #: Interface shape code for the reflectivity kernel
+    shape = ERF_INTERFACE
     def parameters(self):
         """
         Fittable parameters
         """
         return []
 
+    def kernel_width(self):
+        """
+        Return the interface width as used by the reflectivity kernel.
+        """
+        return 0.
+
+    def to_dict(self):
+        return {
+            'type': type(self).__name__,
+            'width': getattr(self, 'width', None),
+            'scale': getattr(self, '_scale', 1),
+        }
+
     def cdf(self, z):
         """
         Return the cumulative density function corresponding to the interface.
@@ -187,6 +216,9 @@ class Erf(Interface):
     def parameters(self):
         return {'width':self.width}
 
+    def kernel_width(self):
+        return self.width.value * self._scale
+
     def cdf(self, z):
         sigma = self.width.value * self._scale
         if sigma <= 0.0:
@@ -221,11 +253,20 @@ class Linear(Interface):
         CDF(z) = 2/w*z if |z|<w/2, 0 if z<-w/2, 1 otherwise
         PDF(z) = 1/w if |z|<w/2, otherwise 0
         PPF(z) = w/2*z if |z|<w/2, -w/2 if z<-w/2, w/2 otherwise
+
+    The reflectivity calculation scales the Fresnel coefficient by the
+    characteristic function of the boxcar evaluated at the Nevot-Croce
+    wavevector, in analogy to the gaussian interface::
+
+        F = (k_i-k_{i+1})/(k_i+k_{i+1}) sinc(sqrt(k_i k_{i+1}) w)
     """
+    shape = LINEAR_INTERFACE
     def __init__(self, width=0, name="linear"):
         self.width = Parameter.default(width, limits=(0, inf), name=name)
     def parameters(self):
         return {'width':self.width}
+    def kernel_width(self):
+        return float(self.width.value)
     def cdf(self, z):
         w = float(self.width.value)
         if w <= 0.0:
@@ -277,6 +318,16 @@ class Tanh(Interface):
     .. seealso::
        This profile has an analytic solution. E.S. Wu, and W. W. Webb,
        Phys Rev A 8(4) 2065-2076 (1973)
+
+    The reflectivity calculation uses the exact reflection coefficient
+    for a single tanh interface, scaling the Fresnel coefficient by
+
+    .. math:
+
+        F = \frac{\text{sinhc}(\pi s (k_i - k_{i+1}))}
+                  {\text{sinhc}(\pi s (k_i + k_{i+1}))}
+
+    where $s = w/(2C)$ and $\text{sinhc}(x) = \sinh(x)/x$.
     """
 
     # Derivation
@@ -309,6 +360,7 @@ class Tanh(Interface):
     # to form ws = w*s
     C = atanh(erf(1/sqrt(2)))
     Cfwhm = 2*acosh(sqrt(2))
+    shape = TANH_INTERFACE
     @classmethod
     def as_fwhm(cls, *args, **kw):
         r"""
@@ -322,6 +374,8 @@ class Tanh(Interface):
         self.width = Parameter.default(width, limits=(0, inf), name=name)
     def parameters(self):
         return {'width':self.width}
+    def kernel_width(self):
+        return self.width.value * self._scale
     def cdf(self, z):
         w = self.width.value * self._scale
         if w <= 0.0:
@@ -119,16 +119,19 @@ PyObject* Pmagnetic_amplitude(PyObject*obj,PyObject*args)
 PyObject* Preflectivity_amplitude(PyObject*obj,PyObject*args)
 {
   PyObject *kz_obj,*r_obj,*d_obj,*rho_obj,*irho_obj,*sigma_obj,*rho_index_obj;
-  Py_ssize_t nkz, nr, nd, nrho, nirho, nsigma, nrho_index;
+  PyObject *shape_obj = NULL, *partial_obj = NULL;
+  Py_ssize_t nkz, nr, nd, nrho, nirho, nsigma, nrho_index, nshape, npartial;
   const double *kz, *d, *sigma, *rho, *irho;
-  const int *rho_index;
-  int nprofiles;
-  Cplx *r;
-  DECLARE_VECTORS(7);
+  const int *rho_index, *shape = NULL;
+  int nprofiles, split = 0, update = 0;
+  double promote = -1.;
+  Cplx *r, *partial = NULL;
+  DECLARE_VECTORS(9);
 
-  if (!PyArg_ParseTuple(args, "OOOOOOO:reflectivity",
+  if (!PyArg_ParseTuple(args, "OOOOOOO|OiiOd:reflectivity",
       &d_obj,&sigma_obj,&rho_obj,&irho_obj,
-      &kz_obj,&rho_index_obj, &r_obj))
+      &kz_obj,&rho_index_obj, &r_obj, &shape_obj,
+      &split, &update, &partial_obj, &promote))
     return NULL;
   INVECTOR(sigma_obj,sigma,nsigma);
   INVECTOR(d_obj,d,nd);
@@ -137,6 +140,16 @@ PyObject* Preflectivity_amplitude(PyObject*obj,PyObject*args)
   INVECTOR(kz_obj,kz,nkz);
   INVECTOR(rho_index_obj, rho_index, nrho_index);
   OUTVECTOR(r_obj,r,nr);
+  if (shape_obj != NULL && shape_obj != Py_None) {
+    INVECTOR(shape_obj, shape, nshape);
+    if (nshape != nsigma) {
+#ifndef BROKEN_EXCEPTIONS
+      PyErr_SetString(PyExc_ValueError, "sigma,shape have different lengths");
+#endif
+      FREE_VECTORS();
+      return NULL;
+    }
+  }
 
   // Determine how many profiles we have
   nprofiles = 1;
@@ -167,11 +180,33 @@ PyObject* Preflectivity_amplitude(PyObject*obj,PyObject*args)
     FREE_VECTORS();
     return NULL;
   }
-  reflectivity_amplitude((int)nd, d, sigma, rho, irho, (int)nkz, kz, rho_index, r);
+  if (split > 0 || promote >= 0.) {
+    if (partial_obj != NULL && partial_obj != Py_None) {
+      OUTVECTOR(partial_obj, partial, npartial);
+    }
+    if (split > 0 && (partial == NULL || npartial != 4*nkz || split >= nd)) {
+#ifndef BROKEN_EXCEPTIONS
+      PyErr_SetString(PyExc_ValueError, "partial must have 4*len(kz) values and split must be less than len(d)");
+#endif
+      FREE_VECTORS();
+      return NULL;
+    }
+    reflectivity_amplitude_split((int)nd, d, sigma, shape, rho, irho, (int)nkz, kz, rho_index, split, update, partial, promote, r);
+  } else {
+    reflectivity_amplitude((int)nd, d, sigma, shape, rho, irho, (int)nkz, kz, rho_index, r);
+  }
   FREE_VECTORS();
   return Py_BuildValue("");
 }
 
+PyObject* Pset_blocked_kernel(PyObject*obj,PyObject*args)
+{
+  int enable;
+
+  if (!PyArg_ParseTuple(args, "i:_set_blocked_kernel", &enable)) return NULL;
+  return Py_BuildValue("i", set_blocked_kernel(enable));
+}
+
 PyObject* Palign_magnetic(PyObject *obj, PyObject *args)
 {
   PyObject *d_obj,*rho_obj,*irho_obj,*sigma_obj;
@@ -318,6 +353,136 @@ PyObject* Pcontract_by_step(PyObject*obj,PyObject*args)
 }
 
 
+// Check the lengths of the data vectors for Pbeam_chisq and Preflectivity_chisq.
+static bool
+check_beam_vectors(Py_ssize_t ncalc_Q, Py_ssize_t ncalc_R,
+                   Py_ssize_t nQ, Py_ssize_t ndQ, Py_ssize_t nR, Py_ssize_t ndR,
+                   const double *theory, Py_ssize_t ntheory,
+                   const double *resid, Py_ssize_t nresid)
+{
+  if (ncalc_Q < 2 || ncalc_Q != ncalc_R) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "calc_Q and calc_R have different lengths");
+#endif
+    return false;
+  }
+  if (nQ != ndQ || nQ != nR || nQ != ndR
+      || (theory != NULL && ntheory != nQ)
+      || (resid != NULL && nresid != nQ)) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "Q, dQ, R, dR, theory and resid have different lengths");
+#endif
+    return false;
+  }
+  return true;
+}
+
+PyObject* Pbeam_chisq(PyObject *obj, PyObject *args)
+{
+  PyObject *calc_Q_obj,*calc_R_obj,*Q_obj,*dQ_obj,*R_obj,*dR_obj;
+  PyObject *theory_obj,*resid_obj;
+  const double *calc_Q,*calc_R,*Q,*dQ,*R,*dR;
+  double *theory = NULL, *resid = NULL;
+  double back_absorption, intensity, background, chisq;
+  int back_reflectivity;
+  Py_ssize_t ncalc_Q,ncalc_R,nQ,ndQ,nR,ndR,ntheory=0,nresid=0;
+  DECLARE_VECTORS(8);
+
+  if (!PyArg_ParseTuple(args, "OOdiOOOOddOO:beam_chisq",
+      &calc_Q_obj,&calc_R_obj,&back_absorption,&back_reflectivity,
+      &Q_obj,&dQ_obj,&R_obj,&dR_obj,&intensity,&background,
+      &theory_obj,&resid_obj))
+    return NULL;
+  INVECTOR(calc_Q_obj,calc_Q,ncalc_Q);
+  INVECTOR(calc_R_obj,calc_R,ncalc_R);
+  INVECTOR(Q_obj,Q,nQ);
+  INVECTOR(dQ_obj,dQ,ndQ);
+  INVECTOR(R_obj,R,nR);
+  INVECTOR(dR_obj,dR,ndR);
+  if (theory_obj != Py_None) OUTVECTOR(theory_obj,theory,ntheory);
+  if (resid_obj != Py_None) OUTVECTOR(resid_obj,resid,nresid);
+  if (!check_beam_vectors(ncalc_Q, ncalc_R, nQ, ndQ, nR, ndR,
+                          theory, ntheory, resid, nresid)) {
+    FREE_VECTORS();
+    return NULL;
+  }
+  chisq = beam_chisq((int)ncalc_Q, calc_Q, calc_R,
+                     back_absorption, back_reflectivity,
+                     (int)nQ, Q, dQ, R, dR, intensity, background,
+                     theory, resid);
+  FREE_VECTORS();
+  return Py_BuildValue("d", chisq);
+}
+
+PyObject* Preflectivity_chisq(PyObject *obj, PyObject *args)
+{
+  PyObject *d_obj,*sigma_obj,*rho_obj,*irho_obj,*shape_obj,*partial_obj;
+  PyObject *calc_Q_obj,*calc_R_obj,*Q_obj,*dQ_obj,*R_obj,*dR_obj;
+  PyObject *theory_obj,*resid_obj;
+  const double *d,*sigma,*rho,*irho,*calc_Q,*Q,*dQ,*R,*dR;
+  const int *shape = NULL;
+  double *calc_R = NULL, *theory = NULL, *resid = NULL;
+  Cplx *partial = NULL;
+  double back_absorption, intensity, background, chisq, promote = -1.;
+  int split, update, back_reflectivity;
+  Py_ssize_t nd,nsigma,nrho,nirho,nshape=0,npartial=0;
+  Py_ssize_t ncalc_Q,ncalc_R,nQ,ndQ,nR,ndR,ntheory=0,nresid=0;
+  DECLARE_VECTORS(14);
+
+  if (!PyArg_ParseTuple(args, "OOOOOiiOOOdiOOOOddOO|d:reflectivity_chisq",
+      &d_obj,&sigma_obj,&rho_obj,&irho_obj,&shape_obj,
+      &split,&update,&partial_obj,
+      &calc_Q_obj,&calc_R_obj,&back_absorption,&back_reflectivity,
+      &Q_obj,&dQ_obj,&R_obj,&dR_obj,&intensity,&background,
+      &theory_obj,&resid_obj,&promote))
+    return NULL;
+  INVECTOR(d_obj,d,nd);
+  INVECTOR(sigma_obj,sigma,nsigma);
+  INVECTOR(rho_obj,rho,nrho);
+  INVECTOR(irho_obj,irho,nirho);
+  if (shape_obj != Py_None) INVECTOR(shape_obj,shape,nshape);
+  if (partial_obj != Py_None) OUTVECTOR(partial_obj,partial,npartial);
+  INVECTOR(calc_Q_obj,calc_Q,ncalc_Q);
+  if (calc_R_obj != Py_None) OUTVECTOR(calc_R_obj,calc_R,ncalc_R);
+  else ncalc_R = ncalc_Q;
+  INVECTOR(Q_obj,Q,nQ);
+  INVECTOR(dQ_obj,dQ,ndQ);
+  INVECTOR(R_obj,R,nR);
+  INVECTOR(dR_obj,dR,ndR);
+  if (theory_obj != Py_None) OUTVECTOR(theory_obj,theory,ntheory);
+  if (resid_obj != Py_None) OUTVECTOR(resid_obj,resid,nresid);
+
+  // rho and irho may hold several profiles, but only the first is used
+  if (nd < 1 || nd != nsigma+1 || nrho < nd || nirho < nd
+      || (shape != NULL && nshape != nsigma)) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "d,rho,irho,sigma,shape have different lengths");
+#endif
+    FREE_VECTORS();
+    return NULL;
+  }
+  if (split > 0 && (partial == NULL || npartial != 4*ncalc_Q || split >= nd)) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "partial must have 4*len(calc_Q) values and split must be less than len(d)");
+#endif
+    FREE_VECTORS();
+    return NULL;
+  }
+  if (!check_beam_vectors(ncalc_Q, ncalc_R, nQ, ndQ, nR, ndR,
+                          theory, ntheory, resid, nresid)) {
+    FREE_VECTORS();
+    return NULL;
+  }
+  chisq = reflectivity_chisq((int)nd, d, sigma, shape, rho, irho,
+                             split, update, partial, promote,
+                             (int)ncalc_Q, calc_Q, calc_R,
+                             back_absorption, back_reflectivity,
+                             (int)nQ, Q, dQ, R, dR, intensity, background,
+                             theory, resid);
+  FREE_VECTORS();
+  return Py_BuildValue("d", chisq);
+}
+
 PyObject* Pconvolve(PyObject *obj, PyObject *args)
 {
   PyObject *xi_obj,*yi_obj,*x_obj,*dx_obj,*y_obj;
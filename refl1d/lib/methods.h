@@ -98,6 +98,7 @@
 //PyObject* pyvector(int n, double v[]);
 
 PyObject* Preflectivity_amplitude(PyObject*obj,PyObject*args);
+PyObject* Pset_blocked_kernel(PyObject*obj,PyObject*args);
 PyObject* Pmagnetic_amplitude(PyObject* obj, PyObject* args);
 PyObject* Pcalculate_u1_u3(PyObject* obj, PyObject* args);
 PyObject* Palign_magnetic(PyObject *obj, PyObject *args);
@@ -105,4 +106,6 @@ PyObject* Pcontract_by_step(PyObject*obj,PyObject*args);
 PyObject* Pcontract_by_area(PyObject*obj,PyObject*args);
 PyObject* Pcontract_mag(PyObject*obj,PyObject*args);
 PyObject* Pconvolve(PyObject*obj,PyObject*args);
+PyObject* Pbeam_chisq(PyObject*obj,PyObject*args);
+PyObject* Preflectivity_chisq(PyObject*obj,PyObject*args);
 PyObject* Pconvolve_sampled(PyObject*obj,PyObject*args);
@@ -115,14 +115,59 @@ Q of a given step size in order to reach 0.001 on a gaussian of width dQ
 #endif
 
 
+// Interface shape codes for reflectivity_amplitude; shape may be NULL
+// for gaussian roughness on all interfaces.
+#define ERF_INTERFACE 0
+#define TANH_INTERFACE 1
+#define LINEAR_INTERFACE 2
+// atanh(erf(1/sqrt(2))), the 1-sigma equivalent width scale for tanh
+#define TANH_C 0.8341339329929067
+
 void
 reflectivity_amplitude(const int layers,
                        const double d[], const double sigma[],
+                       const int shape[],
                        const double rho[], const double irho[],
                        const int points,
                        const double kz[], const int rho_offset[],
                        Cplx r[]);
 
+void
+reflectivity_amplitude_split(const int layers,
+                             const double d[], const double sigma[],
+                             const int shape[],
+                             const double rho[], const double irho[],
+                             const int points,
+                             const double kz[], const int rho_offset[],
+                             const int split, const int update,
+                             Cplx partial[], const double promote,
+                             Cplx r[]);
+
+int
+set_blocked_kernel(const int enable);
+
+double
+beam_chisq(const int n, const double calc_Q[], const double calc_R[],
+           const double back_absorption, const int back_reflectivity,
+           const int points, const double Q[], const double dQ[],
+           const double R[], const double dR[],
+           const double intensity, const double background,
+           double theory[], double resid[]);
+
+double
+reflectivity_chisq(const int layers,
+                   const double d[], const double sigma[],
+                   const int shape[],
+                   const double rho[], const double irho[],
+                   const int split, const int update, Cplx partial[],
+                   const double promote,
+                   const int n, const double calc_Q[], double calc_R[],
+                   const double back_absorption, const int back_reflectivity,
+                   const int points, const double Q[], const double dQ[],
+                   const double R[], const double dR[],
+                   const double intensity, const double background,
+                   double theory[], double resid[]);
+
 void
 magnetic_amplitude(const int layers,
                    const double d[], const double sigma[],
@@ -5,58 +5,129 @@
  */
 #include <iostream>
 #include <complex>
+#include <vector>
 #include "reflcalc.h"
 
-// Abeles matrix reflectivity calculation
+#ifndef M_PI
+#define M_PI 3.141592653589793
+#endif
+
+// Roughness factor for the Fresnel coefficient between wavevectors k and
+// k_next across an interface of the given shape and width.
+//
+// ERF_INTERFACE: Nevot-Croce factor for a gaussian interface with rms
+//   roughness sigma,
+//       exp(-2 k k_next sigma^2)
+// TANH_INTERFACE: exact result for the tanh profile (1+tanh(C z/sigma))/2
+//   with C = atanh(erf(1/sqrt(2))) so that sigma is the 1-sigma equivalent
+//   width [Epstein 1930, Landau & Lifshitz QM sec. 25],
+//       sinhc(pi s (k-k_next)) / sinhc(pi s (k+k_next)), s = sigma/(2C)
+// LINEAR_INTERFACE: Nevot-Croce style factor from the characteristic
+//   function of the boxcar of full width sigma,
+//       sinc(sqrt(k k_next) sigma)
+static inline Cplx
+roughness(const int shape, const Cplx& k, const Cplx& k_next, const double sigma)
+{
+  if (sigma == 0.) return 1.;
+  switch (shape) {
+  case TANH_INTERFACE: {
+    const double s = M_PI*sigma/(2.*TANH_C);
+    const Cplx a = s*(k-k_next), b = s*(k+k_next);
+    if (std::abs(b) < 1e-8) return 1.;
+    // Since Re(b) >= |Re(a)|, all exponents have non-positive real part.
+    const Cplx denom = 1. - exp(-2.*b);
+    if (std::abs(a) < 1e-8) return 2.*b*exp(-b)/denom;
+    return (exp(a-b) - exp(-a-b))/denom * (b/a);
+  }
+  case LINEAR_INTERFACE: {
+    const Cplx x = sqrt(k*k_next)*sigma;
+    return std::abs(x) < 1e-8 ? Cplx(1.) : sin(x)/x;
+  }
+  default:
+    return exp(-2.*k*k_next*sigma*sigma);
+  }
+}
+
+// Points with |kz| below the cutoff are totally reflected.
+static const double KZ_CUTOFF = 1e-10;
+
+// Append the transfer matrix M to the accumulated product B, with the
+// matrices stored as {B11, B12, B21, B22}.
+static inline void
+extend(Cplx B[4], const Cplx M[4])
+{
+  // We have unrolled the matrix multiply for speed.
+  Cplx C1, C2;
+  C1 = B[0]*M[0] + B[2]*M[1];
+  C2 = B[0]*M[2] + B[2]*M[3];
+  B[0] = C1;
+  B[2] = C2;
+  C1 = B[1]*M[0] + B[3]*M[1];
+  C2 = B[1]*M[2] + B[3]*M[3];
+  B[1] = C1;
+  B[3] = C2;
+}
+
+// Abeles matrix product for the interfaces lo to hi-1, in the direction
+// of travel for kz.  For positive kz the beam enters through layer 0 and
+// the product runs up from layer lo, and for negative kz it enters
+// through the last layer and the product runs down from layer hi.  The
+// reflectivity of the whole stack is B12/B11 for lo=0, hi=layers-1.
 static void
-refl(const int layers,
-     const double kz,
-     const double depth[],
-     const double sigma[],
-     const double rho[],
-     const double irho[],
-     Cplx& R)
+refl_range(const int layers,
+           const double kz,
+           const int lo,
+           const int hi,
+           const double depth[],
+           const double sigma[],
+           const int shape[],
+           const double rho[],
+           const double irho[],
+           Cplx B[4])
 {
   const Cplx J(0,1);
 
-  // Check that Q is not too close to zero.
+  B[0] = B[3] = 1;
+  B[1] = B[2] = 0;
+  if (lo >= hi) return;
+
   // For negative Q, reverse the layers.
-  const double cutoff = 1e-10;
-  int next,step;
-  if (kz >= cutoff) {
-    next=0;
+  int next, step, incident;
+  if (kz > 0.) {
+    next=lo;
     step=1;
-  } else if (kz <= -cutoff) {
-    next=layers-1;
+    incident=0;
+  } else {
+    next=hi;
     step=-1;
+    incident=layers-1;
     sigma -= 1;
-  } else {
-    R = -1.;
-    return;
+    if (shape != NULL) shape -= 1;
   }
 
   // Since sqrt(1/4 * x) = sqrt(x)/2, I'm going to pull the 1/2 into the
   // sqrt to save a multiplication later.
   const double pi4=12.566370614359172e-6;        // 1e-6 * 4 pi
-  const double kz_sq = kz*kz + pi4*rho[next];    // kz^2 + 4 pi Vrho
-  Cplx k(fabs(kz));
+  const double kz_sq = kz*kz + pi4*rho[incident];    // kz^2 + 4 pi Vrho
+  Cplx k = (next == incident ? Cplx(fabs(kz))
+            : sqrt(kz_sq - pi4*Cplx(rho[next],irho[next])));
 
-  Cplx B11, B12, B21, B22;
-  B11 = B22 = 1;
-  B12 = B21 = 0;
 #if 0
   std::cout << "kz: " << kz << std::endl;
 #endif
-  for (int i=0; i < layers-1; i++) {
+  for (int i=lo; i < hi; i++) {
     // The loop index is not the layer number because we may be reversing
-    // the stack.  Instead, n is set to the incident layer (which may be
-    // first or last) and incremented or decremented each time through.
+    // the stack.  Instead, next is set to the first layer in the direction
+    // of travel and incremented or decremented each time through.
     const Cplx k_next = sqrt(kz_sq - pi4*Cplx(rho[next+step],irho[next+step]));
-    const Cplx F = (k-k_next)/(k+k_next)*exp(-2.*k*k_next*sigma[next]*sigma[next]);
-    const Cplx M11 = (i>0 ? exp(J*k*depth[next]) : 1);
-    const Cplx M22 = (i>0 ? exp(-J*k*depth[next]) : 1);
-    const Cplx M21 = F*M11;
-    const Cplx M12 = F*M22;
+    const Cplx F = (k-k_next)/(k+k_next)*(shape == NULL
+        ? exp(-2.*k*k_next*sigma[next]*sigma[next])
+        : roughness(shape[next], k, k_next, sigma[next]));
+    Cplx M[4];
+    M[0] = (next != incident ? exp(J*k*depth[next]) : 1);
+    M[3] = (next != incident ? exp(-J*k*depth[next]) : 1);
+    M[2] = F*M[0];
+    M[1] = F*M[3];
 
 #if 0
     std::cout << next
@@ -66,31 +137,336 @@ refl(const int layers,
         << std::endl;
 #endif
     // Multiply existing layers B by new layer M
-    // We have unrolled the matrix multiply for speed.
-    Cplx C1, C2;
-    C1 = B11*M11 + B21*M12;
-    C2 = B11*M21 + B21*M22;
-    B11 = C1;
-    B21 = C2;
-    C1 = B12*M11 + B22*M12;
-    C2 = B12*M21 + B22*M22;
-    B12 = C1;
-    B22 = C2;
+    extend(B, M);
     next += step;
     k = k_next;
   }
+}
+
+// Number of kz values processed in lockstep by refl_block.
+#define KZ_BLOCK 8
 
+// Build AVX-512 and AVX2 versions of the blocked kernel along with the
+// baseline version, with the best one for the processor selected when
+// the module is loaded.
+#if defined(__GNUC__) && !defined(__clang__) && __GNUC__ >= 6 \
+    && defined(__x86_64__) && defined(__linux__)
+#define KZ_TARGETS __attribute__((target_clones("arch=skylake-avx512", \
+                                                "arch=haswell", "default")))
+#else
+#define KZ_TARGETS
+#endif
 
-  // And we are done.
-  R = B12/B11;
+// Complex square root sqrt(ar + i ai) in real arithmetic, using the same
+// cancellation-free form as std::sqrt, with the branch cut on the negative
+// real axis.
+template <typename T>
+static inline void
+csqrt_parts(const T ar, const T ai, T& zr, T& zi)
+{
+  const T t = std::sqrt(T(0.5)*(std::sqrt(ar*ar + ai*ai) + std::fabs(ar)));
+  const T u = (t > T(0) ? T(0.5)*ai/t : T(0));
+  zr = (ar >= T(0) ? t : std::fabs(u));
+  zi = (ar >= T(0) ? u : std::copysign(t, ai));
 }
 
+// Abeles matrix product for interfaces lo to hi-1 for n <= NB points
+// with gaussian interfaces, returning four values per point in B.  The kz
+// values must all be above the cutoff, or all below -cutoff, and offset[j]
+// gives the start of the profile for point j.  The calculation is done
+// with real type T, which may be float or double.
+//
+// This is the same calculation as refl_range, but with the complex values stored
+// as separate real and imaginary arrays over the block so that the loops
+// over the block vectorize.  Since exp(-i k d) = 1/exp(i k d), only one
+// complex exponential is needed per layer for the phase.
+// 1e-6 * 4 pi
+static const double PI4 = 12.566370614359172e-6;
 
+template <typename T, int NB>
+KZ_TARGETS static void
+refl_block(const int layers,
+           const int n,
+           const double kz[],
+           const int offset[],
+           const int lo,
+           const int hi,
+           const double depth[],
+           const double sigma[],
+           const double rho[],
+           const double irho[],
+           Cplx B[])
+{
+  const T pi4=T(PI4);
+  T kz_sq[NB], kr[NB], ki[NB];
+  T B11r[NB], B11i[NB], B12r[NB], B12i[NB];
+  T B21r[NB], B21i[NB], B22r[NB], B22i[NB];
+  int off[NB];
+
+  // For negative kz, reverse the layers.
+  int next, step, incident;
+  if (kz[0] > 0.) {
+    next = lo;
+    step = 1;
+    incident = 0;
+  } else {
+    next = hi;
+    step = -1;
+    incident = layers-1;
+    sigma -= 1;
+  }
+
+  // Fill unused lanes with the first point so the block is always full.
+  for (int j=0; j < NB; j++) {
+    const int src = (j < n ? j : 0);
+    const T kz_j = T(kz[src]);
+    off[j] = offset[src];
+    kz_sq[j] = kz_j*kz_j + pi4*T(rho[off[j]+incident]);
+    if (next == incident) {
+      kr[j] = std::fabs(kz_j);
+      ki[j] = T(0);
+    } else {
+      csqrt_parts(kz_sq[j] - pi4*T(rho[off[j]+next]),
+                  -pi4*T(irho[off[j]+next]), kr[j], ki[j]);
+    }
+    B11r[j] = B22r[j] = T(1);
+    B11i[j] = B22i[j] = T(0);
+    B12r[j] = B12i[j] = B21r[j] = B21i[j] = T(0);
+  }
+
+  T knr[NB], kni[NB], fr[NB], fi[NB];
+  T pr[NB], pim[NB], h[NB], phase[NB];
+  T gr[NB], gi[NB], c[NB], sn[NB];
+  for (int i=lo; i < hi; i++) {
+    const T s2 = T(-2.*sigma[next]*sigma[next]);
+    const T d = T(next != incident ? depth[next] : 0.);
+    const double irho_scale = (next != incident ? 1. : 0.);
+
+    // The transcendental functions are kept in a separate loop so that the
+    // arithmetic before and after vectorizes.
+    for (int j=0; j < NB; j++) {
+      // k_next = sqrt(kz^2 + 4 pi rho_0 - 4 pi rho_next)
+      csqrt_parts(kz_sq[j] - pi4*T(rho[off[j]+next+step]),
+                  -pi4*T(irho[off[j]+next+step]), knr[j], kni[j]);
+      // k - k_next = (k^2 - k_next^2)/(k + k_next), which avoids the
+      // cancellation in the difference at large kz, with
+      //   k^2 - k_next^2 = 4 pi (rho_next - rho) + 4 pi i (irho_next - irho)
+      const T dr = T(PI4*(rho[off[j]+next+step] - rho[off[j]+next]));
+      const T di = T(PI4*(irho[off[j]+next+step]
+                          - irho_scale*irho[off[j]+next]));
+      const T br = kr[j]+knr[j], bi = ki[j]+kni[j];
+      const T scale = T(1)/(br*br + bi*bi);
+      const T ar = (dr*br + di*bi)*scale, ai = (di*br - dr*bi)*scale;
+      // (k - k_next)/(k + k_next)
+      fr[j] = (ar*br + ai*bi)*scale;
+      fi[j] = (ai*br - ar*bi)*scale;
+      // -2 k k_next sigma^2 and i k d
+      pr[j] = s2*(kr[j]*knr[j] - ki[j]*kni[j]);
+      pim[j] = s2*(kr[j]*kni[j] + ki[j]*knr[j]);
+      h[j] = -ki[j]*d;
+      phase[j] = kr[j]*d;
+    }
+    for (int j=0; j < NB; j++) {
+      const T g = std::exp(pr[j]);
+      gr[j] = g*std::cos(pim[j]);
+      gi[j] = g*std::sin(pim[j]);
+      h[j] = std::exp(h[j]);
+      c[j] = std::cos(phase[j]);
+      sn[j] = std::sin(phase[j]);
+    }
+    for (int j=0; j < NB; j++) {
+      // F = (k - k_next)/(k + k_next) exp(-2 k k_next sigma^2)
+      const T Fr = fr[j]*gr[j] - fi[j]*gi[j];
+      const T Fi = fr[j]*gi[j] + fi[j]*gr[j];
+
+      // M11 = exp(i k d), M22 = exp(-i k d), M21 = F M11, M12 = F M22
+      const T M11r = h[j]*c[j], M11i = h[j]*sn[j];
+      const T M22r = c[j]/h[j], M22i = -sn[j]/h[j];
+      const T M21r = Fr*M11r - Fi*M11i, M21i = Fr*M11i + Fi*M11r;
+      const T M12r = Fr*M22r - Fi*M22i, M12i = Fr*M22i + Fi*M22r;
+
+      // B = B M, unrolled
+      T C1r, C1i, C2r, C2i;
+      C1r = B11r[j]*M11r - B11i[j]*M11i + B21r[j]*M12r - B21i[j]*M12i;
+      C1i = B11r[j]*M11i + B11i[j]*M11r + B21r[j]*M12i + B21i[j]*M12r;
+      C2r = B11r[j]*M21r - B11i[j]*M21i + B21r[j]*M22r - B21i[j]*M22i;
+      C2i = B11r[j]*M21i + B11i[j]*M21r + B21r[j]*M22i + B21i[j]*M22r;
+      B11r[j] = C1r; B11i[j] = C1i;
+      B21r[j] = C2r; B21i[j] = C2i;
+      C1r = B12r[j]*M11r - B12i[j]*M11i + B22r[j]*M12r - B22i[j]*M12i;
+      C1i = B12r[j]*M11i + B12i[j]*M11r + B22r[j]*M12i + B22i[j]*M12r;
+      C2r = B12r[j]*M21r - B12i[j]*M21i + B22r[j]*M22r - B22i[j]*M22i;
+      C2i = B12r[j]*M21i + B12i[j]*M21r + B22r[j]*M22i + B22i[j]*M22r;
+      B12r[j] = C1r; B12i[j] = C1i;
+      B22r[j] = C2r; B22i[j] = C2i;
+
+      kr[j] = knr[j];
+      ki[j] = kni[j];
+    }
+    next += step;
+  }
+
+  for (int j=0; j < n; j++) {
+    B[4*j] = Cplx(B11r[j], B11i[j]);
+    B[4*j+1] = Cplx(B12r[j], B12i[j]);
+    B[4*j+2] = Cplx(B21r[j], B21i[j]);
+    B[4*j+3] = Cplx(B22r[j], B22i[j]);
+  }
+}
+
+// Use the blocked kernel when possible; set with set_blocked_kernel.
+static int use_blocked_kernel = 1;
+
+extern "C" int
+set_blocked_kernel(const int enable)
+{
+  const int previous = use_blocked_kernel;
+  use_blocked_kernel = enable;
+  return previous;
+}
+
+// Reflectivity amplitude for the n <= NB points starting at start, using
+// refl_block<T,NB> if blocked is true and the points are all on the same
+// side of kz=0, or refl_range otherwise.  See amplitude for the remaining
+// arguments.
+template <typename T, int NB>
+static void
+amplitude_block(const int layers,
+                const double depth[],
+                const double sigma[],
+                const int shape[],
+                const double rho[],
+                const double irho[],
+                const int start,
+                const int n,
+                const double kz[],
+                const int rho_index[],
+                const bool blocked,
+                const int split,
+                const int update,
+                Cplx partial[],
+                Cplx r[])
+{
+  int offset[NB];
+  bool forward = true, reverse = true;
+  for (int j=0; j < n; j++) {
+    offset[j] = layers*(rho_index!=NULL ? rho_index[start+j] : 0);
+    forward = forward && kz[start+j] >= KZ_CUTOFF;
+    reverse = reverse && kz[start+j] <= -KZ_CUTOFF;
+  }
+
+  Cplx *P = (split > 0 ? partial + 4*start : NULL);
+  Cplx B[4*NB];
+  if (blocked && (forward || reverse)) {
+    if (P != NULL && update) {
+      refl_block<T,NB>(layers, n, kz+start, offset, 0, split,
+                       depth, sigma, rho, irho, P);
+    }
+    refl_block<T,NB>(layers, n, kz+start, offset, split, layers-1,
+                     depth, sigma, rho, irho, B);
+  } else {
+    // Other interface shapes, mixed directions or points near kz=0.
+    for (int j=0; j < n; j++) {
+      if (fabs(kz[start+j]) < KZ_CUTOFF) {
+        B[4*j] = B[4*j+3] = 1.;
+        B[4*j+1] = -1.;
+        B[4*j+2] = 0.;
+        if (P != NULL && update) {
+          P[4*j] = P[4*j+3] = 1.;
+          P[4*j+1] = P[4*j+2] = 0.;
+        }
+        continue;
+      }
+      if (P != NULL && update) {
+        refl_range(layers, kz[start+j], 0, split, depth, sigma, shape,
+                   rho+offset[j], irho+offset[j], P+4*j);
+      }
+      refl_range(layers, kz[start+j], split, layers-1, depth, sigma, shape,
+                 rho+offset[j], irho+offset[j], B+4*j);
+    }
+  }
+
+  for (int j=0; j < n; j++) {
+    Cplx *Bj = B+4*j;
+    if (P != NULL && fabs(kz[start+j]) >= KZ_CUTOFF) {
+      // The substrate side comes first for back reflectivity (kz > 0)
+      // and last for front reflectivity (kz < 0).
+      if (kz[start+j] > 0.) {
+        Cplx C[4] = {P[4*j], P[4*j+1], P[4*j+2], P[4*j+3]};
+        extend(C, Bj);
+        for (int m=0; m < 4; m++) Bj[m] = C[m];
+      } else {
+        extend(Bj, P+4*j);
+      }
+    }
+    r[start+j] = Bj[1]/Bj[0];
+  }
+}
+
+// Reflectivity amplitude for all points.  If split > 0, the product for
+// the interfaces 0 to split-1 on the substrate side is held in partial,
+// with four values for each point, and only the interfaces above it are
+// computed.  The partial products are computed first if update is set.
+//
+// If promote >= 0, points with |kz| >= promote are computed in single
+// precision, with twice as many points in each block.  Points closer to
+// the critical edge are computed in double precision.
+static void
+amplitude(const int layers,
+          const double depth[],
+          const double sigma[],
+          const int shape[],
+          const double rho[],
+          const double irho[],
+          const int points,
+          const double kz[],
+          const int rho_index[],
+          const int split,
+          const int update,
+          Cplx partial[],
+          const double promote,
+          Cplx r[])
+{
+  // The blocked kernel only handles gaussian interfaces.
+  bool blocked = use_blocked_kernel && layers > 1;
+  if (shape != NULL) {
+    for (int i=0; i < layers-1 && blocked; i++) {
+      if (shape[i] != ERF_INTERFACE) blocked = false;
+    }
+  }
+
+  const int chunk = 2*KZ_BLOCK;
+  const int chunks = (points + chunk - 1)/chunk;
+  #ifdef _OPENMP
+  #pragma omp parallel for
+  #endif
+  for (int b=0; b < chunks; b++) {
+    const int start = b*chunk;
+    const int n = (points-start < chunk ? points-start : chunk);
+    bool single = blocked && promote >= 0.;
+    for (int j=0; j < n && single; j++) {
+      if (fabs(kz[start+j]) < promote) single = false;
+    }
+    if (single) {
+      amplitude_block<float,2*KZ_BLOCK>(layers, depth, sigma, shape,
+          rho, irho, start, n, kz, rho_index, blocked,
+          split, update, partial, r);
+    } else {
+      for (int k=start; k < start+n; k += KZ_BLOCK) {
+        const int m = (start+n-k < KZ_BLOCK ? start+n-k : KZ_BLOCK);
+        amplitude_block<double,KZ_BLOCK>(layers, depth, sigma, shape,
+            rho, irho, k, m, kz, rho_index, blocked,
+            split, update, partial, r);
+      }
+    }
+  }
+}
 
 extern "C" void
 reflectivity_amplitude(const int    layers,
              const double depth[],
              const double sigma[],
+             const int    shape[],
              const double rho[],
              const double irho[],
              const int    points,
@@ -98,13 +474,130 @@ reflectivity_amplitude(const int    layers,
              const int    rho_index[],
              Cplx r[])
 {
-  #ifdef _OPENMP
-  #pragma omp parallel for
-  #endif
+  amplitude(layers, depth, sigma, shape, rho, irho, points, kz, rho_index,
+            0, 0, NULL, -1., r);
+}
+
+extern "C" void
+reflectivity_amplitude_split(const int    layers,
+             const double depth[],
+             const double sigma[],
+             const int    shape[],
+             const double rho[],
+             const double irho[],
+             const int    points,
+             const double kz[],
+             const int    rho_index[],
+             const int    split,
+             const int    update,
+             Cplx partial[],
+             const double promote,
+             Cplx r[])
+{
+  amplitude(layers, depth, sigma, shape, rho, irho, points, kz, rho_index,
+            split, update, partial, promote, r);
+}
+
+
+// Chi-squared for the data R +/- dR at Q +/- dQ given the reflectivity
+// calc_R at calc_Q.  This follows Probe.apply_beam: back absorption is
+// applied where calc_Q < 0, the sign of Q is reversed for back reflectivity,
+// then the gaussian resolution, intensity and background are applied.  If
+// they are not NULL, the theory and the residuals (R - theory)/dR are
+// returned in theory and resid.
+extern "C" double
+beam_chisq(const int n,
+           const double calc_Q[],
+           const double calc_R[],
+           const double back_absorption,
+           const int    back_reflectivity,
+           const int    points,
+           const double Q[],
+           const double dQ[],
+           const double R[],
+           const double dR[],
+           const double intensity,
+           const double background,
+           double theory[],
+           double resid[])
+{
+  // Same rounding as (calc_Q < 0)*(back_absorption-1)+1 in apply_beam.
+  const double back = (back_absorption - 1.) + 1.;
+  const double first = (back_reflectivity ? -calc_Q[0] : calc_Q[0]);
+  const double last = (back_reflectivity ? -calc_Q[n-1] : calc_Q[n-1]);
+  const bool reverse = (last < first);
+  std::vector<double> Qin(n), Rin(n);
+  for (int i=0; i < n; i++) {
+    const int k = (reverse ? n-1-i : i);
+    Qin[i] = (back_reflectivity ? -calc_Q[k] : calc_Q[k]);
+    Rin[i] = (calc_Q[k] < 0. ? calc_R[k]*back : calc_R[k]);
+  }
+
+  std::vector<double> work;
+  if (theory == NULL) {
+    work.resize(points);
+    theory = &work[0];
+  }
+  convolve(n, &Qin[0], &Rin[0], points, Q, dQ, theory);
+
+  double chisq = 0.;
   for (int i=0; i < points; i++) {
-    const int offset = layers*(rho_index!=NULL ? rho_index[i] : 0);
-    refl(layers, kz[i], depth, sigma, rho+offset, irho+offset, r[i]);
+    theory[i] = intensity*theory[i] + background;
+    const double ri = (R[i] - theory[i])/dR[i];
+    if (resid != NULL) resid[i] = ri;
+    chisq += ri*ri;
+  }
+  return chisq;
+}
+
+// Reflectivity amplitude, |r|^2 and beam_chisq in one call, with
+// kz = -calc_Q/2.  The arguments are as for reflectivity_amplitude_split
+// and beam_chisq.  If it is not NULL, |r|^2 is returned in calc_R so that
+// it can be used for other measurements with the same calc_Q.
+extern "C" double
+reflectivity_chisq(const int layers,
+                   const double depth[],
+                   const double sigma[],
+                   const int    shape[],
+                   const double rho[],
+                   const double irho[],
+                   const int    split,
+                   const int    update,
+                   Cplx partial[],
+                   const double promote,
+                   const int    n,
+                   const double calc_Q[],
+                   double calc_R[],
+                   const double back_absorption,
+                   const int    back_reflectivity,
+                   const int    points,
+                   const double Q[],
+                   const double dQ[],
+                   const double R[],
+                   const double dR[],
+                   const double intensity,
+                   const double background,
+                   double theory[],
+                   double resid[])
+{
+  std::vector<double> kz(n);
+  std::vector<Cplx> r(n);
+  for (int i=0; i < n; i++) kz[i] = -calc_Q[i]/2.;
+  amplitude(layers, depth, sigma, shape, rho, irho, n, &kz[0], NULL,
+            split, update, partial, promote, &r[0]);
+
+  std::vector<double> work;
+  if (calc_R == NULL) {
+    work.resize(n);
+    calc_R = &work[0];
+  }
+  for (int i=0; i < n; i++) {
+    const double a = std::abs(r[i]);
+    calc_R[i] = a*a;
   }
+  return beam_chisq(n, calc_Q, calc_R, back_absorption, back_reflectivity,
+                    points, Q, dQ, R, dR, intensity, background,
+                    theory, resid);
 }
 
 
@@ -19,6 +19,42 @@
 #include "rebin.h"
 #include "rebin2D.h"
 
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+
+PyObject* Pset_num_threads(PyObject *obj, PyObject *args)
+{
+  int n;
+
+  if (!PyArg_ParseTuple(args, "i:_set_num_threads", &n)) return NULL;
+#ifdef _OPENMP
+  omp_set_num_threads(n > 0 ? n : omp_get_num_procs());
+#endif
+  return Py_BuildValue("");
+}
+
+PyObject* Pget_num_threads(PyObject *obj, PyObject *args)
+{
+  if (!PyArg_ParseTuple(args, ":_get_num_threads")) return NULL;
+#ifdef _OPENMP
+  return Py_BuildValue("i", omp_get_max_threads());
+#else
+  return Py_BuildValue("i", 1);
+#endif
+}
+
+PyObject* Phave_openmp(PyObject *obj, PyObject *args)
+{
+  if (!PyArg_ParseTuple(args, ":_have_openmp")) return NULL;
+#ifdef _OPENMP
+  Py_RETURN_TRUE;
+#else
+  Py_RETURN_FALSE;
+#endif
+}
+
 
 template <typename T>
 PyObject* Prebin(PyObject *obj, PyObject *args)
@@ -86,7 +122,12 @@ static PyMethodDef methods[] = {
 	{"_reflectivity_amplitude",
 	 Preflectivity_amplitude,
 	 METH_VARARGS,
-	 "_reflectivity_amplitude(d,sigma,rho,irho,Q,rho_offset,R): compute reflectivity putting it into vector R of len(Q)"},
+	 "_reflectivity_amplitude(d,sigma,rho,irho,Q,rho_offset,R[,shape[,split,update,partial[,promote]]]): compute reflectivity putting it into vector R of len(Q), with optional interface shape codes; the products for the first split interfaces are held in the complex vector partial of len(4*Q), computed first if update is true; if promote >= 0, points with |Q| >= promote are computed in single precision"},
+
+	{"_set_blocked_kernel",
+	 Pset_blocked_kernel,
+	 METH_VARARGS,
+	 "_set_blocked_kernel(enable): use the kz-blocked kernel in _reflectivity_amplitude when possible, returning the previous setting"},
 
 	{"_magnetic_amplitude",
 	 Pmagnetic_amplitude,
@@ -128,6 +169,31 @@ static PyMethodDef methods[] = {
 	 METH_VARARGS,
 	 "convolve_sampled(xi,yi,xp,yp,x,dx,y): compute convolution with sampled\ndistribution of width dx[k] at points x[k], returned in y[k]"},
 
+	{"_beam_chisq",
+	 Pbeam_chisq,
+	 METH_VARARGS,
+	 "_beam_chisq(calc_Q,calc_R,back_absorption,back_reflectivity,Q,dQ,R,dR,intensity,background,theory,resid): apply back absorption, gaussian resolution, intensity and background to calc_R, returning the chi-squared for R +/- dR; theory and resid are filled if they are not None"},
+
+	{"_reflectivity_chisq",
+	 Preflectivity_chisq,
+	 METH_VARARGS,
+	 "_reflectivity_chisq(d,sigma,rho,irho,shape,split,update,partial,calc_Q,calc_R,back_absorption,back_reflectivity,Q,dQ,R,dR,intensity,background,theory,resid[,promote]): compute |r|^2 at kz=-calc_Q/2, storing it in calc_R if it is not None, then return _beam_chisq for the data"},
+
+	{"_set_num_threads",
+	 Pset_num_threads,
+	 METH_VARARGS,
+	 "_set_num_threads(n): use n OpenMP threads in the kernels, or all processors if n is 0"},
+
+	{"_get_num_threads",
+	 Pget_num_threads,
+	 METH_VARARGS,
+	 "_get_num_threads(): number of OpenMP threads used by the kernels"},
+
+	{"_have_openmp",
+	 Phave_openmp,
+	 METH_VARARGS,
+	 "_have_openmp(): True if the kernels were compiled with OpenMP"},
+
 	{"rebin_uint8",
 	 &Prebin<uint8_t>,
 	 METH_VARARGS,
@@ -567,6 +567,10 @@ class ProbeCache(object):
     def clear(self):
         self._cache = {}
 
+    def __getstate__(self):
+        # Cache keys are object ids, which are not valid in another process.
+        return {'_probe': self._probe, '_cache': {}}
+
     def __delitem__(self, material):
         if material in self._cache:
             del self._cache[material]
@@ -39,6 +39,7 @@ from bumps.parameter import (
     Parameter as Par, IntegerParameter as IntPar, Function, to_dict)
 
 from . import material
+from .interface import Interface, ERF_INTERFACE
 
 class Layer(object): # Abstract base class
     """
@@ -48,11 +49,14 @@ class Layer(object): # Abstract base class
         Thickness of the layer
     interface (Parameter: angstrom)
         Interface for the top of the layer.
+    interface_shape (Interface)
+        Non-gaussian interface profile for the top of the layer, or None.
     magnetism (Magnetism info)
         Magnetic profile anchored to the layer.
     """
     thickness = None
     interface = None
+    interface_shape = None
     name = None
 
     # Make magnetism a property so we can update the magnetism parameter
@@ -63,6 +67,7 @@ class Layer(object): # Abstract base class
         return self._magnetism
     @magnetism.setter
     def magnetism(self, magnetism):
+        _check_magnetic_interface(self.interface_shape, magnetism)
         self._magnetism = magnetism
         if magnetism: magnetism.set_layer_name(str(self))
     @property
@@ -169,12 +174,30 @@ class Layer(object): # Abstract base class
             c.thickness = Par.default(thickness, limits=(0, inf),
                                       name=self.name+" thickness")
         if interface is not None:
+            c.interface_shape = None
+            if isinstance(interface, Interface):
+                if not isinstance(c, Slab):
+                    raise TypeError("%s interface is only supported for slabs, "
+                                    "not %s" % (type(interface).__name__,
+                                                type(c).__name__))
+                _check_magnetic_interface(interface, c.magnetism)
+                c.interface_shape, interface = interface, interface.width
             c.interface = Par.default(interface, limits=(0, inf),
                                       name=self.name+" interface")
         if magnetism is not None:
             c.magnetism = magnetism
         return c
 
+def _check_magnetic_interface(interface, magnetism):
+    """
+    Magnetic models are rendered with gaussian interfaces only.
+    """
+    if (magnetism is not None and interface is not None
+            and interface.shape != ERF_INTERFACE):
+        raise NotImplementedError(
+            "only gaussian interfaces are supported in magnetic models, not %s"
+            % type(interface).__name__)
+
 def _parinit(p, v):
     """
     If v is a parameter use v, otherwise use p but with value v.
@@ -697,6 +720,12 @@ _material_stacker()
 class Slab(Layer):
     """
     A block of material.
+
+    *interface* is the rms roughness of the top of the slab, or an
+    :class:`refl1d.interface.Interface` such as *Tanh(5)* or *Linear(10)*
+    for a non-gaussian interface.  These are computed analytically in
+    the reflectivity calculation, without expanding the interface into
+    microslabs.
     """
     def __init__(self, material=None, thickness=0, interface=0, name=None,
                  magnetism=None):
@@ -704,6 +733,8 @@ class Slab(Layer):
             name = material.name
         self.name = name
         self.material = material
+        if isinstance(interface, Interface):
+            self.interface_shape, interface = interface, interface.width
         self.thickness = Par.default(thickness, limits=(0, inf),
                                      name=name+" thickness")
         self.interface = Par.default(interface, limits=(0, inf),
@@ -716,12 +747,16 @@ class Slab(Layer):
     def render(self, probe, slabs):
         rho, irho = self.material.sld(probe)
         w = self.thickness.value
-        sigma = self.interface.value
+        if self.interface_shape is None:
+            sigma, shape = self.interface.value, 0
+        else:
+            sigma = self.interface_shape.kernel_width()
+            shape = self.interface_shape.shape
         #print "rho", rho
         #print "irho", irho
         #print "w", w
         #print "sigma", sigma
-        slabs.append(rho=rho, irho=irho, w=w, sigma=sigma)
+        slabs.append(rho=rho, irho=irho, w=w, sigma=sigma, shape=shape)
 
     def __str__(self):
         return self.name
@@ -739,6 +774,7 @@ class Slab(Layer):
             'name': self.name,
             'thickness': self.thickness,
             'interface': self.interface,
+            'interface_shape': self.interface_shape,
             'material': self.material,
             'magnetism': self.magnetism,
         })
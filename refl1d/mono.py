@@ -94,8 +94,9 @@ class FreeLayer(Layer):
     def render(self, probe, slabs):
         below = self.below.sld(probe)
         above = self.above.sld(probe)
-        Pw, Pz = slabs.microslabs(self.thickness.value)
-        Prho, Pirho = self.profile(Pz, below, above)
+        Pw, _, (Prho, Pirho) = slabs.adaptive_microslabs(
+            self.thickness.value, lambda z: self.profile(z, below, above),
+            pointwise=True)
         slabs.extend(rho=[Prho], irho=[Pirho], w=Pw)
 
 def inflections(dx, dy):
@@ -177,8 +178,8 @@ class FreeInterface(Layer):
         below_rho, below_irho = self.below.sld(probe)
         above_rho, above_irho = self.above.sld(probe)
         # Pz is the center, Pw is the width
-        Pw, Pz = slabs.microslabs(thickness)
-        profile = self.profile(Pz)
+        Pw, _, profile = slabs.adaptive_microslabs(thickness, self.profile,
+                                                   pointwise=True)
         Pw, profile = util.merge_ends(Pw, profile, tol=1e-3)
         Prho = (1-profile)*below_rho + profile*above_rho
         Pirho = (1-profile)*below_irho + profile*above_irho
@@ -248,8 +249,8 @@ class _FreeInterfaceW(Layer):
         thickness = z[-1]
         if p[-1] == 0: p[-1] = 1
         p /= p[-1]
-        Pw, Pz = slabs.microslabs(z[-1])
-        profile = monospline(z, p, Pz)
+        Pw, _, profile = slabs.adaptive_microslabs(
+            z[-1], lambda t: monospline(z, p, t), pointwise=True)
         Pw, profile = util.merge_ends(Pw, profile, tol=1e-3)
         Prho = (1-profile)*below_rho + profile*above_rho
         Pirho = (1-profile)*below_irho + profile*above_irho
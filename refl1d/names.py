@@ -28,7 +28,7 @@ from .polymer import (PolymerBrush, PolymerMushroom, EndTetheredPolymer,
                       VolumeProfile, layer_thickness)
 from .mono import FreeLayer, FreeInterface
 from .cheby import FreeformCheby, ChebyVF, cheby_approx, cheby_points
-from .interface import Erf
+from .interface import Erf, Tanh, Linear
 from .probe import (Probe, ProbeSet, XrayProbe, NeutronProbe, QProbe,
                     PolarizedNeutronProbe, PolarizedQProbe, load4)
 from .stajconvert import load_mlayer, save_mlayer
@@ -57,6 +57,7 @@ import os
 
 from bumps.data import parse_file
 
+from . import datacache
 from .instrument import Monochromatic
 from .probe import PolarizedNeutronProbe
 from .reflectivity import BASE_GUIDE_ANGLE
@@ -173,7 +174,7 @@ def parse_ncnr_file(filename):
     Slit geometry is set to the default from the instrument if it is not
     available in the reduced file.
     """
-    header, data = parse_file(filename)
+    header, data = datacache.parse(parse_file, filename)
 
     # Fill in instrument parameters, if not available from the file
     if 'instrument' in header and header['instrument'] in INSTRUMENTS:
@@ -52,6 +52,9 @@ __all__ = ["PolymerBrush", "PolymerMushroom", "EndTetheredPolymer",
            "VolumeProfile", "layer_thickness"]
 
 import inspect
+import os
+import hashlib
+from collections import OrderedDict
 
 import numpy as np
 
@@ -60,13 +63,6 @@ from .model import Layer
 from . import util
 from time import time
 
-try:
-    from collections import OrderedDict
-except ImportError:
-    class OrderedDict(dict):
-        def popitem(self, *args, **kw):
-            return dict.popitem(self, *args)
-
 from numpy import real, imag, exp, log, sqrt, pi, hstack, ones_like
 
 # This is okay to use as long as LAMBDA_ARRAY is symmetric,
@@ -207,7 +203,7 @@ class PolymerBrush(Layer):
         except Exception:
             pass
 
-        vf = self.profile(Pz)
+        Pw, _, vf = slabs.adaptive_microslabs(thickness, self.profile)
         Pw, vf = util.merge_ends(Pw, vf, tol=1e-3)
         P = M*vf + S*(1-vf)
         Pr, Pi = real(P), imag(P)
@@ -331,13 +327,16 @@ class VolumeProfile(Layer):
             return
         kw = dict((k, getattr(self, k).value) for k in self._parameters)
         #print(kw)
-        phi = self.profile(Pz, **kw)
-        try:
-            if phi.shape != Pz.shape:
-                raise Exception
-        except Exception:
-            raise TypeError("profile function '%s' did not return array phi(z)"
-                            %self.profile.__name__)
+        def profile(z):
+            phi = self.profile(z, **kw)
+            try:
+                if phi.shape != z.shape:
+                    raise Exception
+            except Exception:
+                raise TypeError("profile function '%s' did not return array phi(z)"
+                                %self.profile.__name__)
+            return phi
+        Pw, _, phi = slabs.adaptive_microslabs(self.thickness.value, profile)
         Pw, phi = util.merge_ends(Pw, phi, tol=1e-3)
         P = M*phi + S*(1-phi)
         slabs.extend(rho=[real(P)], irho=[imag(P)], w=Pw)
@@ -451,7 +450,7 @@ class PolymerMushroom(Layer):
         except:
             pass
 
-        phi = self.profile(Pz)
+        Pw, _, phi = slabs.adaptive_microslabs(thickness, self.profile)
         Pw, phi = util.merge_ends(Pw, phi, tol=1e-3)
         P = M*phi + S*(1-phi)
         Pr, Pi = np.real(P), np.imag(P)
@@ -644,7 +643,7 @@ class EndTetheredPolymer(Layer):
         except:
             pass
 
-        phi = self.profile(Pz)
+        Pw, _, phi = slabs.adaptive_microslabs(thickness, self.profile)
         Pw, phi = util.merge_ends(Pw, phi, tol=1e-3)
         P = M*phi + S*(1-phi)
         Pr, Pi = np.real(P), np.imag(P)
@@ -700,10 +699,17 @@ _SCFcache_dict = OrderedDict()
 
 
 def SCFcache(chi, chi_s, pdi, sigma, phi_b, segments, disp=False,
-             cache=_SCFcache_dict):
+             cache=_SCFcache_dict, store=None, precondition=False):
     """Return a memoized SCF result by walking from a previous solution.
 
     Using an OrderedDict because I want to prune keys FIFO
+
+    If *store* is an :class:`SCFstore` then the solutions saved on disk by
+    this and other processes are also searched for the starting point of the
+    walk, and the new solution is added to the store.  The default store is
+    set by :func:`use_SCFstore`; use *store=False* for memory only.
+
+    *precondition* is passed to :func:`SCFsolve`.
     """
     from scipy.optimize.nonlin import NoConvergence
     # prime the cache with a known easy solutions
@@ -743,6 +749,25 @@ def SCFcache(chi, chi_s, pdi, sigma, phi_b, segments, disp=False,
 
     phi = cache[closest_cp] = cache.pop(closest_cp)
 
+    # A stored solution from another process may be closer than any of ours
+    if store is None:
+        store = _default_SCFstore()
+    elif store is False:
+        store = None
+    if store is not None:
+        nearest = store.nearest(p_array)
+        if nearest is not None:
+            stored_cp, stored_phi = nearest
+            stored_delta = p_array - stored_cp
+            if np.sum(stored_delta**2) < np.sum(closest_delta**2):
+                if disp:
+                    print('SCFstore hit at:', stored_cp)
+                closest_cp = tuple(stored_cp)
+                closest_cp_array, closest_delta = stored_cp, stored_delta
+                phi = cache[closest_cp] = stored_phi
+                if not stored_delta.any():
+                    return phi
+
     if disp:
         print("Walking from nearest:", closest_cp_array)
         print("to:", p_array)
@@ -785,7 +810,8 @@ def SCFcache(chi, chi_s, pdi, sigma, phi_b, segments, disp=False,
 
         try:
             phi = SCFsolve(p_tup[0], p_tup[1] / 3, p_tup[2] + 1, p_tup[3], p_tup[4],
-                           p_tup[5] * 500, disp=disp, phi0=phi)
+                           p_tup[5] * 500, disp=disp, phi0=phi,
+                           precondition=precondition)
         except (NoConvergence, ValueError) as e:
             if isinstance(e, ValueError):
                 if str(e) != "array must not contain infs or NaNs":
@@ -805,6 +831,9 @@ def SCFcache(chi, chi_s, pdi, sigma, phi_b, segments, disp=False,
     if disp:
         print('SCFcache execution time:', round(time()-starttime, 3), "s")
 
+    if store is not None:
+        store.save(p_array, phi)
+
     # keep the cache from consuming all things
     while len(cache) > 100:
         cache.popitem(last=False)
@@ -812,8 +841,167 @@ def SCFcache(chi, chi_s, pdi, sigma, phi_b, segments, disp=False,
     return phi
 
 
+# Number of scaled parameters identifying an SCF solution
+_SCF_NPARS = 6
+_SCF_STORE_KEY = 'REFL1D_SCF_STORE'
+_SCFstore_setting = []
+
+
+def use_SCFstore(path=None, max_entries=10000):
+    """
+    Set the default on-disk store for :func:`SCFcache`.
+
+    Solutions are saved in the directory *path*, which can be shared between
+    fit workers and between fits.  If *path* is None, the directory given
+    by the environment variable REFL1D_SCF_STORE is used, or the store is
+    disabled if it is not set.  The number of saved solutions is limited
+    to *max_entries*.
+
+    Returns the store, or None if it is disabled.
+    """
+    if path is None:
+        path = os.environ.get(_SCF_STORE_KEY, None)
+    store = SCFstore(path, max_entries=max_entries) if path else None
+    _SCFstore_setting[:] = [store]
+    return store
+
+
+def _default_SCFstore():
+    if not _SCFstore_setting:
+        use_SCFstore()
+    return _SCFstore_setting[0]
+
+
+class SCFstore(object):
+    """
+    On-disk store of SCF solutions which is safe for concurrent access.
+
+    Each solution is saved in its own file in the directory *path* as the
+    scaled parameters used by :func:`SCFcache` followed by the volume
+    fraction profile.  Files are written under a temporary name and renamed
+    into place, so readers never see a partial solution.  The parameters
+    of the stored solutions are read through a memory map and indexed with
+    a KD-tree for nearest neighbour lookup.  The directory listing is
+    cached and read again only when the modification time of the directory
+    changes, so the index is rebuilt when another process adds or removes
+    a file.
+
+    When there are more than *max_entries* solutions, the least recently
+    used ones are removed in a batch, leaving 90% of *max_entries* so that
+    the directory is not scanned on every save.
+    """
+    def __init__(self, path, max_entries=10000):
+        self.path = path
+        self.max_entries = max_entries
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+        self._files = []
+        self._points = np.empty((0, _SCF_NPARS))
+        self._tree = None
+        self._names = []
+        self._mtime = None
+
+    def __len__(self):
+        return len(self._list())
+
+    def nearest(self, parameters):
+        """
+        Return the stored *(parameters, phi)* closest to *parameters*, or
+        None if the store is empty.
+        """
+        self._refresh()
+        if self._tree is None:
+            return None
+        _, index = self._tree.query(parameters)
+        filename = os.path.join(self.path, self._files[index])
+        try:
+            data = np.load(filename)
+            os.utime(filename, None)  # mark as recently used
+        except (IOError, OSError, ValueError):
+            # removed by another process since the index was built
+            return None
+        return data[:_SCF_NPARS], data[_SCF_NPARS:]
+
+    def save(self, parameters, phi):
+        """
+        Add solution *phi* for scaled *parameters* to the store.
+        """
+        data = np.hstack((np.asarray(parameters, 'd'), phi))
+        name = hashlib.sha1(data[:_SCF_NPARS].tobytes()).hexdigest() + '.npy'
+        current = self._mtime is not None and self._dir_mtime() == self._mtime
+        util.atomic_write(os.path.join(self.path, name),
+                          lambda fid: np.save(fid, data))
+        if current and name not in self._names:
+            # Nobody else changed the directory since it was listed, so
+            # add the new file to the listing rather than reading it again.
+            self._names = sorted(self._names + [name])
+            self._mtime = self._dir_mtime()
+        if len(self._list()) > self.max_entries:
+            self._evict()
+
+    def _dir_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def _list(self):
+        # On file systems with coarse timestamps a file added by another
+        # process in the same tick is seen after the next change; until
+        # then the store just misses that solution.
+        mtime = self._dir_mtime()
+        if mtime is None or mtime != self._mtime:
+            self._names = sorted(f for f in os.listdir(self.path)
+                                 if f.endswith('.npy'))
+            self._mtime = mtime
+        return self._names
+
+    def _refresh(self):
+        from scipy.spatial import cKDTree
+
+        names = self._list()
+        if names == self._files:
+            return
+        known = dict(zip(self._files, self._points))
+        files, points = [], []
+        for name in names:
+            point = known.get(name, None)
+            if point is None:
+                try:
+                    data = np.load(os.path.join(self.path, name), mmap_mode='r')
+                    point = np.array(data[:_SCF_NPARS])
+                except (IOError, OSError, ValueError):
+                    continue
+            files.append(name)
+            points.append(point)
+        self._files = files
+        self._points = np.array(points).reshape(-1, _SCF_NPARS)
+        self._tree = cKDTree(self._points) if files else None
+
+    def _evict(self):
+        names = self._list()
+        excess = len(names) - self.max_entries
+        if excess <= 0:
+            return
+        excess += self.max_entries//10
+        def _mtime(name):
+            try:
+                return os.path.getmtime(os.path.join(self.path, name))
+            except OSError:
+                return -np.inf
+        for name in sorted(names, key=_mtime)[:excess]:
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except OSError:
+                pass  # already removed by another process
+        self._mtime = None
+
+
 def SCFsolve(chi=0, chi_s=0, pdi=1, sigma=None, phi_b=0, segments=None,
-             disp=False, phi0=None, maxiter=30):
+             disp=False, phi0=None, maxiter=30, precondition=False):
     """Solve SCF equations using an initial guess and lattice parameters
 
     This function finds a solution for the equations where the lattice size
@@ -821,6 +1009,12 @@ def SCFsolve(chi=0, chi_s=0, pdi=1, sigma=None, phi_b=0, segments=None,
 
     The Newton-Krylov solver really makes this one. With gmres, it was faster
     than the other solvers by quite a lot.
+
+    If *precondition* is True, the Krylov iterations are preconditioned
+    with the tridiagonal approximation to the Jacobian given by
+    :class:`SCFpreconditioner`.  This reduces the number of evaluations
+    of the SCF equations for long chains and weak interactions, but can
+    slow convergence for strongly interacting chains.
     """
 
     from scipy.optimize import newton_krylov
@@ -859,6 +1053,7 @@ def SCFsolve(chi=0, chi_s=0, pdi=1, sigma=None, phi_b=0, segments=None,
         if disp:
             print("Solving SCF equations")
 
+        inner_M = SCFpreconditioner(chi, phi0) if precondition else None
         try:
             with np.errstate(invalid='ignore'):
                 phi = abs(newton_krylov(curried_SCFeqns,
@@ -866,6 +1061,7 @@ def SCFsolve(chi=0, chi_s=0, pdi=1, sigma=None, phi_b=0, segments=None,
                                         verbose=bool(disp),
                                         maxiter=maxiter,
                                         method=jac_solve_method,
+                                        inner_M=inner_M,
                                         ))
         except RuntimeError as e:
             if str(e) == 'gmres is not re-entrant':
@@ -1024,6 +1220,50 @@ def SCFeqns(phi_z, chi, chi_s, sigma, n_avg, p_i, phi_b=0):
     return eps_z
 
 
+class SCFpreconditioner(object):
+    r"""
+    Approximate inverse Jacobian of :func:`SCFeqns` for the Krylov solver.
+
+    The SCF equations are $\epsilon = \phi - \phi'(u(\phi))$ where the
+    field $u = \log(1-\phi) + 2\chi \Lambda \phi$ is local, with
+    $\Lambda$ the tridiagonal lattice correlation.  Keeping only the
+    local response of the chain propagators, $\partial\phi'/\partial u
+    \approx \text{diag}(\phi')$, gives the tridiagonal approximation
+
+    .. math::
+
+        J \approx I + \text{diag}(\phi'/(1-\phi))
+             - 2\chi\,\text{diag}(\phi')\Lambda
+
+    which is solved in $O(n)$ operations for each Krylov iteration and
+    is refreshed by the solver after every Newton step.
+
+    The Jacobian-vector products themselves are the finite differences of
+    :func:`scipy.optimize.newton_krylov`, which has no way to accept an
+    analytic product.  An exact product would also need the tangent of
+    the forward and backward chain propagators, which costs as much as
+    the residual evaluation it replaces.
+    """
+    def __init__(self, chi, phi0):
+        self.chi = chi
+        self.shape = (len(phi0), len(phi0))
+        self.dtype = np.dtype('d')
+        self._bands = np.zeros((3, len(phi0)))
+        self._bands[1] = 1.
+
+    def update(self, phi_z, eps_z):
+        phi_z = np.minimum(abs(phi_z), .99999)
+        phi_z_new = phi_z - eps_z
+        coupling = -2*self.chi*phi_z_new
+        self._bands[0, 1:] = coupling[:-1]*LAMBDA_1
+        self._bands[1] = 1 + phi_z_new/(1 - phi_z) + coupling*LAMBDA_0
+        self._bands[2, :-1] = coupling[1:]*LAMBDA_1
+
+    def matvec(self, v):
+        from scipy.linalg import solve_banded
+        return solve_banded((1, 1), self._bands, v, check_finite=False)
+
+
 def calc_phi_z(g_z, n_avg, sigma, phi_b, u_z_avg=0, p_i=None):
     if p_i is None:
         segments = n_avg
@@ -1093,9 +1333,13 @@ class Propagator(object):
             import refl1d.calc_g_zs_cex as cex
             Propagator.cex = cex
         except ImportError:
-            import warnings
-            warnings.warn('Could not load C extension for EndTetheredPolymer. Continuing with slower NumPy code.\n'
-                          'Try rebuilding refl1d to remove this warning and speed things up!')
+            global USE_NUMBA
+            if USE_NUMBA is None:
+                USE_NUMBA = util.numba_available()
+            if not USE_NUMBA:
+                import warnings
+                warnings.warn('Could not load C extension for EndTetheredPolymer. Continuing with slower NumPy code.\n'
+                              'Try rebuilding refl1d to remove this warning and speed things up!')
             Propagator.cex = False
 
     def ta(self):
@@ -1141,6 +1385,8 @@ class Propagator(object):
     def _calc_g_zs(self, g_z, c_i, g_zs):
         if self.cex:
             self.cex._calc_g_zs(g_z, c_i, g_zs, LAMBDA_0, LAMBDA_1, *self.shape)
+        elif USE_NUMBA:
+            _calc_g_zs_numba(g_z, c_i[::-1], g_zs, LAMBDA_0, LAMBDA_1)
         else:
             pg_zs = g_zs[:, 0]
             segment_iterator = enumerate(c_i[::-1])
@@ -1151,8 +1397,34 @@ class Propagator(object):
     def _calc_g_zs_uniform(self, g_z, g_zs):
         if self.cex:
             self.cex._calc_g_zs_uniform(g_z, g_zs, LAMBDA_0, LAMBDA_1, *self.shape)
+        elif USE_NUMBA:
+            _calc_g_zs_numba(g_z, np.zeros(g_zs.shape[1]), g_zs,
+                             LAMBDA_0, LAMBDA_1)
         else:
             segments = g_zs.shape[1]
             pg_zs = g_zs[:, 0]
             for r in range(1, segments):
                 g_zs[:, r] = pg_zs = correlate(pg_zs, LAMBDA_ARRAY, 1) * g_z
+
+
+
+# Whether the numba propagator is used when the C extension is not
+# available; None until checked by the first Propagator.
+USE_NUMBA = None
+
+# Fallback propagator when the C extension is not available.  Same as
+# _calc_g_zs in calc_g_zs_cex.c, with the segment constants c in order
+# of segment rather than reversed.
+@util.lazy_njit
+def _calc_g_zs_numba(g_z, c, g_zs, f0, f1):
+    layers, segments = g_zs.shape
+    for r in range(1, segments):
+        if layers == 1:
+            g_zs[0, r] = (f0*g_zs[0, r-1] + c[r])*g_z[0]
+            continue
+        g_zs[0, r] = (f0*g_zs[0, r-1] + f1*g_zs[1, r-1] + c[r])*g_z[0]
+        for z in range(1, layers-1):
+            g_zs[z, r] = (f1*(g_zs[z-1, r-1] + g_zs[z+1, r-1])
+                          + f0*g_zs[z, r-1] + c[r])*g_z[z]
+        z = layers-1
+        g_zs[z, r] = (f1*g_zs[z-1, r-1] + f0*g_zs[z, r-1] + c[r])*g_z[z]
@@ -40,6 +40,11 @@ from __future__ import with_statement, division, print_function
 
 import os
 import json
+import errno
+import atexit
+import shutil
+import hashlib
+import tempfile
 import warnings
 
 import numpy as np
@@ -53,12 +58,16 @@ from bumps.plotutil import coordinated_colors, auto_shift
 from bumps.data import parse_multi, strip_quotes
 
 from . import fresnel
+from . import datacache
 from .material import Vacuum
 from .resolution import QL2T, QT2L, TL2Q, dQdL2dT, dQdT2dLoL, dTdL2dQ
 from .resolution import sigma2FWHM, FWHM2sigma, dQ_broadening
 from .stitch import stitch
 from .reflectivity import convolve, BASE_GUIDE_ANGLE
-from .util import asbytes
+from .util import asbytes, atomic_write
+
+# Relative difference below which calculation points are merged.
+CALC_Q_TOLERANCE = 1e-10
 
 PROBE_KW = ('T', 'dT', 'L', 'dL', 'data', 'name', 'filename',
             'intensity', 'background', 'back_absorption', 'sample_broadening',
@@ -171,6 +180,7 @@ class Probe(object):
     """
     polarized = False
     Aguide = BASE_GUIDE_ANGLE  # default guide field for unpolarized measurements
+    calc_tolerance = CALC_Q_TOLERANCE
     view = "log"
     plot_shift = 0
     residuals_shift = 0
@@ -366,7 +376,9 @@ class Probe(object):
     def _set_calc(self, T, L):
         Q = TL2Q(T=T, L=L)
 
-        idx = np.argsort(Q)
+        # Sort by Q, keeping one of each set of points within calc_tolerance
+        idx, start = _merge_order(Q, self.calc_tolerance)
+        idx = idx[start]
         self.calc_T = T[idx]
         self.calc_L = L[idx]
         self.calc_Qo = Q[idx]
@@ -375,6 +387,43 @@ class Probe(object):
         self.unique_L = np.unique(self.calc_L)
         self._L_idx = np.searchsorted(self.unique_L, L)
 
+    def share_memory(self, path=None):
+        """
+        Move the probe arrays into memory mapped files.
+
+        The measurement and calculation points are written to a private
+        directory of this process under *path* (default /dev/shm if it
+        exists, otherwise the system temporary directory) and replaced by
+        read-only memory maps.  When the probe is pickled for a worker
+        process on the same machine, only the file names are sent, and the
+        worker maps the same pages as the parent.  The directory is removed
+        when this process exits, so it must outlive its workers.  Directories
+        left by processes which were killed are removed on the next call.
+
+        Call this after any data manipulation such as :meth:`oversample`
+        since the shared arrays cannot be modified in place.  Arrays which
+        are later replaced are pickled as usual.
+        """
+        _share_arrays(self, _SHARED_ATTRS, path)
+
+    def __getstate__(self):
+        # Arrays derived from the measurement are rebuilt when the probe is
+        # loaded so that process pool and MPI workers receive the data once.
+        state = self.__dict__.copy()
+        _detach_shared(state)
+        if (self.__dict__.get('T', None) is not None and 'Qo' in state
+                and np.array_equal(self.Qo, TL2Q(T=self.T, L=self.L))):
+            del state['Qo']
+        _compact_calc(self, state)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        _attach_shared(self)
+        if 'Qo' not in self.__dict__:
+            self.Qo = TL2Q(T=self.T, L=self.L)
+        _restore_calc(self)
+
     @property
     def Q(self):
         if self.theta_offset.value != 0:
@@ -1060,7 +1109,11 @@ class ProbeSet(Probe):
 
     @property
     def calc_Q(self):
-        return np.unique(np.hstack([p.calc_Q for p in self.probes]))
+        # Segments often overlap, so merge the points they have in common
+        # and evaluate the kernel once for each.  Every segment applies its
+        # resolution to the merged set.
+        calc_Q = np.hstack([p.calc_Q for p in self.probes])
+        return merge_points(calc_Q, self.calc_tolerance)[0]
 
     @property
     def dQ(self):
@@ -1075,6 +1128,29 @@ class ProbeSet(Probe):
             p.oversample(**kw)
     oversample.__doc__ = Probe.oversample.__doc__
 
+    def share_memory(self, path=None):
+        for p in self.probes:
+            p.share_memory(path)
+        _share_arrays(self, ('R', 'dR'), path)
+    share_memory.__doc__ = Probe.share_memory.__doc__
+
+    def __getstate__(self):
+        # R and dR are copies of the data in the individual probes
+        state = self.__dict__.copy()
+        _detach_shared(state)
+        for k in ('R', 'dR'):
+            if k in state and np.array_equal(
+                    state[k], np.hstack([getattr(p, k) for p in self.probes])):
+                del state[k]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        _attach_shared(self)
+        for k in ('R', 'dR'):
+            if k not in self.__dict__:
+                setattr(self, k, np.hstack([getattr(p, k) for p in self.probes]))
+
     def scattering_factors(self, material, density):
         # TODO: support wavelength dependent systems
         return self.probes[0].scattering_factors(material, density)
@@ -1248,6 +1324,9 @@ def load4(filename, keysep=":", sep=None, comment="#", name=None,
     individual data lines.  The parser isn't very sophisticated, so
     be nice.
 
+    The parsed file is saved in the data cache if it is enabled; see
+    :mod:`refl1d.datacache`.
+
     *intensity* is the overall beam intensity, *background* is the
     overall background level, and *back_absorption* is the relative
     intensity of data measured at negative Q compared to positive Q
@@ -1324,7 +1403,8 @@ def load4(filename, keysep=":", sep=None, comment="#", name=None,
     *resolution* is 'normal' (default) or 'uniform'. Use uniform if you
     are merging Q points from a finely stepped energy sensitive measurement.
     """
-    entries = parse_multi(filename, keysep=keysep, sep=sep, comment=comment)
+    entries = datacache.parse(parse_multi, filename,
+                              keysep=keysep, sep=sep, comment=comment)
     if columns:
         actual = columns.split()
         natural = "Q R dR dQ".split()
@@ -1552,6 +1632,184 @@ class QProbe(Probe):
         self.calc_Qo = np.sort(calc_Q)
     critical_edge.__doc__ = Probe.critical_edge.__doc__
 
+# Probe arrays which are moved to memory mapped files by share_memory.
+_SHARED_ATTRS = ('T', 'dT', 'L', 'dL', 'Qo', 'dQo', 'R', 'dR',
+                 'calc_T', 'calc_L', 'calc_Qo', 'unique_L', '_L_idx')
+# Private directories created by this process, {base: (pid, directory)}.
+# Only the creating process writes to or removes them; workers only open
+# the files.  The pid guards against forked children removing the
+# directory of their parent when they exit.
+_SHARED_DIRS = {}
+_SHARED_PREFIX = 'refl1d-shm-'
+
+def _shared_dir(path=None):
+    """
+    Return the private directory of this process for shared arrays under
+    *path*, creating it on first use and removing directories left behind
+    by processes which no longer exist.
+    """
+    if path is None:
+        path = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    base = os.path.abspath(path)
+    pid = os.getpid()
+    owner, directory = _SHARED_DIRS.get(base, (None, None))
+    if owner != pid or not os.path.isdir(directory):
+        _remove_stale_dirs(base)
+        directory = tempfile.mkdtemp(prefix='%s%d-'%(_SHARED_PREFIX, pid),
+                                     dir=base)
+        _SHARED_DIRS[base] = (pid, directory)
+    return directory
+
+def _remove_stale_dirs(base):
+    # Process ids can only be checked without side effects on posix;
+    # os.kill(pid, 0) terminates the process on windows.
+    if os.name != 'posix':
+        return
+    try:
+        names = os.listdir(base)
+    except OSError:
+        return
+    for name in names:
+        if not name.startswith(_SHARED_PREFIX):
+            continue
+        try:
+            pid = int(name[len(_SHARED_PREFIX):].split('-', 1)[0])
+        except ValueError:
+            continue
+        if not _pid_exists(pid):
+            shutil.rmtree(os.path.join(base, name), ignore_errors=True)
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        # EPERM: the process exists but belongs to another user
+        return exc.errno == errno.EPERM
+    return True
+
+def _share_arrays(obj, attrs, path=None):
+    """
+    Replace arrays *attrs* of *obj* with read-only memory maps of files in
+    the private directory of this process under *path*.  Files are named by
+    content, so identical arrays share a file.
+    """
+    directory = None
+    shared = dict(obj.__dict__.get('_shared', {}))
+    for k in attrs:
+        value = obj.__dict__.get(k, None)
+        if (not isinstance(value, np.ndarray) or value.dtype.hasobject
+                or _is_shared(value, shared.get(k, None))):
+            continue
+        if directory is None:
+            directory = _shared_dir(path)
+        value = np.ascontiguousarray(value)
+        digest = hashlib.sha1(asbytes(value.dtype.str + str(value.shape)))
+        digest.update(value.tobytes())
+        filename = os.path.join(directory, '%s.npy'%digest.hexdigest())
+        if not os.path.exists(filename):
+            atomic_write(filename, lambda fid: np.save(fid, value))
+        setattr(obj, k, np.load(filename, mmap_mode='r'))
+        shared[k] = filename
+    obj._shared = shared
+
+def _is_shared(value, filename):
+    return (filename is not None and isinstance(value, np.memmap)
+            and value.filename == filename)
+
+def _detach_shared(state):
+    """
+    Replace the shared arrays in the pickle *state* by their file names.
+    """
+    if '_shared' not in state:
+        return
+    state['_shared'] = dict((k, filename)
+                            for k, filename in state['_shared'].items()
+                            if _is_shared(state.get(k, None), filename))
+    for k in state['_shared']:
+        del state[k]
+
+def _attach_shared(obj):
+    """
+    Map the shared arrays named in *obj._shared* after unpickling.
+    """
+    for k, filename in obj.__dict__.get('_shared', {}).items():
+        if not os.path.exists(filename):
+            raise IOError(
+                "shared probe array %r is missing; the process which called "
+                "share_memory() must run until its workers are done"
+                % filename)
+        setattr(obj, k, np.load(filename, mmap_mode='r'))
+
+@atexit.register
+def _remove_shared_dirs():
+    pid = os.getpid()
+    for base, (owner, directory) in list(_SHARED_DIRS.items()):
+        if owner == pid:
+            shutil.rmtree(directory, ignore_errors=True)
+            del _SHARED_DIRS[base]
+
+def _compact_calc(probe, state):
+    """
+    Remove the calculation points from the pickle *state* of *probe* if
+    they can be restored from the measurement points by
+    :func:`_restore_calc`.  Shared arrays are not in *state* and are left
+    alone.
+    """
+    if any(k not in state for k in ('calc_T', 'calc_L', 'calc_Qo')):
+        return
+    if not np.array_equal(state['calc_Qo'],
+                          TL2Q(T=state['calc_T'], L=state['calc_L'])):
+        return
+    del state['calc_Qo']
+    state.pop('unique_L', None)
+    T, L = probe.__dict__.get('T', None), probe.__dict__.get('L', None)
+    if (T is not None and np.array_equal(state['calc_T'], T)
+            and np.array_equal(state['calc_L'], L)):
+        del state['calc_T'], state['calc_L']
+        state['_calc_T_is_T'] = True
+
+def _restore_calc(probe):
+    """
+    Rebuild the calculation points removed by :func:`_compact_calc`.
+    """
+    if probe.__dict__.pop('_calc_T_is_T', False):
+        probe.calc_T, probe.calc_L = probe.T.copy(), probe.L.copy()
+    if 'calc_T' not in probe.__dict__ or 'calc_Qo' in probe.__dict__:
+        return
+    # calc_T, calc_L are already sorted by Q
+    probe.calc_Qo = TL2Q(T=probe.calc_T, L=probe.calc_L)
+    if 'unique_L' not in probe.__dict__:
+        probe.unique_L = np.unique(probe.calc_L)
+
+def merge_points(Q, tolerance=CALC_Q_TOLERANCE):
+    """
+    Merge points which are the same to within a relative *tolerance*.
+
+    Returns the sorted merged points *Qm* and an index array with
+    *Q[i]* approximately *Qm[index[i]]*, so that values computed once at
+    each merged point can be returned to the original points as
+    *values[index]*.  Sorted points are merged with the previous point if
+    they differ by no more than *tolerance* times their magnitude; the
+    merged value is the smallest in each group.  With *tolerance=0* this
+    is :func:`numpy.unique` with *return_inverse=True*.
+    """
+    Q = np.asarray(Q, 'd')
+    order, start = _merge_order(Q, tolerance)
+    index = np.empty(len(Q), 'i')
+    index[order] = np.cumsum(start) - 1
+    return Q[order[start]], index
+
+def _merge_order(Q, tolerance):
+    """
+    Return the order sorting *Q* and a mask of the sorted points which
+    start a new group for :func:`merge_points`.
+    """
+    order = np.argsort(Q, kind='mergesort')
+    Qs = Q[order]
+    start = np.ones(len(Qs), bool)
+    start[1:] = (Qs[1:] - Qs[:-1]) > tolerance*abs(Qs[1:])
+    return order, start
+
 def measurement_union(xs):
     """
     Determine the unique (T, dT, L, dL) across all datasets.
@@ -1604,6 +1862,7 @@ class PolarizedNeutronProbe(object):
     show_resolution = None  # Default to Probe.show_resolution when None
     substrate = surface = None
     polarized = True
+    calc_tolerance = CALC_Q_TOLERANCE
     def __init__(self, xs=None, name=None, Aguide=BASE_GUIDE_ANGLE, H=0):
         self._xs = xs
 
@@ -1735,7 +1994,10 @@ class PolarizedNeutronProbe(object):
         # TODO: shouldn't clone code from probe
         Q = TL2Q(T=T, L=L)
 
-        idx = np.argsort(Q)
+        # Cross sections measured at the same angles with different
+        # resolution give repeated points in the union, so merge them.
+        idx, start = _merge_order(Q, self.calc_tolerance)
+        idx = idx[start]
         self.calc_T = T[idx]
         self.calc_L = L[idx]
         self.calc_Qo = Q[idx]
@@ -1744,6 +2006,37 @@ class PolarizedNeutronProbe(object):
         self.unique_L = np.unique(self.calc_L)
         self._L_idx = np.searchsorted(self.unique_L, L)
 
+    def share_memory(self, path=None):
+        for xs in self.xs:
+            if xs is not None:
+                xs.share_memory(path)
+        _share_arrays(self, _SHARED_ATTRS + ('Q', 'dQ'), path)
+    share_memory.__doc__ = Probe.share_memory.__doc__
+
+    _UNION = ('T', 'dT', 'L', 'dL', 'Q', 'dQ')
+    def __getstate__(self):
+        # The measurement union and calculation points are rebuilt from
+        # the cross sections when the probe is loaded.
+        state = self.__dict__.copy()
+        _detach_shared(state)
+        _compact_calc(self, state)
+        if all(k in state for k in self._UNION):
+            union = measurement_union(self.xs)
+            if all(np.array_equal(state[k], v)
+                   for k, v in zip(self._UNION, union)):
+                for k in self._UNION:
+                    del state[k]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        _attach_shared(self)
+        if 'Q' not in self.__dict__:
+            union = measurement_union(self.xs)
+            for k, v in zip(self._UNION, union):
+                setattr(self, k, v)
+        _restore_calc(self)
+
     def apply_beam(self, Q, R, resolution=True, interpolation=0):
         """
         Apply factors such as beam intensity, background, backabsorption,
@@ -1960,7 +2253,7 @@ class PolarizedQProbe(PolarizedNeutronProbe):
                                         limits=[-360, 360])
         self.H = Parameter.default(H, name="H "+self.name)
         self.Q, self.dQ = Qmeasurement_union(xs)
-        self.calc_Qo = self.Q
+        self.calc_Qo = merge_points(self.Q, self.calc_tolerance)[0]
 
 # Deprecated old long name
 PolarizedNeutronQProbe = PolarizedQProbe
@@ -64,6 +64,18 @@ from numpy import inf, nan, isnan
 from scipy.special import erf
 
 from .reflectivity import BASE_GUIDE_ANGLE as DEFAULT_THETA_M
+from .interface import Tanh, TANH_INTERFACE, LINEAR_INTERFACE
+
+# Number of slabs for a layer before refining pointwise profiles.
+_REFINE_START = 16
+
+def _merge_points(z, values, znew, vnew):
+    """
+    Merge sorted points *z* with *znew*, and columns *values* with *vnew*.
+    """
+    order = np.argsort(np.hstack((z, znew)), kind='mergesort')
+    return (np.hstack((z, znew))[order],
+            np.hstack((values, vnew))[:, order])
 
 class Microslabs(object):
     """
@@ -84,7 +96,7 @@ class Microslabs(object):
 
     def __init__(self, nprobe, dz=1):
         self._num_slabs = 0
-        # _slabs contains the 1D objects w, sigma of len n
+        # _slabs contains the 1D objects w, sigma, interface shape of len n
         # _slabs_rho contains 2D objects rho, irho, with one for each wavelength
         # rhoM, thetaM will contain magnetic moment and angle
         self._slabs = np.empty(shape=(0, 2))
@@ -93,6 +105,7 @@ class Microslabs(object):
         self.thetaM = None  # type: np.ndarray
         self._slabs_mag = np.empty(shape=(0, nprobe, 2))
         self.dz = dz
+        self.dA = None
         self._magnetic_sections = []
         self._z_left = self._z_right = 0.
         self._z_offset = 0.
@@ -125,6 +138,112 @@ class Microslabs(object):
         widths = edges[1:] - edges[:-1]
         return widths, centers
 
+    def adaptive_microslabs(self, thickness, profile, pointwise=False):
+        """
+        Return variable width microslabs for a layer of the given *thickness*.
+
+        The profile function may return a vector or a sequence of vectors,
+        such as (rho, irho), and may be complex.  Slab widths are chosen so
+        that the area of the box containing the profile variation within
+        each slab is about *slabs.dA*, the same condition used to contract
+        the profile.  Slabs are about *slabs.dz* or thicker, so steep regions
+        keep the uniform slicing while flat regions are covered by a few
+        thick slabs.
+
+        If *pointwise* is True, *profile* can be evaluated at any set of
+        increasing points in [0, *thickness*].  The layer is then cut into
+        a few slabs which are split in half while the profile at their
+        edges and center varies by more than the area condition allows, so
+        the profile is only evaluated where it changes.  Otherwise *profile*
+        is evaluated at the centers of the uniform microslabs returned by
+        :meth:`microslabs`, as needed by profiles which are smoothed on
+        the grid, and the local gradient and curvature are used to choose
+        the slab widths, with profile values interpolated from the uniform
+        samples.
+
+        If *slabs.dA* is not set, the uniform microslabs are returned.
+
+        :Parameters:
+            *thickness* : float | A
+                Layer thickness
+            *profile* : function
+                Profile function *profile(z)* for *z* in [0, *thickness*]
+            *pointwise* : bool
+                True if *profile* does not depend on the uniform grid
+        :Returns:
+            *widths*: vector | A
+                Microslab widths
+            *centers*: vector | A
+                Microslab centers
+            *values*: vector or array
+                Profile at the microslab centers, with one row for each
+                vector returned by the profile function.
+        """
+        if pointwise and self.dA and thickness >= 3*self.dz:
+            return self._refine_microslabs(thickness, profile)
+        Pw, Pz = self.microslabs(thickness)
+        values = np.asarray(profile(Pz))
+        if not self.dA or len(Pw) < 3:
+            return Pw, Pz, values
+
+        # Slab width h such that slope*h^2 or curvature*h^3/8 is dA.
+        rows = values.reshape(-1, len(Pz))
+        slope = np.gradient(rows, Pz, axis=-1)
+        curvature = np.gradient(slope, Pz, axis=-1)
+        slope = np.max(abs(slope), axis=0)
+        curvature = np.max(abs(curvature), axis=0)
+        with np.errstate(divide='ignore'):
+            h = np.minimum(np.sqrt(self.dA/slope),
+                           np.cbrt(8*self.dA/curvature))
+        h = np.clip(h, self.dz, max(thickness, self.dz))
+
+        # Place the slab edges at equal steps in the cumulative slab count.
+        edges = np.hstack((0., np.cumsum(Pw)))
+        count = np.hstack((0., np.cumsum(Pw/h)))
+        n = max(int(np.ceil(count[-1] - 1e-6)), 1)
+        edges = np.interp(np.linspace(0, count[-1], n+1), count, edges)
+        widths = np.diff(edges)
+        centers = (edges[1:] + edges[:-1])/2
+        rows = np.array([np.interp(centers, Pz, r) for r in rows])
+        return widths, centers, rows.reshape(values.shape[:-1] + (n,))
+
+    def _refine_microslabs(self, thickness, profile):
+        """
+        Adaptive microslabs from :meth:`adaptive_microslabs` evaluating a
+        pointwise *profile* only at the slab edges and centers.
+        """
+        def evaluate(z):
+            return np.asarray(profile(z))
+        n = int(min(_REFINE_START, thickness//self.dz))
+        edges = np.linspace(0., thickness, n+1)
+        at_edges = evaluate(edges)
+        shape = at_edges.shape[:-1]
+        at_edges = at_edges.reshape(-1, n+1)
+        centers = (edges[1:] + edges[:-1])/2
+        at_centers = evaluate(centers).reshape(-1, n)
+        while True:
+            widths = np.diff(edges)
+            # Box containing the profile at the edges and the center.
+            lo, hi = at_edges[:, :-1], at_edges[:, 1:]
+            spread = np.max(np.maximum(np.maximum(abs(hi - lo),
+                                                  abs(at_centers - lo)),
+                                       abs(at_centers - hi)), axis=0)
+            # Halves are at least dz/sqrt(2) wide.
+            split = (widths*spread > self.dA) & (widths >= np.sqrt(2)*self.dz)
+            if not split.any():
+                break
+            # The centers of the split slabs become edges, and the profile
+            # is evaluated at the centers of the two halves.
+            quarter = widths[split]/4
+            halves = np.vstack((centers[split] - quarter,
+                                centers[split] + quarter)).T.flatten()
+            at_halves = evaluate(halves).reshape(len(at_edges), -1)
+            edges, at_edges = _merge_points(
+                edges, at_edges, centers[split], at_centers[:, split])
+            centers, at_centers = _merge_points(
+                centers[~split], at_centers[:, ~split], halves, at_halves)
+        return widths, centers, at_centers.reshape(shape + (len(centers),))
+
     def clear(self):
         """
         Reset the slab model so that none are present.
@@ -132,6 +251,16 @@ class Microslabs(object):
         self._num_slabs = 0
         self._magnetic_sections = []
 
+    def __getstate__(self):
+        # The slab buffers are scratch space for rendering, so only keep
+        # the settings.
+        return self._slabs_rho.shape[1], self.dz, self.dA
+
+    def __setstate__(self, state):
+        nprobe, dz, dA = state
+        self.__init__(nprobe, dz=dz)
+        self.dA = dA
+
     def __len__(self):
         return self._num_slabs
 
@@ -158,6 +287,7 @@ class Microslabs(object):
 
         # Replace interface on the top
         self._slabs[self._num_slabs - 1, 1] = interface
+        self._slabs[self._num_slabs - 1, 2] = 0
 
         if self._magnetic_sections:
             raise NotImplementedError("Repeated magnetic layers not implemented")
@@ -174,9 +304,13 @@ class Microslabs(object):
             self._slabs_rho = self._slabs_rho.copy()
             self._slabs_rho.resize((new_ns, nl, 2))
 
-    def extend(self, w=0, sigma=0, rho=0, irho=0):
+    def extend(self, w=0, sigma=0, rho=0, irho=0, shape=0):
         """
         Extend the micro slab model with the given layers.
+
+        *shape* is the interface shape code for the top of each layer,
+        such as *refl1d.reflectivity.TANH_INTERFACE*.  The default is
+        a gaussian interface.
         """
         nadd = len(w)
         self._reserve(nadd)
@@ -184,10 +318,11 @@ class Microslabs(object):
         self._num_slabs += nadd
         self._slabs[idx, 0] = w
         self._slabs[idx, 1] = sigma
+        self._slabs[idx, 2] = shape
         self._slabs_rho[idx, :, 0] = np.asarray(rho).T
         self._slabs_rho[idx, :, 1] = np.asarray(irho).T
 
-    def append(self, w=0, sigma=0, rho=0, irho=0):
+    def append(self, w=0, sigma=0, rho=0, irho=0, shape=0):
         """
         Extend the micro slab model with a single layer.
         """
@@ -196,6 +331,7 @@ class Microslabs(object):
         self._reserve(1)
         self._slabs[self._num_slabs, 0] = w
         self._slabs[self._num_slabs, 1] = sigma
+        self._slabs[self._num_slabs, 2] = shape
         self._slabs_rho[self._num_slabs, :, 0] = rho
         self._slabs_rho[self._num_slabs, :, 1] = irho
         self._num_slabs += 1
@@ -234,6 +370,12 @@ class Microslabs(object):
         "rms roughness (A)"
         return self._slabs[:self._num_slabs - 1, 1]
 
+    @property
+    def interface_shape(self):
+        "interface shape codes, or None if all interfaces are gaussian"
+        shape = self._slabs[:self._num_slabs - 1, 2]
+        return shape.astype('i') if shape.any() else None
+
     @property
     def surface_sigma(self):
         "roughness for the current top layer, or nan if substrate"
@@ -298,6 +440,9 @@ class Microslabs(object):
         be merged.
         """
         if self.ismagnetic:
+            if self.interface_shape is not None:
+                raise NotImplementedError(
+                    "only gaussian interfaces are supported in magnetic models")
             self._align_magnetic_and_nuclear()
 
         self._set_z_range()
@@ -369,16 +514,17 @@ class Microslabs(object):
         n_profiles = self.rho.shape[0]
         offsets = np.cumsum(self.w[:-1])  # assumes w[0] == 0 in _set_z_range
 
-        # generate profiles
-        rho = np.empty((n_profiles, n_slabs), 'd')
-        irho = np.empty((n_profiles, n_slabs), 'd')
-        for k in range(n_profiles):
-            # Gd support: cycle through wavelength dependent rho/irho
-            rho[k] = build_profile(z, offsets, self.sigma, self.rho[k])
-            irho[k] = build_profile(z, offsets, self.sigma, self.irho[k])
+        # generate profiles for all columns at once, including the
+        # wavelength dependent rho/irho for Gd support
+        columns = [self.rho, self.irho]
+        if self.ismagnetic:
+            columns.extend([[self.rhoM], [self.thetaM]])
+        profiles = build_profile(z, offsets, self.sigma, np.vstack(columns),
+                                 shape=self.interface_shape)
+        rho = profiles[:n_profiles]
+        irho = profiles[n_profiles:2*n_profiles]
         if self.ismagnetic:
-            rhoM = build_profile(z, offsets, self.sigma, self.rhoM)
-            thetaM = build_profile(z, offsets, self.sigma, self.thetaM)
+            rhoM, thetaM = profiles[2*n_profiles:]
 
         w = self.dz * np.ones(n_slabs)
         w[0] = w[-1] = 0.
@@ -388,6 +534,7 @@ class Microslabs(object):
         self._num_slabs = n_slabs
         self.w[:] = w
         self.sigma[:] = 0
+        self._slabs[:n_slabs, 2] = 0
         self.rho[:,:] = rho
         self.irho[:,:] = irho
         if self.ismagnetic:
@@ -411,6 +558,11 @@ class Microslabs(object):
             np.ascontiguousarray(v, 'd')
             for v in (self.w, self.sigma, self.rho[0], self.irho[0])
             ]
+        # Contraction preserves the rough interfaces in order, so their
+        # shapes can be restored afterward.
+        shape = self.interface_shape
+        if shape is not None:
+            shape = shape[self.sigma != 0]
         #print "final sld before contract", rho[-1]
         n = _contract_by_area(w, sigma, rho, irho, dA)
         self._num_slabs = n
@@ -418,6 +570,9 @@ class Microslabs(object):
         self.rho[0, :] = rho[:n]
         self.irho[0, :] = irho[:n]
         self.sigma[:] = sigma[:n-1]
+        self._slabs[:n, 2] = 0
+        if shape is not None:
+            self._slabs[np.flatnonzero(self.sigma), 2] = shape
         #print "final sld after contract", rho[n-1], self.rho[0][n-1], n
 
     def _contract_magnetic(self, dA):
@@ -515,8 +670,9 @@ class Microslabs(object):
         """
         z = np.arange(self._z_left, self._z_right + 0.5*dz, dz)
         offsets = np.cumsum(self.w) + self._z_offset
-        irho = build_profile(z, offsets, self.sigma, self.irho[0])
-        rho = build_profile(z, offsets, self.sigma, self.rho[0])
+        rho, irho = build_profile(z, offsets, self.sigma,
+                                  [self.rho[0], self.irho[0]],
+                                  shape=self.interface_shape)
         return z, rho, irho
 
     def magnetic_smooth_profile(self, dz=0.1):
@@ -525,10 +681,9 @@ class Microslabs(object):
         """
         z = np.arange(self._z_left, self._z_right + 0.5*dz, dz)
         offsets = np.cumsum(self.w) + self._z_offset
-        irho = build_profile(z, offsets, self.sigma, self.irho[0])
-        rho = build_profile(z, offsets, self.sigma, self.rho[0])
-        rhoM = build_profile(z, offsets, self.sigma, self.rhoM)
-        thetaM = build_profile(z, offsets, self.sigma, self.thetaM)
+        rho, irho, rhoM, thetaM = build_profile(
+            z, offsets, self.sigma,
+            [self.rho[0], self.irho[0], self.rhoM, self.thetaM])
         return z, rho, irho, rhoM, thetaM
 
     def _join_magnetic_sections(self, gap_size):
@@ -612,22 +767,72 @@ def compute_limited_sigma(thickness, roughness, limit):
     return roughness
 
 
-def build_profile(z, offset, roughness, value):
+def build_profile(z, offset, roughness, value, window=6, shape=None):
     """
     Convert a step profile to a smooth profile.
 
-    *z*          calculation points
+    *z*          calculation points, in increasing order
     *offset*     offset for each interface
     *roughness*  roughness of each interface
-    *value*      target value for each slab
-    *max_rough*  limit the roughness to a fraction of the layer thickness
+    *value*      target value for each slab, or an array with one row of
+                 slab values for each profile
+    *window*     blend width in units of roughness
+    *shape*      interface shape code for each interface, or None for
+                 gaussian interfaces throughout
+
+    Each interface is blended over *window* times its roughness on either
+    side, and is treated as a sharp step beyond that.  The blend
+    function is evaluated once and shared between all rows of *value*,
+    so rho, irho, rhoM and thetaM can be computed in one call.
+
+    Returns a vector of len(*z*), or an array with a row for each row of
+    *value*.
     """
-    contrast = np.diff(value)
-    result = np.zeros_like(z) + value[0]
-    for offset_k, sigma_k, contrast_k in zip(offset, roughness, contrast):
-        delta = contrast_k * blend(z, sigma_k, offset_k)
-        result += delta
-    return result
+    z = np.asarray(z, 'd')
+    value = np.asarray(value, 'd')
+    rows = value.reshape(-1, value.shape[-1])
+    n = min(len(offset), len(roughness), rows.shape[1]-1)
+    offset = np.asarray(offset, 'd')[:n]
+    sigma = np.maximum(np.asarray(roughness, 'd')[:n], 0.)
+    contrast = np.diff(rows[:, :n+1], axis=1)
+
+    # Start of the constant region above each interface, and start of the
+    # blended region below it.  Sharp interfaces have an empty window.
+    # The tanh tail decays more slowly than erf, and linear interfaces
+    # are only width sigma.
+    half = window*sigma
+    if shape is not None:
+        shape = np.asarray(shape)[:n]
+        half = np.where(shape == TANH_INTERFACE, 2*half, half)
+        half = np.where(shape == LINEAR_INTERFACE, sigma/2, half)
+    hi = np.searchsorted(z, offset + half)
+    lo = np.minimum(np.searchsorted(z, offset - half), hi)
+
+    # Accumulate the full step for all points above each window.
+    steps = np.zeros((rows.shape[0], len(z)+1))
+    for k, row in enumerate(contrast):
+        steps[k] = np.bincount(hi, weights=row, minlength=len(z)+1)
+    result = np.cumsum(steps[:, :-1], axis=1) + rows[:, :1]
+
+    # Add the partial step for the points within each window.
+    size = hi - lo
+    if size.sum() > 0:
+        interface = np.repeat(np.arange(n), size)
+        start = np.cumsum(size) - size
+        index = np.arange(len(interface)) - start[interface] + lo[interface]
+        x = (z[index] - offset[interface])/sigma[interface]
+        partial = 0.5*erf(SQRT1_2*x) + 0.5
+        if shape is not None:
+            code = shape[interface]
+            tanh = code == TANH_INTERFACE
+            partial[tanh] = 0.5*np.tanh(Tanh.C*x[tanh]) + 0.5
+            linear = code == LINEAR_INTERFACE
+            partial[linear] = np.clip(x[linear] + 0.5, 0, 1)
+        for k, row in enumerate(contrast):
+            result[k] += np.bincount(index, weights=partial*row[interface],
+                                     minlength=len(z))
+
+    return result.reshape(value.shape[:-1] + z.shape)
 
 
 SQRT1_2 = 1. / np.sqrt(2.0)
@@ -18,19 +18,96 @@ __author__ = "Paul Kienzle"
 __all__ = ['reflectivity', 'reflectivity_amplitude',
            'magnetic_reflectivity', 'magnetic_amplitude',
            'unpolarized_magnetic', 'convolve',
+           'set_num_threads', 'get_num_threads', 'IncrementalAmplitude',
+           'promote_kz', 'DenseAmplitude', 'reflectivity_chisq',
           ]
 
+import os
+import sys
+
 import numpy as np
 from numpy import pi, sin, cos, conj, radians
+
+from .util import lazy_njit
+from . import backend
 # delay load so doc build doesn't require compilation
 #from . import reflmodule
 
 BASE_GUIDE_ANGLE = 270.0
 
+# Interface shape codes for reflectivity_amplitude
+from .interface import ERF_INTERFACE, TANH_INTERFACE, LINEAR_INTERFACE
+
 def _dense(x, dtype='d'):
     return np.ascontiguousarray(x, dtype)
 
 
+_NUM_THREADS_KEY = 'REFL1D_NUM_THREADS'
+# Environment variables giving the number of MPI ranks for common MPI
+# implementations (Open MPI, MPICH/Intel MPI, MVAPICH).
+_MPI_SIZE_KEYS = ('OMPI_COMM_WORLD_SIZE', 'PMI_SIZE', 'MV2_COMM_WORLD_SIZE')
+# [pid, n] from the last call to set_num_threads
+_thread_request = [None, None]
+# pid of the process for which the kernel threads were configured
+_thread_pid = [None]
+
+def set_num_threads(n=None):
+    """
+    Set the number of OpenMP threads used by the reflectivity kernels.
+
+    *n* is the number of threads, or 0 for one per processor.  If *n* is
+    None, the number is taken from the environment variable
+    REFL1D_NUM_THREADS if it is set.  Otherwise the kernels use one thread
+    per processor, except in the worker processes of a parallel fit, where
+    they use one thread.  Workers are detected as multiprocessing pool
+    processes or MPI jobs with more than one rank.
+
+    The setting applies to the current process only.  Worker processes
+    started later make their own choice, so a thread count set for
+    plotting in the parent process does not oversubscribe the processors
+    during a parallel fit.
+
+    The kernels are single threaded if refl1d was built without OpenMP.
+    """
+    _thread_request[:] = [os.getpid(), n]
+    _thread_pid[0] = None
+
+def get_num_threads():
+    """
+    Return the number of OpenMP threads used by the reflectivity kernels.
+    """
+    return _kernels()._get_num_threads()
+
+def _num_threads():
+    pid, n = _thread_request
+    if pid == os.getpid() and n is not None:
+        return n
+    if os.environ.get(_NUM_THREADS_KEY, ''):
+        return int(os.environ[_NUM_THREADS_KEY])
+    return 1 if _in_parallel_worker() else 0
+
+def _in_parallel_worker():
+    # Pool workers have multiprocessing loaded; don't import it otherwise.
+    if 'multiprocessing' in sys.modules:
+        import multiprocessing
+        if multiprocessing.current_process().name != 'MainProcess':
+            return True
+    return any(int(os.environ.get(key, '1')) > 1 for key in _MPI_SIZE_KEYS)
+
+def _kernels():
+    """
+    Return the reflmodule extension, with the thread count set for the
+    current process.
+    """
+    from . import reflmodule
+
+    pid = os.getpid()
+    if _thread_pid[0] != pid:
+        reflmodule._set_num_threads(_num_threads())
+        _thread_pid[0] = pid
+    return reflmodule
+
+
 def reflectivity(*args, **kw):
     """
     Calculate reflectivity $|r(k_z)|^2$ from slab model.
@@ -68,6 +145,8 @@ def reflectivity_amplitude(kz=None,
                            irho=0,
                            sigma=0,
                            rho_index=None,
+                           shape=None,
+                           precision='double',
                           ):
     r"""
     Calculate reflectivity amplitude $r(k_z)$ from slab model.
@@ -89,6 +168,19 @@ def reflectivity_amplitude(kz=None,
             Points at which to evaluate the reflectivity
         *rho_index* = 0 : integer[M]
             *rho* and *irho* columns to use for the various kz.
+        *shape* = None : integer[N-1]
+            Interface profile for each interface, or None if all interfaces
+            are gaussian.  Use *ERF_INTERFACE* for a gaussian interface with
+            rms roughness *sigma* using the Nevot-Croce approximation,
+            *TANH_INTERFACE* for a tanh interface with 1-\ $\sigma$ equivalent
+            width *sigma* using the exact result for a single interface,
+            or *LINEAR_INTERFACE* for a linear gradient of full width *sigma*
+            using the Nevot-Croce style approximation.  See
+            :mod:`refl1d.interface` for details.
+        *precision* = 'double' : string
+            Use 'single' to compute the matrix products in single precision
+            for points with $|k_z|$ above twice the critical edge.  See
+            :func:`promote_kz`.  This requires the C backend.
 
     :Returns:
         *r* | complex[M]
@@ -96,8 +188,45 @@ def reflectivity_amplitude(kz=None,
 
     This function does not compute any instrument resolution corrections.
     """
-    from . import reflmodule
+    kz, depth, rho, irho, sigma, rho_index, shape = _amplitude_args(
+        kz, depth, rho, irho, sigma, rho_index, shape)
+    promote = promote_kz(rho, precision)
+    if promote < 0:
+        return backend.evaluate('amplitude', kz, depth, rho, irho, sigma,
+                                rho_index, shape)
+    r = np.empty(kz.shape, 'D')
+    _kernels()._reflectivity_amplitude(depth, sigma, rho, irho, kz,
+                                       rho_index, r, shape,
+                                       0, 0, None, promote)
+    return r
 
+# Points with |kz| below this multiple of the critical edge are computed in
+# double precision when precision='single'.  Below the edge the waves are
+# evanescent and the single precision products overflow.
+_PROMOTE_KC = 2.
+
+def promote_kz(rho, precision='double'):
+    r"""
+    Return the $|k_z|$ above which the reflectivity can be computed in
+    single precision, or -1 if all points need double precision.
+
+    *rho* is the array of scattering length densities for the layers, with
+    one row per column of :func:`reflectivity_amplitude`.  For
+    *precision='single'* this is twice the largest critical edge
+    $k_c = \sqrt{4\pi(\rho_{\rm max}-\rho_{\rm incident})}$, using the
+    smaller of the two end layers as the incident medium.  For
+    *precision='double'* it is -1.
+    """
+    if precision == 'double':
+        return -1.
+    elif precision != 'single':
+        raise ValueError("precision should be 'double' or 'single'")
+    rho = np.asarray(rho).reshape(-1, np.shape(rho)[-1])
+    incident = np.minimum(rho[:, 0], rho[:, -1])
+    contrast = max((rho.max(axis=1) - incident).max(), 0.)
+    return _PROMOTE_KC*np.sqrt(4e-6*pi*contrast)
+
+def _amplitude_args(kz, depth, rho, irho, sigma, rho_index, shape):
     kz = _dense(kz, 'd')
     if rho_index is None:
         rho_index = np.zeros(kz.shape, 'i')
@@ -115,17 +244,337 @@ def reflectivity_amplitude(kz=None,
     else:
         irho = _dense(irho, 'd')
 
-
-    #print(irho.shape, irho[:,0], irho[:,-1])
     irho[irho < 0] = 0.
-    #print depth.shape, rho.shape, irho.shape, sigma.shape
-    #print depth.dtype, rho.dtype, irho.dtype, sigma.dtype
-    r = np.empty(kz.shape, 'D')
-    #print "amplitude", depth, rho, kz, rho_index
-    #print depth.shape, sigma.shape, rho.shape, irho.shape, kz.shape
-    reflmodule._reflectivity_amplitude(depth, sigma, rho, irho, kz,
-                                       rho_index, r)
-    return r
+    if shape is not None:
+        shape = _dense(shape, 'i')
+    return kz, depth, rho, irho, sigma, rho_index, shape
+
+
+# Below this many layers, comparing the layers costs more than it saves.
+_INCREMENTAL_MIN_LAYERS = 12
+
+class IncrementalAmplitude(object):
+    """
+    Reflectivity amplitude calculator which reuses the substrate side of
+    the previous calculation.
+
+    In a typical fit only a few layers near the surface are varying, with
+    the substrate and any buried layers below them fixed.  Each call is
+    compared to the previous one, and the Abeles matrix product through
+    the unchanged layers on the substrate side is kept for each kz.  Later
+    calls in which those layers are still unchanged only compute the
+    product through the layers above them, so the cost is proportional to
+    the number of layers between the surface and the deepest layer that
+    changes.
+
+    Call with the same arguments as :func:`reflectivity_amplitude`.  The
+    results agree with :func:`reflectivity_amplitude` to within rounding
+    error.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the previous calculation.
+        """
+        self._last = None
+        self._split = 0
+        self._partial = None
+        self._precision = 'double'
+
+    def __getstate__(self):
+        # The saved products are rebuilt after unpickling.
+        return {'_last': None, '_split': 0, '_partial': None,
+                '_precision': 'double'}
+
+    def __call__(self, kz=None, depth=None, rho=None, irho=0, sigma=0,
+                 rho_index=None, shape=None, precision='double'):
+        reflmodule = _kernels()
+        args = _amplitude_args(kz, depth, rho, irho, sigma, rho_index, shape)
+        kz, depth, rho, irho, sigma, rho_index, shape = args
+        promote = promote_kz(rho, precision)
+        incremental = len(depth) >= _INCREMENTAL_MIN_LAYERS
+        if (promote < 0
+                and backend.select('amplitude', args, incremental) != 'c'):
+            # Other backends compute the whole product each time.
+            return backend.evaluate('amplitude', *args)
+        split, update = self._plan(args, precision)
+        r = np.empty(kz.shape, 'D')
+        if split or promote >= 0:
+            reflmodule._reflectivity_amplitude(depth, sigma, rho, irho, kz,
+                                               rho_index, r, shape,
+                                               split, update,
+                                               self._partial if split else None,
+                                               promote)
+        else:
+            reflmodule._reflectivity_amplitude(depth, sigma, rho, irho, kz,
+                                               rho_index, r, shape)
+        self._remember(args)
+        return r
+
+    def _plan(self, args, precision='double'):
+        """
+        Return *(split, update)* for the kernel given the arguments from
+        :func:`_amplitude_args`, with the products in *self._partial*.
+        """
+        if len(args[1]) < _INCREMENTAL_MIN_LAYERS:
+            self._last = self._partial = None
+            return 0, False
+        # Products saved at a different precision are recomputed.
+        if precision != self._precision:
+            self._precision = precision
+            self._last = None
+        # The products for the first split interfaces only depend on the
+        # layers below the split and the incident medium.
+        split = self._unchanged(args) - 1
+        if split < 1:
+            self._partial = None
+            return 0, False
+        if self._partial is None or split < self._split:
+            self._partial = np.empty(4*len(args[0]), 'D')
+            self._split = split
+            return split, True
+        return self._split, False
+
+    def _remember(self, args):
+        if len(args[1]) < _INCREMENTAL_MIN_LAYERS:
+            return
+        # Keep copies since the caller may reuse the arrays.
+        self._last = [(np.array(v) if v is not None else None) for v in args]
+
+    def _unchanged(self, args):
+        """
+        Number of layers on the substrate side which are the same as the
+        previous call, or 0 if the whole calculation must be redone.
+        """
+        if self._last is None:
+            return 0
+        kz, depth, rho, irho, sigma, rho_index, shape = args
+        last_kz, last_depth, last_rho, last_irho, last_sigma, \
+            last_rho_index, last_shape = self._last
+        layers = len(depth)
+        if (rho.shape != last_rho.shape or irho.shape != last_irho.shape
+                or depth.shape != last_depth.shape
+                or (shape is None) != (last_shape is None)
+                or not np.array_equal(kz, last_kz)
+                or not np.array_equal(rho_index, last_rho_index)):
+            return 0
+        rho, last_rho = rho.reshape(-1, layers), last_rho.reshape(-1, layers)
+        irho, last_irho = irho.reshape(-1, layers), last_irho.reshape(-1, layers)
+        # front reflectivity depends on the incident medium at the surface
+        if (rho[:, -1] != last_rho[:, -1]).any():
+            return 0
+        changed = ((depth != last_depth)
+                   | (rho != last_rho).any(axis=0)
+                   | (irho != last_irho).any(axis=0))
+        changed[1:] |= (sigma != last_sigma)
+        if shape is not None:
+            changed[1:] |= (shape != last_shape)
+        return np.argmax(changed) if changed.any() else layers
+
+
+def reflectivity_chisq(Q, depth, rho, irho=0, sigma=0, shape=None, beams=(),
+                       precision='double', incremental=None,
+                       theory=None, resid=None):
+    r"""
+    Return the chi-squared of a slab model against measured data.
+
+    The reflectivity is computed at the calculation points *Q*
+    ($k_z = -Q/2$) and taken directly to the sum of the squared residuals,
+    without the intermediate arrays of :func:`reflectivity_amplitude`
+    followed by a separate resolution calculation.  *depth*, *rho*, *irho*,
+    *sigma*, *shape* and *precision* are as for
+    :func:`reflectivity_amplitude`, with a single column of *rho*.
+
+    *beams* is a list of tuples
+
+        (Q, dQ, R, dR, intensity, background, back_absorption, back_reflectivity)
+
+    one for each measurement computed from the same calculation points.
+    The theory is the reflectivity convolved with a gaussian resolution of
+    1-\ $\sigma$ width *dQ*, scaled by *intensity* plus *background*, with
+    *back_absorption* applied when *back_reflectivity* is True.
+
+    *incremental* is an :class:`IncrementalAmplitude` which keeps the
+    substrate side of the calculation between calls.
+
+    If *theory* and *resid* arrays are given, they are filled with the
+    theory and the residuals $(R - \text{theory})/dR$ for the measurement
+    points of all the beams in order.
+    """
+    args = _amplitude_args(-_dense(Q)/2, depth, rho, irho, sigma,
+                           None, shape)
+    _, depth, rho, irho, sigma, _, shape = args
+    Q = _dense(Q)
+    promote = promote_kz(rho, precision)
+    native = promote >= 0 or backend.select(
+        'amplitude', args,
+        incremental is not None and len(depth) >= _INCREMENTAL_MIN_LAYERS) == 'c'
+    reflmodule = _kernels()
+    if native:
+        if incremental is not None:
+            split, update = incremental._plan(args, precision)
+            partial = incremental._partial if split else None
+        else:
+            split, update, partial = 0, False, None
+        # |r|^2 is kept for the remaining beams.
+        calc_R = np.empty(len(Q)) if len(beams) > 1 else None
+    else:
+        # Amplitude from another backend, then chi-squared for each beam.
+        r = backend.evaluate('amplitude', *args)
+        calc_R = _dense(abs(r)**2)
+    chisq, start = 0., 0
+    for k, (Qk, dQ, R, dR, intensity, background, back_absorption,
+            back_reflectivity) in enumerate(beams):
+        end = start + len(Qk)
+        beam = (back_absorption, bool(back_reflectivity),
+                _dense(Qk), _dense(dQ), _dense(R), _dense(dR),
+                intensity, background,
+                theory[start:end] if theory is not None else None,
+                resid[start:end] if resid is not None else None)
+        if k == 0 and native:
+            chisq += reflmodule._reflectivity_chisq(
+                depth, sigma, rho, irho, shape, split, update, partial,
+                Q, calc_R, *(beam + (promote,)))
+        else:
+            chisq += reflmodule._beam_chisq(Q, calc_R, *beam)
+        start = end
+    if native and incremental is not None:
+        incremental._remember(args)
+    return chisq
+
+
+# Table points per fringe for a sample of the given thickness.
+_DENSE_FRINGE = 48
+# Fraction of the kz range added to either side of the table.
+_DENSE_PAD = 0.05
+
+class DenseAmplitude(object):
+    r"""
+    Reflectivity amplitude interpolated from a table on a dense kz grid.
+
+    When only the sample alignment is changing, such as when fitting
+    *theta_offset* or *sample_broadening*, the sample is the same for
+    each call but the kz points move.  The amplitude is computed once on a
+    uniform grid extending a little beyond the requested points, and later
+    calls for the same sample interpolate the table with a cubic
+    polynomial.
+
+    The grid spacing is chosen from the total thickness so there are
+    several points per fringe.  The table is checked when it is built by
+    interpolating at the midpoints of the grid and comparing to the kernel.
+    Intervals in which the error relative to the local $|r|$ is above
+    *tolerance*, and the region below the critical edge where $r$ is not
+    smooth, are computed directly with :func:`reflectivity_amplitude`
+    on each call.  The midpoints are then added to the table, so the
+    interpolation error is well below *tolerance* in the remaining
+    intervals.  The table has at most *max_points* points.
+
+    Call with the new kz points, a hashable *key* identifying the sample
+    and a function *sample()* returning *(depth, rho, irho, sigma, shape)*
+    for that sample, or None if it cannot be tabulated, in which case the
+    call returns None.  *sample* is only called when the table needs to be
+    built, so the caller can avoid rendering the model if *key* has not
+    changed.  *builds* and *calls* count the tables built and the calls.
+    """
+    def __init__(self, tolerance=1e-5, max_points=1<<17):
+        self.tolerance = tolerance
+        self.max_points = max_points
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the table.
+        """
+        self._key = None
+        self._table = None
+        self.builds = self.calls = 0
+
+    def __getstate__(self):
+        # The table is rebuilt after unpickling.
+        return {'tolerance': self.tolerance, 'max_points': self.max_points,
+                '_key': None, '_table': None, 'builds': 0, 'calls': 0}
+
+    def __call__(self, kz, key, sample):
+        kz = _dense(kz, 'd')
+        self.calls += 1
+        if key != self._key:
+            self._key = key
+            self._table = self._build(kz, sample())
+        elif self._table is not None and not self._covers(kz):
+            self._table = self._build(kz, self._table['sample'])
+        if self._table is None or len(kz) == 0:
+            return None
+        return self._lookup(kz)
+
+    def _covers(self, kz):
+        x0, step, n = [self._table[k] for k in ('x0', 'step', 'n')]
+        # the cubic stencil needs one point below and two above
+        return kz.min() >= x0 + step and kz.max() <= x0 + (n-3)*step
+
+    def _build(self, kz, sample):
+        if sample is None or len(kz) == 0:
+            return None
+        self.builds += 1
+        depth, rho, irho, sigma, shape = sample
+        lo, hi = kz.min(), kz.max()
+        thickness = max(np.sum(depth[1:-1]), 10.)
+        coarse = pi/(_DENSE_FRINGE*thickness)
+        if hi > lo:
+            coarse = min(coarse, (hi - lo)/64)
+            pad = _DENSE_PAD*(hi - lo)
+            lo, hi = lo - pad, hi + pad
+        if 2*((hi - lo)/coarse + 6) > self.max_points:
+            coarse = (hi - lo)/(self.max_points//2 - 6)
+        n = int(np.ceil((hi - lo)/coarse)) + 5
+        x0 = lo - 2*coarse
+        grid = x0 + coarse*np.arange(n)
+        r = reflectivity_amplitude(np.hstack((grid, grid[:-1] + coarse/2)),
+                                   depth, rho, irho, sigma, shape=shape)
+        r_coarse, r_mid = r[:n], r[n:]
+
+        # Interpolation error at the midpoints relative to the local |r|.
+        error = abs(_cubic(r_coarse, 0.5 + np.arange(n-1)) - r_mid)
+        scale = np.maximum(np.maximum(abs(r_coarse[:-1]), abs(r_coarse[1:])),
+                           abs(r_mid))
+        bad = error > self.tolerance*np.maximum(scale, 1e-300)
+        kc = promote_kz(rho, 'single')/_PROMOTE_KC
+        bad |= (grid[:-1] < kc) & (grid[1:] > -kc)
+
+        # Merge the midpoints into the table, with the direct intervals
+        # widened so that the stencil never reaches into them.
+        table = np.empty(2*n-1, 'D')
+        table[0::2], table[1::2] = r_coarse, r_mid
+        direct = np.repeat(bad, 2)
+        direct[1:] |= direct[:-1].copy()
+        direct[:-1] |= direct[1:].copy()
+        return {'x0': x0, 'step': coarse/2, 'n': 2*n-1, 'r': table,
+                'direct': direct, 'sample': sample}
+
+    def _lookup(self, kz):
+        table = self._table
+        t = (kz - table['x0'])/table['step']
+        index = np.clip(np.floor(t).astype('i'), 1, table['n'] - 3)
+        direct = table['direct'][index]
+        r = np.empty(kz.shape, 'D')
+        r[~direct] = _cubic(table['r'], t[~direct])
+        if direct.any():
+            depth, rho, irho, sigma, shape = table['sample']
+            r[direct] = reflectivity_amplitude(kz[direct], depth, rho, irho,
+                                               sigma, shape=shape)
+        return r
+
+def _cubic(y, t):
+    """
+    Interpolate *y* sampled at integer points using the cubic through the
+    points on either side of *t*.  Points within one step of the ends use
+    the nearest full stencil.
+    """
+    i = np.clip(np.floor(t).astype('i'), 1, len(y) - 3)
+    s = t - i
+    return (-s*(s-1)*(s-2)/6*y[i-1] + (s+1)*(s-1)*(s-2)/2*y[i]
+            - (s+1)*s*(s-2)/2*y[i+1] + (s+1)*s*(s-1)/6*y[i+2])
 
 
 def magnetic_reflectivity(*args, **kw):
@@ -196,8 +645,6 @@ def magnetic_amplitude(kz,
 
     See :class:`magnetic_reflectivity <refl1d.reflectivity.magnetic_reflectivity>` for details.
     """
-    from . import reflmodule
-
     kz = _dense(kz, 'd')
     if rho_index is None:
         rho_index = np.zeros(kz.shape, 'i')
@@ -221,11 +668,8 @@ def magnetic_amplitude(kz,
 
     sld_b, u1, u3 = calculate_u1_u3(H, rhoM, thetaM, Aguide)
 
-    R1, R2, R3, R4 = [np.empty(kz.shape, 'D') for pol in (1, 2, 3, 4)]
-    reflmodule._magnetic_amplitude(depth, sigma, rho, irho,
-                                   sld_b, u1, u3, Aguide, kz, rho_index,
-                                   R1, R2, R3, R4)
-    return R1, R2, R3, R4
+    return backend.evaluate('magnetic', kz, depth, rho, irho, sigma,
+                            sld_b, u1, u3, Aguide, rho_index)
 
 def calculate_u1_u3(H, rhoM, thetaM, Aguide):
     from . import reflmodule
@@ -289,21 +733,7 @@ def calculate_u1_u3_py(H, rhoM, thetaM, Aguide):
     #print "u3", u3
     return sld_b, u1, u3
 
-try:
-    #raise ImportError() # uncomment to force numba off
-    from numba import njit
-    USE_NUMBA = True
-except ImportError:
-    USE_NUMBA = False
-    # if no numba then njit does nothing
-    def njit(*args, **kw):
-        # Check for bare @njit, in which case we just return the function.
-        if len(args) == 1 and callable(args[0]) and not kw:
-            return args[0]
-        # Otherwise we have @njit(...), so return the identity decorator.
-        return lambda fn: fn
-
-@njit('(f8[:], f8[:], f8[:], f8[:], f8[:])')
+@lazy_njit
 def _convolve_uniform(xi, yi, x, dx, y):
     root_12_over_2 = np.sqrt(3)
     left_index = 0
@@ -420,15 +850,12 @@ def convolve(xi, yi, x, dx, resolution='normal'):
     distribution uses the $1-\sigma$ equivalent distribution width which is
     $1/\sqrt{3}$ times the width of the rectangle.
     """
-    from . import reflmodule
-
     xi, yi, x, dx = _dense(xi), _dense(yi), _dense(x), _dense(dx)
-    y = np.empty_like(x)
     if resolution == 'uniform':
+        y = np.empty_like(x)
         _convolve_uniform(xi, yi, x, dx, y)
-    else:
-        reflmodule.convolve(xi, yi, x, dx, y)
-    return y
+        return y
+    return backend.evaluate('convolve', xi, yi, x, dx)
 
 
 def convolve_sampled(xi, yi, xp, yp, x, dx):
@@ -443,7 +870,7 @@ def convolve_sampled(xi, yi, xp, yp, x, dx):
     resolution *(xp, yp)* is also represented as a piece-wise linear
     spline.
     """
-    from . import reflmodule
+    reflmodule = _kernels()
 
     x = _dense(x)
     y = np.empty_like(x)
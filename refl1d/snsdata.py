@@ -19,6 +19,7 @@ import numpy as np
 
 from bumps.data import parse_file
 
+from . import datacache
 from .rebin import rebin
 from .instrument import Pulsed
 from . import resolution
@@ -127,7 +128,7 @@ def parse_sns_file(filename):
     *header* dictionary of fields such as 'data', 'title', 'instrument'
     *data* 2D array of data
     """
-    raw_header, data = parse_file(filename)
+    raw_header, data = datacache.parse(parse_file, filename)
     header = {}
 
     # guess instrument from file name
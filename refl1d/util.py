@@ -1,6 +1,9 @@
-__all__ = ["merge_ends"]
+__all__ = ["merge_ends", "lazy_njit", "atomic_write"]
 
+import os
 import sys
+import functools
+import tempfile
 
 import numpy as np
 
@@ -12,6 +15,71 @@ else:
     def asbytes(s):
         return s
 
+# CRUFT: python 2.7 does not have os.replace; rename is atomic on posix
+_replace = getattr(os, 'replace', os.rename)
+
+def atomic_write(filename, writer):
+    """
+    Write *filename* by calling *writer(fid)* on a temporary file in the
+    same directory, then moving it into place.
+
+    Readers in other processes see either the old file or the complete
+    new one, never a partial write.  The temporary file is removed if
+    *writer* fails.
+    """
+    fd, tmpfile = tempfile.mkstemp(suffix='.tmp',
+                                   dir=os.path.dirname(filename) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as fid:
+            writer(fid)
+        _replace(tmpfile, filename)
+    except Exception:
+        os.unlink(tmpfile)
+        raise
+
+def lazy_njit(fn=None, parallel=False, cache=True):
+    """
+    Decorator compiling *fn* with numba.njit on its first call.
+
+    Importing numba and compiling takes a large fraction of a second, which
+    dominates startup for short-lived worker processes, so neither happens
+    until the function is used.  The compiled code is cached on disk for
+    later processes unless *cache* is False.  If numba is not available the
+    python function is used.
+
+    Use *@lazy_njit(parallel=True)* for functions which loop over *prange*.
+    The module defining *fn* should set *prange = range* for the python
+    version; it is replaced by *numba.prange* when the function is compiled.
+    """
+    if fn is None:
+        return lambda fn: lazy_njit(fn, parallel=parallel, cache=cache)
+    compiled = []
+    @functools.wraps(fn)
+    def wrapper(*args, **kw):
+        if not compiled:
+            try:
+                #raise ImportError() # uncomment to force numba off
+                from numba import njit
+                if parallel:
+                    from numba import prange
+                    fn.__globals__['prange'] = prange
+                compiled.append(njit(cache=cache, parallel=parallel)(fn))
+            except ImportError:
+                compiled.append(fn)
+        return compiled[0](*args, **kw)
+    wrapper.py_func = fn
+    return wrapper
+
+def numba_available():
+    """
+    Return True if numba can be imported.
+    """
+    try:
+        import numba
+        return True
+    except ImportError:
+        return False
+
 def merge_ends(w, p, tol=1e-3):
     """
     join the leading and trailing ends of the profile together so fewer
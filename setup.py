@@ -26,6 +26,39 @@ for line in open(os.path.join("refl1d", "__init__.py")):
 extra_compile_args =  {'msvc': ['/EHsc']}
 extra_link_args =  {}
 
+# OpenMP (compile, link) flags to try for each compiler type.  Apple clang
+# needs the libomp library from homebrew or conda.  Set REFL1D_OPENMP=0 in
+# the environment to build without OpenMP.
+openmp_flags = {
+    'msvc': [(['/openmp'], [])],
+    'unix': [(['-fopenmp'], ['-fopenmp']),
+             (['-Xpreprocessor', '-fopenmp'], ['-lomp'])],
+    'mingw32': [(['-fopenmp'], ['-fopenmp'])],
+}
+
+def check_openmp(compiler, compile_args, link_args):
+    """
+    Return True if *compiler* can build an OpenMP program with these flags.
+    """
+    import tempfile
+    import shutil
+    from distutils.errors import CompileError, LinkError
+    tmpdir = tempfile.mkdtemp()
+    try:
+        src = os.path.join(tmpdir, 'check_openmp.c')
+        with open(src, 'w') as fid:
+            fid.write("#include <omp.h>\n"
+                      "int main(void) { return omp_get_max_threads() < 1; }\n")
+        objects = compiler.compile([src], output_dir=tmpdir,
+                                   extra_postargs=compile_args)
+        compiler.link_executable(objects, os.path.join(tmpdir, 'check_openmp'),
+                                 extra_postargs=link_args)
+        return True
+    except (CompileError, LinkError):
+        return False
+    finally:
+        shutil.rmtree(tmpdir)
+
 class build_ext_subclass(build_ext):
     def build_extensions(self):
         c = self.compiler.compiler_type
@@ -35,6 +68,18 @@ class build_ext_subclass(build_ext):
         if c in extra_link_args:
             for e in self.extensions:
                 e.extra_link_args = extra_link_args[c]
+        if os.environ.get('REFL1D_OPENMP', '1') != '0':
+            for compile_args, link_args in openmp_flags.get(c, []):
+                if check_openmp(self.compiler, compile_args, link_args):
+                    for e in self.extensions:
+                        if e.name == 'refl1d.reflmodule':
+                            e.extra_compile_args = (list(e.extra_compile_args)
+                                                    + compile_args)
+                            e.extra_link_args = (list(e.extra_link_args)
+                                                 + link_args)
+                    break
+            else:
+                print("OpenMP not available; kernels will be single threaded")
         build_ext.build_extensions(self)
 
 # reflmodule extension
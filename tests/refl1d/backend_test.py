@@ -0,0 +1,138 @@
+import os
+import json
+import tempfile
+import shutil
+
+import numpy as np
+
+from refl1d import backend
+from refl1d.reflectivity import (
+    reflectivity_amplitude, convolve, _amplitude_args,
+    TANH_INTERFACE, LINEAR_INTERFACE)
+
+def _amplitude_cases():
+    rng = np.random.RandomState(7)
+    kz = np.hstack((np.linspace(-0.1, 0.1, 203), [0., 1e-11, -1e-11]))
+    for layers in (2, 3, 40):
+        depth = rng.uniform(5, 50, layers)
+        rho = rng.uniform(-1, 8, layers)
+        irho = rng.uniform(0, 0.1, layers)
+        irho[1] = 0.
+        sigma = rng.uniform(0, 5, layers-1)
+        sigma[0] = 0.
+        shape = rng.randint(0, 3, layers-1).astype('i')
+        yield kz, depth, rho, irho, sigma, None, None
+        yield kz, depth, rho, irho, sigma, None, shape
+    # separate profile for each point
+    rho = rng.uniform(-1, 8, (3, layers))
+    irho = rng.uniform(0, 0.1, (3, layers))
+    rho_index = rng.randint(0, 3, len(kz)).astype('i')
+    yield kz, depth, rho, irho, sigma, rho_index, None
+
+def test_amplitude_backends():
+    names = backend.available('amplitude')
+    assert names[0] == 'c' and 'numpy' in names
+    for case in _amplitude_cases():
+        args = _amplitude_args(*case)
+        reference = backend._c_amplitude(*args)
+        for name, fn, _ in backend._registry['amplitude']:
+            if name in names:
+                r = fn(*args)
+                assert np.allclose(r, reference, rtol=1e-10, atol=1e-13), name
+
+def test_convolve_backends():
+    xi = np.linspace(0.001, 0.3, 400)
+    yi = np.exp(-30*xi)*(1.5 + np.cos(200*xi))
+    # duplicate theory points do not contribute to the integral
+    xi = np.sort(np.hstack((xi, xi[100:105])))
+    yi = np.exp(-30*xi)*(1.5 + np.cos(200*xi))
+    x = np.linspace(0.0, 0.31, 91)
+    dx = 0.002 + 0.02*x
+    dx[[3, 50, 90]] = 0.
+    reference = backend._c_convolve(xi, yi, x, dx)
+    for name, fn, _ in backend._registry['convolve']:
+        if name in backend.available('convolve'):
+            y = fn(xi, yi, x, dx)
+            assert np.allclose(y, reference, rtol=1e-10, atol=0), name
+
+def test_use_backend():
+    path = tempfile.mkdtemp()
+    try:
+        backend.use_backend_cache(path)
+        try:
+            backend.use_backend('missing')
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("expected ValueError for missing backend")
+
+        # magnetic has no numpy kernel so it stays with C
+        backend.use_backend('numpy')
+        assert backend.get_backend('amplitude') == 'numpy'
+        assert backend.get_backend('magnetic') == 'c'
+        case = next(_amplitude_cases())
+        r = reflectivity_amplitude(*case)
+        backend.use_backend('c')
+        assert np.allclose(r, reflectivity_amplitude(*case), rtol=1e-10)
+
+        # shapes are only timed at the explicit tuning step
+        backend.use_backend('auto', kernel='amplitude')
+        reflectivity_amplitude(*case)
+        filename = backend._cache_file(path)
+        assert not os.path.exists(filename)
+        assert backend.select('amplitude', _amplitude_args(*case)) == 'c'
+
+        # tuning records the fastest backend for the shape in the cache
+        backend.tune(reflectivity_amplitude, *case)
+        key = backend._shape_key('amplitude', _amplitude_args(*case))
+        with open(filename) as fid:
+            choices = json.load(fid)['choices']
+        assert choices[key] in backend.available('amplitude')
+        # the choice is reused in a later process
+        choices[key] = 'numpy'
+        with open(filename, 'w') as fid:
+            json.dump({'refl1d': backend.__version__, 'choices': choices}, fid)
+        backend.use_backend_cache(path)
+        assert backend.select('amplitude', _amplitude_args(*case)) == 'numpy'
+        # callers needing the incremental or single precision kernel keep C
+        assert backend.select('amplitude', _amplitude_args(*case),
+                              native=True) == 'c'
+    finally:
+        backend.use_backend('c')
+        backend.use_backend_cache(False)
+        shutil.rmtree(path)
+
+def test_experiment_backend():
+    from refl1d.names import NeutronProbe, Experiment, silicon, gold, air
+    probe = NeutronProbe(T=np.linspace(0.2, 3, 60), dT=0.01, L=4.75,
+                         dL=0.05)
+    probe.R = np.exp(-20*probe.Q)
+    probe.dR = 0.05*probe.R
+    M = Experiment(sample=silicon(0, 5) | gold(100, 5) | air, probe=probe)
+    nllf, theory = M.nllf(), M.reflectivity()[1]
+    try:
+        backend.use_backend('numpy')
+        M.update()
+        assert np.allclose(M.nllf(), nllf, rtol=1e-10)
+        M.update()
+        assert np.allclose(M.reflectivity()[1], theory, rtol=1e-10)
+    finally:
+        backend.use_backend('c')
+
+def test_tune_experiment():
+    from refl1d.names import NeutronProbe, Experiment, silicon, gold, air
+    probe = NeutronProbe(T=np.linspace(0.2, 3, 60), dT=0.01, L=4.75,
+                         dL=0.05)
+    probe.R = np.exp(-20*probe.Q)
+    probe.dR = 0.05*probe.R
+    M = Experiment(sample=silicon(0, 5) | gold(100, 5) | air, probe=probe)
+    nllf = M.nllf()
+    try:
+        backend.use_backend_cache(False)
+        backend.use_backend('auto')
+        M.tune_backends()
+        assert any(k.startswith('amplitude:') for k in backend._choices())
+        M.update()
+        assert np.allclose(M.nllf(), nllf, rtol=1e-10)
+    finally:
+        backend.use_backend('c')
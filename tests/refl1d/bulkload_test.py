@@ -0,0 +1,60 @@
+import os
+
+import numpy as np
+
+from refl1d.names import NCNR
+from refl1d.bulkload import load_many, sniff
+
+testdir = os.path.dirname(__file__)
+rootdir = os.path.join(testdir, os.pardir, os.pardir)
+
+def test_sniff():
+    formats = {
+        'cg1test.refl': 'ncnr',
+        'c_PLP0000708.dat': 'ansto',
+        'liquids-sample.txt': 'sns',
+    }
+    for filename, fmt in formats.items():
+        assert sniff(os.path.join(testdir, filename)) == fmt
+    magnetic = os.path.join(rootdir, 'doc', 'examples', 'freemag',
+                            'pmf13_100mT.reflB')
+    assert sniff(magnetic) == 'ncnr_magnetic'
+
+def test_load_many():
+    files = [os.path.join(testdir, 'c_PLP0000708.dat'),
+             os.path.join(testdir, 'cg1test.refl')]
+    options = {'ncnr': dict(Tlo=0.5, slits_at_Tlo=0.2)}
+    serial = load_many(files, workers=1, options=options)
+    assert [p.filename for p in serial] == files
+    for processes in (False, True):
+        probes = load_many(files, workers=2, processes=processes,
+                           options=options)
+        assert [p.filename for p in probes] == files
+        for p, q in zip(probes, serial):
+            assert np.array_equal(p.Q, q.Q) and np.array_equal(p.dQ, q.dQ)
+
+    # cross sections are grouped into one polarized probe
+    pattern = os.path.join(rootdir, 'doc', 'examples', 'freemag', '*.refl?')
+    instrument = NCNR.NG1(Tlo=0.5, slits_at_Tlo=0.2)
+    probes = load_many(pattern, instrument=instrument, workers=1)
+    assert [p.pp.filename.endswith('reflD') for p in probes] == [True, True]
+    assert '100mT' in probes[0].pp.filename
+
+def test_load_options():
+    files = [os.path.join(testdir, 'c_PLP0000708.dat'),
+             os.path.join(testdir, 'cg1test.refl')]
+    # loader arguments need a format when formats are detected per file
+    for kw in (dict(Tlo=0.5), dict(options={'missing': {}})):
+        try:
+            load_many(files, workers=1, **kw)
+        except (TypeError, ValueError):
+            pass
+        else:
+            raise AssertionError("expected an error for %s" % kw)
+    # options only go to the loader of their format
+    probe, = load_many(files[1:], format='ncnr', workers=1,
+                       Tlo=0.5, slits_at_Tlo=0.2)
+    other, = load_many(files[1:], workers=1,
+                       options={'ncnr': dict(Tlo=0.5, slits_at_Tlo=0.2),
+                                'ansto': dict(unused=1)})
+    assert np.array_equal(probe.dT, other.dT)
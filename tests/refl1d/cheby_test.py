@@ -0,0 +1,33 @@
+import numpy as np
+from bumps.cheby import cheby_val, cheby_coeff
+
+from refl1d.names import *
+from refl1d.cheby import _profile
+
+def test_profile_matrix():
+    t = np.linspace(0, 1, 101)
+    rng = np.random.RandomState(2)
+    for n in (1, 2, 5, 20):
+        c = rng.normal(size=n)
+        assert np.max(abs(_profile(c, t, 'direct') - cheby_val(c, t))) < 1e-12
+        target = cheby_val(cheby_coeff(c), t)
+        assert np.max(abs(_profile(c, t, 'interp') - target)) < 1e-12
+        # columns are evaluated as separate profiles
+        P = _profile(np.array([c, 2*c]).T, t, 'interp')
+        assert np.max(abs(P - np.array([target, 2*target]).T)) < 1e-12
+    assert (_profile([], t, 'interp') == 0).all()
+
+def test_freeform_cheby():
+    T = np.linspace(0.1, 3, 50)
+    probe = NeutronProbe(T=T, dT=0.02, L=4.75, dL=0.0475)
+    layer = FreeformCheby(100, rho=[1, 2, 3, 4], irho=[0.1, 0, 0, 0.1])
+    sample = silicon(0, 5) | layer | air
+    M = Experiment(sample=sample, probe=probe, dz=1)
+    w, _, rho, irho = M.slabs()
+    z = np.cumsum(w[1:-1]) - w[1:-1]/2
+    assert np.max(abs(rho[1:-1] - cheby_val(cheby_coeff([1, 2, 3, 4]), z/100))) < 1e-12
+    assert np.max(abs(irho[1:-1] - cheby_val(cheby_coeff([.1, 0, 0, .1]), z/100))) < 1e-12
+    # imaginary profile may be omitted
+    layer = FreeformCheby(100, rho=[1, 2, 3, 4])
+    M = Experiment(sample=silicon(0, 5) | layer | air, probe=probe, dz=1)
+    assert (M.slabs()[3][1:-1] == 0).all()
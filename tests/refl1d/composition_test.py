@@ -0,0 +1,38 @@
+import numpy as np
+
+from refl1d.names import *
+from refl1d.composition import CompositionSpace, Part, Gaussian
+
+def test_gaussian():
+    z = np.linspace(0, 50, 501)
+    f = Gaussian(center=20, width=10, sigma=3)(z)
+    # flat within the width, gaussian tails outside
+    assert (f[abs(z-20) <= 5] == 1).all()
+    outside = abs(z-20) > 5
+    target = np.exp(-0.5*((abs(z[outside]-20)-5)/3)**2)
+    assert np.max(abs(f[outside] - target)) < 1e-14
+
+def test_composition_space():
+    lipid, protein = SLD('lipid', rho=-0.4), SLD('protein', rho=2, irho=0.1)
+    water = SLD('water', rho=6)
+    space = CompositionSpace(solvent=water, thickness=60)
+    space.add(Part(lipid, Gaussian(center=20, width=15, sigma=2), fraction=0.9))
+    space.add(Part(protein, Gaussian(center=35, width=0, sigma=5), fraction=0.4))
+    T = np.linspace(0.1, 3, 50)
+    probe = NeutronProbe(T=T, dT=0.02, L=4.75, dL=0.0475)
+    M = Experiment(sample=silicon(0, 5) | space | water, probe=probe, dz=0.5)
+    w, _, rho, irho = M.slabs()
+    w, rho, irho = w[1:-1], rho[1:-1], irho[1:-1]
+    z = np.cumsum(w) - w/2
+    assert abs(np.sum(w) - 60) < 1e-10
+    f = [p.fraction.value*p.profile(z) for p in space.parts]
+    total = np.clip(f[0] + f[1], 0, 1)
+    assert np.max(abs(rho - (-0.4*f[0] + 2*f[1] + 6*(1-total)))) < 1e-12
+    assert np.max(abs(irho - 0.1*f[1])) < 1e-12
+    # only the changed part is recomputed
+    cached = space._fractions[2][0].copy()
+    space[1].profile.center.value = 40
+    M.update()
+    M.slabs()
+    assert (space._fractions[2][0] == cached).all()
+    assert abs(z[np.argmax(space._fractions[2][1])] - 40) < 0.5
@@ -0,0 +1,86 @@
+import numpy as np
+
+from refl1d.names import *
+from refl1d.cost import (evaluation_cost, fit_time, recommend,
+                         theory_deviation)
+
+def _experiment(**kw):
+    T = np.linspace(0.1, 3, 150)
+    probe = NeutronProbe(T=T, dT=0.02, L=4.75, dL=0.0475)
+    sample = silicon(0, 5) | SLD(rho=4)(200, 10) | air
+    M = Experiment(sample=sample, probe=probe, **kw)
+    M.simulate_data(noise=5)
+    return M
+
+def test_cost():
+    M = _experiment(dz=0.2, step_interfaces=True)
+    cost = evaluation_cost(M, repeats=1)
+    assert cost.slabs > 100  # step interfaces use microslabs
+    assert cost.calc_points == 150 and cost.data_points == 150
+    assert cost.total > 0
+    # dream time is linear in samples
+    t1 = fit_time(cost, fitter='dream', nfree=3, samples=1000, burn=0)
+    t2 = fit_time(cost, fitter='dream', nfree=3, samples=2000, burn=0)
+    assert abs(t2 - 2*t1) < 1e-12
+
+def test_cost_repeats():
+    # thick sample so the kernel dominates
+    T = np.linspace(0.1, 3, 2000)
+    probe = NeutronProbe(T=T, dT=0.02, L=4.75, dL=0.0475)
+    sample = silicon(0, 5)
+    for k in range(200):
+        sample = sample | SLD(name="L%d"%k, rho=k%5)(10, 2)
+    M = Experiment(sample=sample | air, probe=probe)
+    M.simulate_data(noise=5)
+    # kernel time after changing the layer next to the substrate, which
+    # invalidates all the saved products
+    from timeit import default_timer as timer
+    layer = M.sample['L0'].thickness
+    full = np.inf
+    for k in range(3):
+        layer.value = 10 + (k+1)
+        M.update()
+        t0 = timer()
+        M._reflamp()
+        full = min(full, timer() - t0)
+    layer.value = 10
+    cost = evaluation_cost(M, repeats=3)
+    # repeats are not served from the kernel products of the previous one
+    assert cost.kernel > 0.5*full
+    # the fused nllf is not counted twice
+    assert cost.beam < cost.kernel
+    assert cost.total < 1.5*(cost.render + cost.kernel + cost.beam)
+
+def test_recommend():
+    M = _experiment(dz=0.2, step_interfaces=True)
+    settings = M.dz, M.dA, M.step_interfaces
+    reference = M.reflectivity()
+    found = recommend(M, tolerance=0.5, repeats=1)
+    names = [rec.name for rec in found]
+    assert 'dA' in names
+    for rec in found:
+        assert rec.deviation <= 0.5
+    # experiment is restored
+    assert (M.dz, M.dA, M.step_interfaces) == settings
+    M.update()
+    assert theory_deviation(M.probe, reference, M.reflectivity()) == 0
+
+def test_auto_dA():
+    M = _experiment(dz=0.2, step_interfaces=True, dA='auto', dA_recheck=3)
+    exact = _experiment(dz=0.2, step_interfaces=True)
+    reference = exact.reflectivity()
+    # retune now that simulate_data has set dR
+    dA = M.tune_dA()
+    theory = M.reflectivity()
+    assert dA is not None
+    assert theory_deviation(M.probe, reference, theory) <= M.dA_error
+    # contraction reduces the slab count
+    assert 5*len(M.slabs()[0]) < len(exact.slabs()[0])
+    # tolerance is revalidated after dA_recheck renders
+    for _ in range(3):
+        M.update()
+        M.reflectivity()
+    assert M._dA_countdown == M.dA_recheck - 1
+    # a tighter budget gives a finer tolerance
+    M.dA_error = 0.01
+    assert M.tune_dA() < dA
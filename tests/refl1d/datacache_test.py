@@ -0,0 +1,41 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from bumps.data import parse_file, parse_multi
+
+from refl1d import datacache
+from refl1d.probe import load4
+from refl1d.anstodata import Platypus
+
+testdir = os.path.dirname(__file__)
+
+def test_data_cache():
+    path = tempfile.mkdtemp()
+    try:
+        datacache.use_data_cache(path)
+        filename = os.path.join(testdir, 'cg1test.refl')
+        header, data = parse_file(filename)
+        for _ in range(2):
+            cached_header, cached_data = datacache.parse(parse_file, filename)
+            assert cached_header == header
+            assert np.array_equal(cached_data, data)
+        assert isinstance(cached_data, np.memmap)
+        # arguments are part of the key
+        for _ in range(2):
+            parts = datacache.parse(parse_multi, filename, keysep=':')
+        assert len(parts) == 1 and isinstance(parts[0][1], np.memmap)
+        assert np.array_equal(parts[0][1], parse_multi(filename)[0][1])
+
+        # loaders go through the cache
+        probe = load4(filename)
+        assert np.array_equal(probe.R, load4(filename).R)
+        filename = os.path.join(testdir, 'c_PLP0000708.dat')
+        probe = Platypus().load(filename)
+        assert np.array_equal(Platypus().load(filename).Q, probe.Q)
+        assert probe.filename == filename
+        assert len([f for f in os.listdir(path) if f.endswith('.json')]) == 4
+    finally:
+        datacache.use_data_cache(False)
+        shutil.rmtree(path)
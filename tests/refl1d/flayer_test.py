@@ -0,0 +1,60 @@
+import numpy as np
+
+from refl1d.names import *
+
+def _model(counter):
+    def profile(z, rhoL, rhoR):
+        counter.append(len(z))
+        return rhoL + (rhoR-rhoL)*z/100
+    def mag(z, M):
+        counter.append(len(z))
+        return M*np.ones_like(z), 270
+    L1, L3 = SLD('L1', rho=2.07), SLD('L3', rho=4)
+    flayer = FunctionalProfile(100, 0, profile=profile, rhoL=L1.rho,
+                               rhoR=L3.rho, magnetism=FunctionalMagnetism(mag, M=1))
+    sample = L1(0, 5) | flayer | flayer.end(20, 5, magnetism=flayer.magnetism.end) | L3
+    flayer.magnetism.set_anchor(sample, flayer.name)
+    return flayer, sample
+
+def test_profile_cache():
+    calls = []
+    flayer, sample = _model(calls)
+    T = np.linspace(0.1, 3, 20)
+    probe = PolarizedNeutronProbe([
+        NeutronProbe(T=T, dT=0.02, L=4.75, dL=0.0475) for _ in range(4)])
+    M = Experiment(sample=sample, probe=probe, dz=1)
+    M.reflectivity()
+    # one evaluation each for the nuclear and magnetic profiles on the
+    # uniform microslab grid, and one each for the layer boundaries
+    assert sorted(calls) == [2, 2, 100, 100]
+    assert flayer.start.rho.value == 2.07 and flayer.end.rho.value == 4
+    assert flayer.magnetism.end.rhoM.value == 1
+    assert len(calls) == 4
+    # a parameter change triggers a new evaluation
+    flayer.rhoR.value = 5
+    assert flayer.end.rho.value == 5
+    M.update()
+    M.reflectivity()
+    assert calls[4:] == [2, 100]
+
+def test_grid():
+    # the profile function sees the documented grid with step 2*z[0]
+    grids = []
+    def profile(z, rho):
+        grids.append(z)
+        return rho*np.ones_like(z)
+    flayer = FunctionalProfile(37, 0, profile=profile, rho=3)
+    M = Experiment(sample=SLD('L1', rho=2.07)(0, 5) | flayer | air,
+                   probe=NeutronProbe(T=np.linspace(0.1, 3, 20), L=4.75),
+                   dz=1.5)
+    M.reflectivity()
+    z = [g for g in grids if len(g) > 2][0]
+    assert np.allclose(np.diff(z)[:-1], 2*z[0])
+    assert flayer.end.rho.value == 3
+
+def test_jit():
+    def profile(z, slope):
+        return slope*z
+    flayer = FunctionalProfile(10, 0, profile=profile, slope=2, jit=True)
+    assert flayer.end.rho.value == 20
+    assert flayer.profile is profile
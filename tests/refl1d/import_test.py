@@ -0,0 +1,28 @@
+import sys
+import subprocess
+
+# Short-lived worker processes import the model namespace on startup, so
+# keep numba compilation, plotting and the gui out of the import path.
+CHECK = """
+import sys, time
+start = time.time()
+import refl1d.names, refl1d.fitplugin
+print(time.time() - start)
+print(" ".join(m for m in ("numba", "matplotlib.pyplot", "refl1d.view",
+                           "refl1d.errors", "wx") if m in sys.modules))
+"""
+
+def test_import_time():
+    output = subprocess.check_output([sys.executable, "-c", CHECK])
+    elapsed, loaded = (output.decode('ascii').split('\n') + [''])[:2]
+    assert loaded.strip() == "", "unexpected imports: " + loaded
+    # generous budget: about 0.5 s on a workstation, most of it in bumps
+    assert float(elapsed) < 5.0
+
+def test_lazy_convolve():
+    import numpy as np
+    from refl1d.reflectivity import convolve
+    xi = np.linspace(0, 1, 101)
+    x = np.linspace(0.1, 0.9, 9)
+    y = convolve(xi, xi**2, x, 0.01*np.ones_like(x), resolution='uniform')
+    assert np.max(abs(y - (x**2 + 0.01**2))) < 1e-4
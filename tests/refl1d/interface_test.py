@@ -0,0 +1,61 @@
+import numpy as np
+
+from refl1d.names import *
+from refl1d.abeles import refl
+from refl1d.reflectivity import reflectivity_amplitude
+
+def test_shape_kernel():
+    # C kernel matches the python kernel for mixed interface shapes,
+    # including reversed layers for kz < 0
+    kz = np.linspace(-0.1, 0.1, 200)
+    depth, rho, irho = [0, 100, 50, 0], [2.07, 4, 1, 0], [0, 0.1, 0, 0]
+    sigma, shape = [5, 3, 8], [2, 0, 1]
+    r = reflectivity_amplitude(kz, depth, rho, irho, sigma, shape=shape)
+    with np.errstate(all='ignore'):
+        target = refl(kz, depth, rho, irho, sigma, shape=shape)
+    assert np.max(abs(r - target)) < 1e-12
+
+def test_shape_accuracy():
+    # analytic roughness factor matches a finely sliced interface profile
+    kz = np.linspace(0.001, 0.1, 100)
+    z = np.arange(-80, 80, 0.02) + 0.01
+    for interface in (Tanh(5), Linear(20)):
+        profile = 2.07 + (4 - 2.07)*(1 - interface.cdf(z))
+        depth = np.hstack((0, 0.02*np.ones_like(z), 0))
+        R = abs(reflectivity_amplitude(kz, depth, np.hstack((4, profile, 2.07))))**2
+        r = reflectivity_amplitude(kz, [0, 0], [4, 2.07], 0,
+                                   [interface.kernel_width()],
+                                   shape=[interface.shape])
+        assert np.max(abs(abs(r)**2 - R)/R) < 1e-4
+
+def test_shape_slabs():
+    probe = NeutronProbe(T=np.linspace(0.1, 5, 100), L=4.75)
+    sample = silicon(0, Tanh(8)) | SLD(rho=4)(150, Linear(20)) | air
+    M = Experiment(sample=sample, probe=probe, dz=0.2)
+    M.reflectivity()
+    # interfaces stay as single boundaries
+    assert len(M.slabs()[0]) == 3
+    assert list(M._slabs.interface_shape) == [Tanh.shape, Linear.shape]
+    # contraction keeps the shapes with their interfaces
+    sample = silicon(0, 5) | SLD(rho=4)(20, 0) | SLD(rho=4.01)(20, 0) \
+        | SLD(rho=3)(150, Tanh(5)) | air
+    M = Experiment(sample=sample, probe=probe, dA=1)
+    M.reflectivity()
+    assert len(M.slabs()[0]) == 4
+    assert list(M._slabs.interface_shape) == [0, 0, Tanh.shape]
+
+def test_shape_unsupported():
+    # only slabs render interface shapes, and only non-magnetic ones
+    layer = FunctionalProfile(50, 0, profile=lambda z: 0*z + 4)
+    for build in (lambda: layer(50, Tanh(5)),
+                  lambda: Slab(SLD(rho=4), 50, Tanh(5), magnetism=Magnetism()),
+                  lambda: SLD(rho=4)(50, 5, Magnetism())(interface=Linear(5)),
+                  lambda: SLD(rho=4)(50, Tanh(5))(magnetism=Magnetism())):
+        try:
+            build()
+        except (TypeError, NotImplementedError):
+            pass
+        else:
+            raise AssertionError("unsupported interface accepted")
+    # gaussian interfaces remain valid for magnetic layers
+    SLD(rho=4)(50, Erf(5), Magnetism())
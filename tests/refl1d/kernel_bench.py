@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+"""
+Accuracy and throughput benchmark for the compiled kernels.
+
+Sweeps layer count, kz count, roughness, absorption and magnetism, timing
+the reflmodule entry points and checking them against the pure python
+references (:mod:`refl1d.abeles`, :mod:`refl1d.refl_tr`) and, when gfortran
+is available, the gepore reference in gepore_check.py.
+
+Usage::
+
+    python tests/refl1d/kernel_bench.py --output bench.json
+    python tests/refl1d/kernel_bench.py --quick --compare bench.json
+
+With *--compare* the run exits with a nonzero status if any kernel
+throughput drops by more than *--factor* relative to the earlier run.
+
+Throughput is kz points times layers per second for the reflectivity
+kernels, and output points times theory points per second for the
+resolution convolution.  Errors are the maximum relative error in $|r|^2$
+with a floor of 1e-10, so points with no reflectivity do not dominate.
+"""
+from __future__ import print_function
+
+import sys
+import os
+import json
+import time
+import socket
+import platform
+import subprocess
+
+import numpy as np
+
+from refl1d import reflmodule, abeles, refl_tr, backend, __version__
+from refl1d.reflectivity import calculate_u1_u3, _amplitude_args
+
+LAYERS = (2, 10, 100, 1000)
+POINTS = (100, 1000, 10000)
+QUICK_LAYERS = (2, 10)
+QUICK_POINTS = (100,)
+GEPORE_MAXQ = 1000
+REFL_TR_MAX_LAYERS = 100
+# Relative error below which the kernel agrees with the reference.
+TOLERANCE = {
+    'abeles': 1e-8,
+    'refl_tr': 1e-8,
+    'gepore': None,  # reported only; see _gepore_error
+    'numpy': 1e-10,
+    'gaussian': 1e-2,
+    'thickness': 1e-10,
+    }
+
+
+def _timeit(fn, min_time=0.05, max_repeats=50):
+    """
+    Return the best time per call of *fn*, repeating until *min_time*.
+    """
+    best, total, n = np.inf, 0., 0
+    while n < max_repeats and (n < 3 or total < min_time):
+        t0 = time.perf_counter()
+        fn()
+        dt = time.perf_counter() - t0
+        best, total, n = min(best, dt), total+dt, n+1
+    return best
+
+
+def _relerr(R, Rref):
+    R, Rref = np.asarray(R), np.asarray(Rref)
+    return float(np.max(abs(R - Rref)/np.maximum(abs(Rref), 1e-10)))
+
+
+def _sample(layers, rough, absorb, magnetic, seed=1):
+    rng = np.random.RandomState(seed + layers)
+    depth = rng.uniform(5, 100, layers)
+    depth[0] = depth[-1] = 0.
+    rho = rng.uniform(-0.5, 8, layers)
+    rho[0] = 0.
+    irho = rng.uniform(0, absorb, layers) if absorb else np.zeros(layers)
+    irho[0] = 0.
+    sigma = rng.uniform(0, rough, layers-1) if rough else np.zeros(layers-1)
+    sample = dict(depth=depth, rho=rho, irho=irho, sigma=sigma)
+    if magnetic:
+        rhoM = rng.uniform(0, 2, layers)
+        rhoM[0] = rhoM[-1] = 0.
+        thetaM = rng.uniform(0, 360, layers)
+        sample.update(rhoM=rhoM, thetaM=thetaM)
+    return sample
+
+
+def _amplitude(kz, s):
+    args = _amplitude_args(kz, s['depth'], s['rho'], s['irho'], s['sigma'],
+                           None, None)
+    kz, depth, rho, irho, sigma, rho_index, shape = args
+    r = np.empty(kz.shape, 'D')
+    def run():
+        reflmodule._reflectivity_amplitude(depth, sigma, rho, irho, kz,
+                                           rho_index, r, shape)
+    return run, r
+
+
+def bench_amplitude(layers, points, rough, absorb):
+    s = _sample(layers, rough, absorb, False)
+    kz = np.linspace(-0.15, 0.15, points)
+    run, r = _amplitude(kz, s)
+    seconds = _timeit(run)
+    run()
+    R = abs(r)**2
+    errors = {}
+    # abeles is the reference for front reflectivity, refl_tr for back
+    # reflectivity (it only accepts kz >= 0).
+    front, back = kz < 0, kz >= 0
+    Rref = abs(abeles.refl(kz[front], s['depth'], s['rho'], s['irho'],
+                           s['sigma']))**2
+    errors['abeles'] = _relerr(R[front], Rref)
+    if not rough and layers <= REFL_TR_MAX_LAYERS:
+        # refl_tr has no roughness model, and its transfer matrices
+        # overflow for thick samples
+        out = refl_tr.refl_tr(kz[back], s['depth'], s['rho'], s['irho'],
+                              s['sigma'])
+        errors['refl_tr'] = _relerr(R[back], abs(out[0, 1])**2)
+    return seconds, points*layers, errors
+
+
+def _gepore_error(s, kz, R, H):
+    try:
+        import gepore_check
+    except ImportError:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import gepore_check
+    layers = np.vstack((s['depth'], s['rho'], s['rhoM'], s['thetaM'],
+                        np.zeros_like(s['depth']))).T
+    # gepore has fixed size arrays so only compare the start of the range
+    kz, R = kz[:GEPORE_MAXQ], [r[:GEPORE_MAXQ] for r in R]
+    dk = kz[1] - kz[0]
+    # gepore echoes its input to stdout; silence it at the descriptor level
+    sys.stdout.flush()
+    saved, null = os.dup(1), os.open(os.devnull, os.O_WRONLY)
+    os.dup2(null, 1)
+    try:
+        Rg = gepore_check.gepore(layers, 2*kz[0], 2*dk, len(kz), 270., H)
+    except (RuntimeError, OSError) as exc:
+        return {'error': str(exc)}
+    finally:
+        os.dup2(saved, 1)
+        os.close(saved)
+        os.close(null)
+    # gepore returns (--, +-, -+, ++); the kernel returns (++, +-, -+, --).
+    names = ('++', '+-', '-+', '--')
+    return dict((xs, _relerr(abs(r)**2, abs(g)**2))
+                for xs, r, g in zip(names, R, Rg[::-1]))
+
+
+def bench_magnetic(layers, points, rough, absorb, gepore=True):
+    s = _sample(layers, rough, absorb, True)
+    kz = np.linspace(0.0005, 0.15, points)
+    H, Aguide = 1e-3, 270.
+    args = _amplitude_args(kz, s['depth'], s['rho'], s['irho'], s['sigma'],
+                           None, None)
+    kz, depth, rho, irho, sigma, rho_index, _ = args
+    sld_b, u1, u3 = calculate_u1_u3(H, s['rhoM'], s['thetaM'], Aguide)
+    R = [np.empty(kz.shape, 'D') for _ in range(4)]
+    def run():
+        reflmodule._magnetic_amplitude(depth, sigma, rho, irho, sld_b, u1, u3,
+                                       Aguide, kz, rho_index, *R)
+    seconds = _timeit(run)
+    run()
+    errors = {}
+    if gepore and not rough and not absorb:
+        # gepore has no roughness or absorption; it does not agree with the
+        # kernel for all cross sections so the errors are reported only.
+        errors['gepore'] = _gepore_error(s, kz, R, H)
+    return seconds, points*layers, errors
+
+
+def bench_convolve(points, theory=None):
+    theory = theory if theory is not None else 4*points
+    xi = np.linspace(0.001, 0.3, theory)
+    yi = np.exp(-30*xi)*(1.5 + np.cos(200*xi))
+    x = np.linspace(0.005, 0.29, points)
+    dx = 0.001 + 0.02*x
+    y = np.empty_like(x)
+    def run():
+        reflmodule.convolve(xi, yi, x, dx, y)
+    seconds = _timeit(run)
+    run()
+    errors = {'numpy': _relerr(y, backend._numpy_convolve(xi, yi, x, dx))}
+    return seconds, points*theory, errors
+
+
+def bench_convolve_sampled(points, theory=None):
+    theory = theory if theory is not None else 4*points
+    xi = np.linspace(0.001, 0.3, theory)
+    yi = np.exp(-30*xi)*(1.5 + np.cos(200*xi))
+    x = np.linspace(0.02, 0.28, points)
+    dx = 0.001 + 0.02*x
+    # unit gaussian sampled on a fine grid out to 4 sigma
+    xp = np.linspace(-4, 4, 401)
+    yp = np.exp(-0.5*xp**2)/np.sqrt(2*np.pi)
+    y = np.empty_like(x)
+    def run():
+        reflmodule.convolve_sampled(xi, yi, xp, yp, x, dx, y)
+    seconds = _timeit(run)
+    run()
+    errors = {'gaussian': _relerr(y, backend._c_convolve(xi, yi, x, dx))}
+    return seconds, points*theory, errors
+
+
+def bench_contract(layers, dA=1.):
+    rng = np.random.RandomState(layers)
+    w0 = np.full(layers, 1.)
+    sigma0 = np.zeros(layers-1)
+    rho0 = np.cumsum(rng.normal(0, 0.1, layers))
+    irho0 = np.zeros(layers)
+    def run():
+        w, sigma, rho, irho = [v.copy() for v in (w0, sigma0, rho0, irho0)]
+        return reflmodule._contract_by_area(w, sigma, rho, irho, dA), w
+    seconds = _timeit(run)
+    n, w = run()
+    errors = {'thickness': _relerr(np.sum(w[:n]), np.sum(w0))}
+    return seconds, layers, errors
+
+
+def _header():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        commit = None
+    return {
+        'host': socket.gethostname(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'refl1d': __version__,
+        'commit': commit,
+        'cpus': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+
+
+def _record(kernel, seconds, work, errors, **case):
+    failed = [ref for ref, err in errors.items()
+              if isinstance(err, float) and TOLERANCE.get(ref) is not None
+              and not err <= TOLERANCE[ref]]
+    record = dict(kernel=kernel, seconds=seconds, throughput=work/seconds,
+                  errors=errors, ok=not failed)
+    record.update(case)
+    return record
+
+
+def _key(record):
+    return tuple((k, record[k]) for k in sorted(record)
+                 if k not in ('seconds', 'throughput', 'errors', 'ok'))
+
+
+def run(quick=False, gepore=True, verbose=False):
+    """
+    Run the benchmark sweep, returning a JSON-compatible dict.
+
+    If *quick*, use a small sweep that completes in a few seconds.  Set
+    *gepore* to False to skip the fortran reference.
+    """
+    layer_set = QUICK_LAYERS if quick else LAYERS
+    point_set = QUICK_POINTS if quick else POINTS
+    results = []
+    def add(record):
+        results.append(record)
+        if verbose:
+            case = ", ".join("%s=%s" % kv for kv in _key(record))
+            print("%-60s %10.3g/s %s" % (case, record['throughput'],
+                                         "ok" if record['ok'] else "FAIL"))
+
+    for layers in layer_set:
+        for points in point_set:
+            for rough in (0., 3.):
+                for absorb in (0., 0.05):
+                    case = dict(layers=layers, points=points,
+                                roughness=rough, absorption=absorb)
+                    add(_record('amplitude', *bench_amplitude(
+                        layers, points, rough, absorb), **case))
+                    add(_record('magnetic', *bench_magnetic(
+                        layers, points, rough, absorb,
+                        gepore=gepore and 2 < layers <= 100), **case))
+    for points in point_set:
+        add(_record('convolve', *bench_convolve(points), points=points))
+        add(_record('convolve_sampled', *bench_convolve_sampled(points),
+                    points=points))
+    for layers in layer_set:
+        add(_record('contract_by_area', *bench_contract(10*layers),
+                    layers=10*layers))
+    return {'header': _header(), 'results': results}
+
+
+def compare(old, new, factor=1.5):
+    """
+    Return the records in *new* whose throughput is more than *factor*
+    times slower than the matching record in *old*.
+    """
+    baseline = dict((_key(r), r) for r in old['results'])
+    slow = []
+    for r in new['results']:
+        prev = baseline.get(_key(r))
+        if prev is not None and r['throughput']*factor < prev['throughput']:
+            slow.append((prev, r))
+    return slow
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--output', help="write results to this JSON file")
+    parser.add_argument('--quick', action='store_true', help="small sweep")
+    parser.add_argument('--no-gepore', action='store_true',
+                        help="skip the fortran gepore reference")
+    parser.add_argument('--compare', help="earlier JSON results")
+    parser.add_argument('--factor', type=float, default=1.5,
+                        help="allowed slowdown relative to --compare")
+    opts = parser.parse_args()
+
+    result = run(quick=opts.quick, gepore=not opts.no_gepore, verbose=True)
+    if opts.output:
+        with open(opts.output, 'w') as fid:
+            json.dump(result, fid, indent=1, sort_keys=True)
+    status = 0
+    if not all(r['ok'] for r in result['results']):
+        print("accuracy check failed")
+        status = 1
+    if opts.compare:
+        with open(opts.compare) as fid:
+            old = json.load(fid)
+        for prev, r in compare(old, result, factor=opts.factor):
+            print("slower: %s %.3g/s -> %.3g/s" % (
+                dict(_key(r)), prev['throughput'], r['throughput']))
+            status = 1
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()
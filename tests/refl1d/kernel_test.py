@@ -0,0 +1,150 @@
+import numpy as np
+
+from refl1d import reflmodule
+from refl1d.reflectivity import reflectivity_amplitude
+
+def _compare(kz, depth, rho, irho, sigma, rho_index=None):
+    previous = reflmodule._set_blocked_kernel(0)
+    try:
+        r_scalar = reflectivity_amplitude(kz, depth, rho, irho, sigma,
+                                          rho_index=rho_index)
+        reflmodule._set_blocked_kernel(1)
+        r_blocked = reflectivity_amplitude(kz, depth, rho, irho, sigma,
+                                           rho_index=rho_index)
+    finally:
+        reflmodule._set_blocked_kernel(previous)
+    assert np.allclose(r_blocked, r_scalar, rtol=1e-10, atol=1e-14)
+
+def test_blocked_kernel():
+    rng = np.random.RandomState(3)
+    # positive and negative kz, points near zero, partial blocks
+    kz = np.hstack((np.linspace(-0.1, 0.1, 203), [0., 1e-11, -1e-11]))
+    for layers in (2, 3, 17, 200):
+        depth = rng.uniform(5, 50, layers)
+        rho = rng.uniform(-1, 8, layers)
+        irho = rng.uniform(0, 0.1, layers)
+        sigma = rng.uniform(0, 5, layers-1)
+        _compare(kz, depth, rho, irho, sigma)
+
+    # separate profile for each point
+    layers = 10
+    depth = rng.uniform(5, 50, layers)
+    rho = rng.uniform(-1, 8, (3, layers))
+    irho = rng.uniform(0, 0.1, (3, layers))
+    sigma = rng.uniform(0, 5, layers-1)
+    rho_index = rng.randint(0, 3, len(kz)).astype('i')
+    _compare(kz, depth, rho, irho, sigma, rho_index=rho_index)
+
+def test_incremental():
+    import pickle
+    from refl1d.reflectivity import IncrementalAmplitude, TANH_INTERFACE
+
+    rng = np.random.RandomState(5)
+    kz = np.hstack((np.linspace(-0.1, 0.1, 203), [0.]))
+    layers = 40
+    depth = rng.uniform(5, 50, layers)
+    rho = rng.uniform(-1, 8, layers)
+    irho = rng.uniform(0, 0.1, layers)
+    sigma = rng.uniform(0, 5, layers-1)
+    shape = np.zeros(layers-1, 'i')
+    calc = IncrementalAmplitude()
+    def check(shape=None):
+        r = calc(kz, depth, rho, irho, sigma, shape=shape)
+        target = reflectivity_amplitude(kz, depth, rho, irho, sigma,
+                                        shape=shape)
+        assert np.allclose(r, target, rtol=1e-10, atol=1e-14)
+
+    check()
+    # vary layers near the surface, then deeper, then the incident medium
+    for index in (-3, -2, -5, 10, 25, 1, -1, -1, 0):
+        depth[index] += 1
+        rho[index] += 0.1
+        check()
+        check()
+    sigma[-2] = 3.
+    check()
+    # interfaces other than gaussian use the scalar kernel
+    shape[-3:] = TANH_INTERFACE
+    check(shape)
+    rho[-2] += 0.1
+    check(shape)
+    # the saved products are not pickled
+    calc = pickle.loads(pickle.dumps(calc))
+    assert calc._partial is None
+    check()
+
+def test_single_precision():
+    from refl1d.reflectivity import IncrementalAmplitude, promote_kz
+    rng = np.random.RandomState(5)
+    kz = -np.linspace(0.001, 0.15, 301)
+    layers = 40
+    depth = rng.uniform(5, 50, layers)
+    rho = rng.uniform(-1, 8, layers)
+    rho[0], rho[-1] = 2.07, 0.
+    irho = rng.uniform(0, 0.1, layers)
+    sigma = rng.uniform(0, 5, layers-1)
+    promote = promote_kz(rho, 'single')
+    assert promote_kz(rho) == -1.
+    assert np.isclose(promote, 2*np.sqrt(4e-6*np.pi*rho.max()))
+
+    r = reflectivity_amplitude(kz, depth, rho, irho, sigma)
+    r_single = reflectivity_amplitude(kz, depth, rho, irho, sigma,
+                                      precision='single')
+    low = abs(kz) < promote
+    # whole blocks near the critical edge stay in double precision
+    assert np.allclose(r_single[low], r[low], rtol=1e-12, atol=0)
+    R, R_single = abs(r)**2, abs(r_single)**2
+    assert np.max(abs(R_single - R)/R) < 1e-3
+    assert not np.array_equal(r_single, r)
+
+    # incremental products are recomputed when the precision changes
+    incremental = IncrementalAmplitude()
+    for precision in ('single', 'single', 'double', 'single'):
+        result = incremental(kz, depth, rho, irho, sigma, precision=precision)
+        expected = r_single if precision == 'single' else r
+        assert np.allclose(result, expected, rtol=1e-12, atol=1e-15)
+
+    try:
+        reflectivity_amplitude(kz, depth, rho, irho, sigma, precision='half')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("expected ValueError for precision='half'")
+
+def test_reflectivity_chisq():
+    from refl1d.reflectivity import (
+        reflectivity_chisq, IncrementalAmplitude, convolve)
+    calc_Q = np.linspace(0.001, 0.3, 1000)
+    depth = np.hstack((0, 20 + np.arange(20), 0))
+    rho = np.hstack((2.07, 4 + np.sin(np.arange(20)), 0))
+    sigma = 3*np.ones(len(depth) - 1)
+    R0 = abs(reflectivity_amplitude(-calc_Q/2, depth, rho, 0, sigma))**2
+    beams, expected, pts = [], 0., []
+    for Q in (np.linspace(0.01, 0.1, 50), np.linspace(0.08, 0.25, 80)):
+        dQ = 0.02*Q + 0.001
+        theory = 0.95*convolve(calc_Q, R0, Q, dQ) + 1e-7
+        R, dR = theory*(1 + 0.01*np.cos(50*Q)), 0.05*theory
+        beams.append((Q, dQ, R, dR, 0.95, 1e-7, 0., False))
+        expected += np.sum(((R - theory)/dR)**2)
+        pts.append(theory)
+    incremental = IncrementalAmplitude()
+    theory, resid = np.empty(130), np.empty(130)
+    for _ in range(2):
+        chisq = reflectivity_chisq(calc_Q, depth, rho, 0, sigma, beams=beams,
+                                   incremental=incremental,
+                                   theory=theory, resid=resid)
+        assert abs(chisq - expected) < 1e-8*expected
+    assert np.allclose(theory, np.hstack(pts), rtol=1e-10)
+    assert np.allclose(np.sum(resid**2), expected, rtol=1e-10)
+
+def test_benchmark():
+    import json
+    import kernel_bench
+
+    result = kernel_bench.run(quick=True, gepore=False)
+    result = json.loads(json.dumps(result))
+    kernels = set(r['kernel'] for r in result['results'])
+    assert kernels == set(('amplitude', 'magnetic', 'convolve',
+                           'convolve_sampled', 'contract_by_area'))
+    assert all(r['ok'] and r['throughput'] > 0 for r in result['results'])
+    assert kernel_bench.compare(result, result) == []
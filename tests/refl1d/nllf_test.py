@@ -0,0 +1,119 @@
+import numpy as np
+
+from refl1d.names import (
+    NeutronProbe, QProbe, ProbeSet, Slab, SLD, Experiment)
+
+
+def _sample():
+    return (Slab(material=SLD(name='Si', rho=2.07, irho=0.01))
+            | Slab(material=SLD(name='SiOx', rho=3.4), thickness=15,
+                   interface=3)
+            | Slab(material=SLD(name='Ni', rho=9.4, irho=0.05),
+                   thickness=120, interface=5)
+            | Slab(material=SLD(name='air', rho=0.), interface=4))
+
+def _probe(Tlo, Thi, L=4.75, **kw):
+    T = np.linspace(Tlo, Thi, 60)
+    probe = NeutronProbe(T=T, dT=0.01, L=L, dL=0.05, **kw)
+    R = np.exp(-20*probe.Q)
+    probe.R, probe.dR = R, 0.05*R
+    return probe
+
+def _staged(expt):
+    expt.update()
+    Q, theory = expt.reflectivity()
+    resid = (expt.probe.R - theory)/expt.probe.dR
+    return 0.5*np.sum(resid**2), theory, resid
+
+def test_fused_nllf():
+    probes = [
+        _probe(0.2, 2.),
+        _probe(0.2, 2., back_reflectivity=True, back_absorption=0.7,
+               intensity=0.9, background=1e-6, theta_offset=0.01),
+        ProbeSet([_probe(0.2, 1.), _probe(0.8, 3., L=5.)]),
+    ]
+    probes[2].probes[1].intensity.value = 1.1
+    for probe in probes:
+        expt = Experiment(sample=_sample(), probe=probe)
+        assert expt._fused_probes() is not None
+        nllf, theory, resid = _staged(expt)
+        expt.update()
+        assert np.allclose(expt.nllf(), nllf, rtol=1e-12)
+        expt.update()
+        assert np.allclose(expt.residuals(), resid, rtol=1e-12, atol=1e-12)
+        assert np.allclose(expt.reflectivity()[1], theory, rtol=1e-12)
+        # the incremental kernel is used when a parameter changes
+        expt.sample['Ni'].thickness.value += 1
+        expt.update()
+        fused = expt.nllf()
+        assert np.allclose(fused, _staged(expt)[0], rtol=1e-12)
+
+def test_fused_fallback():
+    Q = np.linspace(0.01, 0.2, 50)
+    probe = QProbe(Q, 0.01*Q, data=(np.exp(-20*Q), 0.05*np.exp(-20*Q)),
+                   resolution='uniform')
+    expt = Experiment(sample=_sample(), probe=probe)
+    assert expt._fused_probes() is None
+    assert np.allclose(expt.nllf(), _staged(expt)[0])
+
+def test_single_precision():
+    expt = Experiment(sample=_sample(), probe=_probe(0.2, 2.),
+                      precision='single')
+    nllf, theory, resid = _staged(expt)
+    expt.update()
+    assert np.allclose(expt.nllf(), nllf, rtol=1e-12)
+    error = expt.precision_error()
+    assert 0 < error < 1e-3
+    assert expt.precision == 'single'
+    expt.precision = 'double'
+    assert expt.precision_error() == 0
+
+def test_alignment_cache():
+    probe = _probe(0.2, 2., theta_offset=0.)
+    expt = Experiment(sample=_sample(), probe=probe, alignment_cache=True)
+    reference = Experiment(sample=_sample(), probe=_probe(0.2, 2.))
+    for offset, broadening, thickness in ((0., 0., 120), (0.01, 0., 120),
+                                          (-0.02, 0.005, 120), (0., 0., 125)):
+        for M in (expt, reference):
+            M.probe.theta_offset.value = offset
+            M.probe.sample_broadening.value = broadening
+            M.sample['Ni'].thickness.value = thickness
+            M.update()
+        assert np.allclose(expt.nllf(), reference.nllf(), rtol=1e-4)
+        assert np.allclose(expt.reflectivity()[1], reference.reflectivity()[1],
+                           rtol=1e-4, atol=0)
+        # alignment moves do not render the sample
+        assert ('rendered' in expt._cache) == (offset == 0.)
+    assert expt._aligned.builds == 2
+
+def test_theory_cache():
+    expt = Experiment(sample=_sample(), probe=_probe(0.2, 2.),
+                      theory_cache=1 << 20)
+    reference = Experiment(sample=_sample(), probe=_probe(0.2, 2.))
+    for thickness in (120, 125, 120, 130, 125):
+        for M in (expt, reference):
+            M.sample['Ni'].thickness.value = thickness
+            M.update()
+        hit = 'chisq' in expt._cache
+        assert np.allclose(expt.nllf(), reference.nllf(), rtol=1e-12)
+        assert np.allclose(expt.reflectivity()[1], reference.reflectivity()[1],
+                           rtol=1e-12)
+        expt.smooth_profile()
+    stats = expt.theory_cache_stats()
+    assert hit and stats['hits'] == 2 and stats['misses'] == 3
+    assert stats['hit_rate'] == 0.4 and stats['entries'] == 3
+
+    # new data invalidates the cached residuals
+    expt.probe.R = 2*expt.probe.R
+    expt.update()
+    assert 'chisq' not in expt._cache
+
+    # entries are evicted to stay within the size limit
+    expt = Experiment(sample=_sample(), probe=_probe(0.2, 2.),
+                      theory_cache=10000)
+    for thickness in range(100, 130):
+        expt.sample['Ni'].thickness.value = thickness
+        expt.update()
+        expt.reflectivity()
+    stats = expt.theory_cache_stats()
+    assert stats['evictions'] > 0 and 0 < stats['nbytes'] <= 10000
@@ -0,0 +1,116 @@
+import os
+import sys
+import pickle
+import shutil
+import subprocess
+import tempfile
+
+import numpy as np
+
+from refl1d.names import *
+
+def _probe(T):
+    R, dR = np.ones_like(T), 0.01*np.ones_like(T)
+    return NeutronProbe(T=T, dT=0.01, L=4.75, dL=0.0475, data=(R, dR))
+
+def _roundtrip(obj):
+    data = pickle.dumps(obj, protocol=2)
+    return len(data), pickle.loads(data)
+
+def test_experiment_pickle():
+    T = np.linspace(0.1, 5, 200)
+    probe = _probe(T)
+    probe.oversample(20, seed=1)
+    sample = silicon(0, 5) | SLD(rho=4)(100, 5) | air
+    M = Experiment(probe=probe, sample=sample)
+    M.nllf()
+    size, M2 = _roundtrip(M)
+    assert M2.is_reset()
+    assert np.array_equal(M2.probe.calc_Qo, M.probe.calc_Qo)
+    assert np.array_equal(M2.probe._L_idx, M.probe._L_idx)
+    assert np.allclose(M2.reflectivity()[1], M.reflectivity()[1])
+    assert M2.nllf() == M.nllf()
+
+    # The rendered profile and the derived probe arrays are not sent.
+    M.reflectivity()
+    assert size < 0.5*len(pickle.dumps(M.__dict__, protocol=2))
+
+def test_polarized_pickle():
+    T = np.linspace(0.1, 5, 100)
+    probe = PolarizedNeutronProbe([_probe(T), None, None, _probe(T)])
+    sample = (silicon(0, 5) | SLD(rho=4)(100, 5, magnetism=Magnetism(rhoM=1))
+              | air)
+    M = Experiment(probe=probe, sample=sample)
+    M.nllf()
+    size, M2 = _roundtrip(M)
+    assert np.array_equal(M2.probe.Q, M.probe.Q)
+    for a, b in zip(M2.reflectivity(), M.reflectivity()):
+        if a is not None:
+            assert np.allclose(a[1], b[1])
+    assert M2.nllf() == M.nllf()
+
+def test_shared_memory():
+    T = np.linspace(0.1, 5, 200)
+    probe = PolarizedNeutronProbe([_probe(T), None, None, _probe(T)])
+    probe.oversample(5, seed=1)
+    sample = silicon(0, 5) | SLD(rho=4)(100, 5) | air
+    M = Experiment(probe=probe, sample=sample)
+    nllf = M.nllf()
+    path = tempfile.mkdtemp()
+    try:
+        probe.share_memory(path)
+        # identical arrays in the two cross sections share a file
+        files = set(probe.xs[0]._shared.values())
+        assert files == set(probe.xs[3]._shared.values())
+        directory, = os.listdir(path)
+        assert all(os.path.dirname(f) == os.path.join(path, directory)
+                   for f in files)
+        M.update()
+        assert M.nllf() == nllf
+        size, M2 = _roundtrip(M)
+        assert size < 10000
+        assert isinstance(M2.probe.xs[0].calc_T, np.memmap)
+        assert M2.probe.xs[0].calc_T.filename == probe.xs[0].calc_T.filename
+        assert M2.nllf() == nllf
+    finally:
+        shutil.rmtree(path)
+
+def test_shared_memory_owner():
+    T = np.linspace(0.1, 5, 200)
+    probe = _probe(T)
+    path = tempfile.mkdtemp()
+    try:
+        # a directory left by a process which no longer exists is removed
+        dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+        dead.wait()
+        stale = os.path.join(path, 'refl1d-shm-%d-x'%dead.pid)
+        os.mkdir(stale)
+
+        # another process sharing the same data first and exiting while we
+        # are still using it does not remove our files
+        script = ("import pickle, sys; p = pickle.load(sys.stdin.buffer);"
+                  " p.share_memory(%r); print('ready'); sys.stdout.flush();"
+                  " sys.stdin.readline()"%path)
+        child = subprocess.Popen([sys.executable, '-c', script],
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        pickle.dump(_probe(T), child.stdin, protocol=2)
+        child.stdin.flush()
+        assert child.stdout.readline().strip() == b'ready'
+        probe.share_memory(path)
+        assert not os.path.exists(stale)
+        child.communicate(b'\n')
+        assert child.returncode == 0
+        _, probe2 = _roundtrip(probe)
+        assert np.array_equal(probe2.R, probe.R)
+
+        # a missing file gives a clear error in the worker
+        data = pickle.dumps(probe, protocol=2)
+        os.unlink(probe._shared['R'])
+        try:
+            pickle.loads(data)
+        except IOError as exc:
+            assert 'share_memory' in str(exc)
+        else:
+            raise AssertionError("missing shared file not reported")
+    finally:
+        shutil.rmtree(path)
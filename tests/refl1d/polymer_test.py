@@ -176,6 +176,27 @@ def calc_g_zs_free_test():
     check(g_zs.free(), g_zs_data, rtol=1e-7)
 
 
+def calc_g_zs_numba_test():
+    from refl1d import polymer, util
+    if not util.numba_available():
+        return
+    layers = 10
+    segments = 20
+    g_z = np.linspace(.9, 1.1, layers)
+    c_i = np.linspace(0, 1, segments)
+    saved = Propagator.cex
+    try:
+        Propagator.cex = polymer.USE_NUMBA = False
+        g_zs = Propagator(g_z, segments)
+        target = g_zs.ngts(c_i)
+        polymer.USE_NUMBA = True
+        check(g_zs.ngts(c_i), target)
+        check(g_zs.ngts_u(1.0), g_zs_data, rtol=1e-7)
+    finally:
+        Propagator.cex = saved
+        polymer.USE_NUMBA = None
+
+
 def SZdist_test():
 
     # uniform
@@ -440,6 +461,14 @@ def SCFsolve_test():
     result = SCFsolve(chi, chi_s, pdi, sigma, 0, navgsegments, False, phi0)
     check(result, data)
 
+    # preconditioned solver finds the same solution over the whole profile
+    result = SCFsolve(chi, chi_s, pdi, sigma, 0, navgsegments, False, phi0,
+                      precondition=True)
+    check(result, data)
+    result = SCFsolve(0.1, 0.05, pdi, sigma, 0, navgsegments,
+                      precondition=True)
+    check(result, easy_phi_z)
+
 
 def SCFcache_test():
 
@@ -754,6 +783,39 @@ def PolymerBrush_test():
     check(result, data)
 
 
+def SCFstore_test():
+    import tempfile, shutil
+    from collections import OrderedDict
+    from refl1d.polymer import SCFstore
+
+    path = tempfile.mkdtemp()
+    try:
+        store = SCFstore(path, max_entries=4)
+        # solutions are saved to disk and shared with a fresh process cache
+        phi = SCFcache(0, 0, 1, .1, 0, 80, cache=OrderedDict(), store=store)
+        assert len(store) == 1
+        other = SCFstore(path, max_entries=4)
+        params = np.array((0, 0, 0, .1, 0, 80/500))
+        stored, stored_phi = other.nearest(params + 0.01)
+        check(stored, params)
+        check(stored_phi, phi)
+        result = SCFcache(0, 0, 1, .1, 0, 80, cache=OrderedDict(), store=other)
+        check(result, phi)
+        assert len(other) == 1
+        # least recently used entries are evicted
+        for k in range(6):
+            other.save(params + k + 1, phi)
+        assert len(other) == 4
+        check(other.nearest(params + 6.1)[0], params + 6)
+        # eviction removes a batch so the directory is not scanned each save
+        other.max_entries = 20
+        for k in range(17):
+            other.save(params + k + 10, phi)
+        assert len(other) == 18
+    finally:
+        shutil.rmtree(path)
+
+
 if __name__ == '__main__':
     calc_g_zs_ta_test()
     calc_g_zs_ngts_u_test()
@@ -763,7 +825,9 @@ if __name__ == '__main__':
     SCFeqns_test()
     SCFsolve_test()
     SCFcache_test()
+    SCFstore_test()
     SCFprofile_test()
     EndTetheredPolymer_test()
     PolymerMushroom_test()
     PolymerBrush_test()
+
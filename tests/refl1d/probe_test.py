@@ -0,0 +1,53 @@
+import numpy as np
+
+from refl1d.names import (
+    NeutronProbe, ProbeSet, PolarizedNeutronProbe, Slab, SLD, Magnetism,
+    Experiment)
+from refl1d.probe import merge_points
+from refl1d.resolution import TL2Q
+from refl1d.reflectivity import magnetic_amplitude
+
+
+def _probe(T, dT=0.01, L=4.75):
+    probe = NeutronProbe(T=T, dT=dT, L=L, dL=0.05)
+    probe.R = np.exp(-20*probe.Q)
+    probe.dR = 0.05*probe.R
+    return probe
+
+def test_merge_points():
+    Q = np.array([0.1, 0.2, 0.1*(1 + 1e-12), 0.3, 0.2, 0.05])
+    Qm, index = merge_points(Q)
+    assert np.array_equal(Qm, [0.05, 0.1, 0.2, 0.3])
+    assert np.allclose(Qm[index], Q, rtol=1e-10, atol=0)
+    Qm, index = merge_points(Q, tolerance=0)
+    assert len(Qm) == 5 and np.array_equal(Qm[index], Q)
+
+def test_probeset_overlap():
+    # overlapping angular segments with round-off in the shared angles
+    T = np.linspace(0.2, 2., 40)
+    probe = ProbeSet([_probe(T[:30]), _probe(T[10:]*(1 + 1e-13))])
+    assert len(probe.calc_Q) == len(T)
+
+def test_polarized_duplicates():
+    # cross sections at the same angles with different angular resolution
+    T = np.linspace(0.2, 2., 40)
+    xs = [_probe(T, dT=0.01), None, None, _probe(T, dT=0.02)]
+    probe = PolarizedNeutronProbe(xs)
+    assert len(probe.T) == 2*len(T) and len(probe.calc_Q) == len(T)
+
+    sample = (Slab(material=SLD(name='Si', rho=2.07))
+              | Slab(material=SLD(name='Fe', rho=8.), thickness=100,
+                     interface=5, magnetism=Magnetism(rhoM=2., thetaM=270))
+              | Slab(material=SLD(name='air', rho=0.), interface=3))
+    M = Experiment(sample=sample, probe=probe)
+    theory = M.reflectivity()
+
+    # duplicate theory points do not change the convolution
+    w, sigma, rho, irho, rhoM, thetaM = M.magnetic_slabs()
+    Q = np.sort(TL2Q(probe.T, probe.L))
+    r = magnetic_amplitude(-Q/2, depth=w, rho=rho, irho=irho, rhoM=rhoM,
+                           thetaM=thetaM, sigma=sigma[:-1],
+                           Aguide=probe.Aguide.value, H=probe.H.value)
+    expected = probe.apply_beam(Q, [abs(ri)**2 for ri in r])
+    for k in (0, 3):
+        assert np.allclose(theory[k][1], expected[k][1], rtol=1e-12)
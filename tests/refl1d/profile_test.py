@@ -0,0 +1,96 @@
+import numpy as np
+
+from refl1d.names import *
+from refl1d.profile import Microslabs
+
+def test_adaptive_microslabs():
+    S = Microslabs(nprobe=1, dz=0.5)
+    def profile(z):
+        rho = 2.07 + (4.5-2.07)*(1 + np.tanh((z-20)/2))/2
+        return rho, 0.01*rho
+    w, z, (rho, irho) = S.adaptive_microslabs(100, profile)
+    # without dA the uniform microslabs are used
+    assert len(w) == 200 and (w == 0.5).all()
+    S.dA = 0.1
+    w, z, (rho, irho) = S.adaptive_microslabs(100, profile)
+    assert len(w) < 40
+    assert abs(np.sum(w) - 100) < 1e-10
+    assert abs(z - (np.cumsum(w) - w/2)).max() < 1e-10
+    # thin slabs on the interface, thick slabs in the bulk
+    assert w.min() > 0.45
+    assert w[np.argmin(abs(z-20))] < 1 and w[-1] > 10
+    # area condition holds for each slab
+    for wk, zk in zip(w, z):
+        zk = np.linspace(zk-wk/2, zk+wk/2, 50)
+        assert wk*np.ptp(profile(zk)[0]) < 3*S.dA
+
+def test_pointwise_microslabs():
+    S = Microslabs(nprobe=1, dz=0.5)
+    S.dA = 0.1
+    calls = []
+    def profile(z):
+        calls.append(len(z))
+        rho = 2.07 + (4.5-2.07)*(1 + np.tanh((z-20)/2))/2
+        return rho, 0.01*rho
+    w, z, (rho, irho) = S.adaptive_microslabs(100, profile)
+    uniform = sum(calls)
+    del calls[:]
+    w, z, (rho, irho) = S.adaptive_microslabs(100, profile, pointwise=True)
+    # the profile is only evaluated where it changes
+    assert sum(calls) < uniform/2
+    assert abs(np.sum(w) - 100) < 1e-10
+    assert abs(z - (np.cumsum(w) - w/2)).max() < 1e-10
+    assert np.allclose(rho, profile(z)[0], rtol=1e-12)
+    assert w.min() > 0.5/np.sqrt(2) - 1e-10 and w[-1] > 5
+    for wk, zk in zip(w, z):
+        zk = np.linspace(zk-wk/2, zk+wk/2, 50)
+        assert wk*np.ptp(profile(zk)[0]) < 3*S.dA
+
+def test_pointwise_reflectivity():
+    T = np.linspace(0.1, 5, 100)
+    probe = NeutronProbe(T=T, dT=0.02, L=4.75, dL=0.0475)
+    def experiment(dA):
+        layer = FreeInterface(below=silicon, above=SLD(rho=4.5),
+                              thickness=100, dz=[1, 2, 1], dp=[1, 4, 1])
+        sample = silicon(0, 5) | layer | SLD(rho=4.5)(0, 5)
+        return Experiment(sample=sample, probe=probe, dz=0.5, dA=dA)
+    exact = experiment(None).reflectivity()[1]
+    M = experiment(0.1)
+    R = M.reflectivity()[1]
+    assert len(M.slabs()[0]) < len(M._slabs.microslabs(100)[0])/4
+    # the slab model differs from the smooth profile far below the
+    # measurable reflectivity
+    index = exact > 1e-7
+    assert np.max(abs(R - exact)[index]/exact[index]) < 0.03
+
+def test_adaptive_reflectivity():
+    T = np.linspace(0.1, 5, 100)
+    probe = NeutronProbe(T=T, dT=0.02, L=4.75, dL=0.0475)
+    def experiment(dA):
+        layer = FreeformCheby(200, rho=[2.07, 2.07, 4.5, 4.5, 4.5, 4.5],
+                              irho=[0, 0])
+        sample = silicon(0, 5) | layer | SLD(rho=4.5)(0, 5)
+        return Experiment(sample=sample, probe=probe, dz=0.5, dA=dA)
+    exact = experiment(None).reflectivity()[1]
+    M = experiment(0.1)
+    uniform = len(M._slabs.microslabs(200)[0])
+    R = M.reflectivity()[1]
+    assert len(M.slabs()[0]) < uniform/4
+    assert np.max(abs(R - exact)/exact) < 0.03
+
+def test_build_profile():
+    from refl1d.profile import build_profile, blend
+    rng = np.random.RandomState(1)
+    n = 20
+    offset = np.cumsum(rng.uniform(0, 20, n))
+    sigma = rng.uniform(0, 8, n)
+    sigma[::7] = 0
+    value = rng.normal(size=(3, n+1))
+    z = np.arange(-20, offset[-1]+20, 0.1)
+    # all rows in one call match the unwindowed sum over interfaces
+    result = build_profile(z, offset, sigma, value)
+    for row, target in zip(result, value):
+        direct = target[0] + sum(c*blend(z, s, o) for o, s, c
+                                 in zip(offset, sigma, np.diff(target)))
+        assert np.max(abs(row - direct)) < 1e-8
+    assert build_profile(z, offset, sigma, value[0]).shape == z.shape
@@ -0,0 +1,32 @@
+import os
+from multiprocessing import Pool
+
+from refl1d import reflectivity
+from refl1d.reflectivity import set_num_threads, get_num_threads
+
+def test_num_threads():
+    from refl1d import reflmodule
+    if not reflmodule._have_openmp():
+        assert get_num_threads() == 1
+        return
+    try:
+        set_num_threads(3)
+        assert get_num_threads() == 3
+        # pool workers run single threaded regardless of the parent setting
+        pool = Pool(1)
+        try:
+            assert pool.apply(get_num_threads) == 1
+        finally:
+            pool.close()
+            pool.join()
+        set_num_threads(None)
+        os.environ['REFL1D_NUM_THREADS'] = '2'
+        assert get_num_threads() == 2
+        del os.environ['REFL1D_NUM_THREADS']
+        os.environ['OMPI_COMM_WORLD_SIZE'] = '4'
+        reflectivity._thread_pid[0] = None
+        assert get_num_threads() == 1
+    finally:
+        os.environ.pop('REFL1D_NUM_THREADS', None)
+        os.environ.pop('OMPI_COMM_WORLD_SIZE', None)
+        set_num_threads(None)